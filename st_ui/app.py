@@ -97,6 +97,11 @@ def show_version_and_config():
     footer_text = ConfigStore.get_config_and_version_string()
     FloatingFooter.show(footer_text)
 
+@st.cache_resource
+def start_config_refresh():
+    """ Warm the config cache and watch for changes, cached so it runs once per process """
+    ConfigStore.start_background_refresh()
+
 def handle_user_auth():
     """ Handle authentication - return true to proceed with rest of app """
 
@@ -115,6 +120,9 @@ def main():
     # Wide
     st.set_page_config(page_title="Labs Platform GenAI Tool", page_icon='\U0001F411', layout="wide")
 
+    # Warm the config cache and watch for changes - only runs once in the process
+    start_config_refresh()
+
     # Check auth
     if not handle_user_auth():
         return
@@ -104,14 +104,15 @@ class SideBarStateMgr:
         state_to_save = {key: st.session_state[key] for key in st.session_state
                          if SideBarStateMgr.key_is_persistant(key, key_storage_map)}
         rel_path = self.get_state_relative_path(name)
-        self.storage.write_text(rel_path, json.dumps(state_to_save))
+        with self.storage.open_write(rel_path, encoding='utf-8') as file:
+            json.dump(state_to_save, file)
 
 
     def load_state(self, name, key_storage_map):
         """ Load the state for the name """
         rel_path = self.get_state_relative_path(name)
-        loaded_state = self.storage.read_text(rel_path)
-        loaded_state = json.loads(loaded_state)
+        with self.storage.open_read(rel_path, encoding='utf-8') as file:
+            loaded_state = json.load(file)
         return {key: loaded_state[key] for key in loaded_state
                 if SideBarStateMgr.key_is_persistant(key, key_storage_map)}
 
@@ -134,12 +135,13 @@ class SideBarStateMgr:
     def duplicate_state(self, name):
         """ Make a copy of name, check for clashes and increment an index, return new name """
         index = 1
+        existing_files = set(self.storage.list_files(''))
         while True:
             new_name = f'{name}_{index}'
             source_rel_path = self.get_state_relative_path(name)
             destination_rel_path = self.get_state_relative_path(new_name)
 
-            if not self.storage.file_exists(destination_rel_path):
+            if destination_rel_path not in existing_files:
                 try:
                     self.storage.copy(source_rel_path, destination_rel_path)
                     return new_name
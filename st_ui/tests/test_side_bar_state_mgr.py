@@ -53,6 +53,18 @@ class TestSideBarStateMgr(unittest.TestCase):
         self.side_bar_state_mgr.save_state('test_state', key_storage_map )
         self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'test_state.json')))
 
+    def test_failed_save_keeps_saved_state(self):
+        key_storage_map  = { 'persistant' : ['count', 'bad'], 'volatile' : []}
+        self.mock_session_state['count'] = 5
+        self.side_bar_state_mgr.save_state('test_state', key_storage_map )
+
+        self.mock_session_state['bad'] = object()
+        with self.assertRaises(TypeError):
+            self.side_bar_state_mgr.save_state('test_state', key_storage_map )
+        self.assertEqual(self.side_bar_state_mgr.load_state('test_state', key_storage_map ),
+                         {'count': 5})
+        self.assertEqual(os.listdir(self.temp_dir), ['test_state.json'])
+
     def test_load_state(self):
         test_state = {'count': 10, 'name': 'LoadTest'}
         with open(os.path.join(self.temp_dir, 'test_load.json'), 'w', encoding='utf-8') as f:
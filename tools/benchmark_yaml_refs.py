@@ -0,0 +1,84 @@
+""" Time YAML reference resolution on a synthetic template with shared fragments """
+import os
+import time
+from tool_utils import  ToolBase # pylint: disable=import-error
+
+class YAMLRefBenchmark(ToolBase):
+    """ Tool class to benchmark YAMLKeyResolver """
+
+    def __init__(self):
+        super().__init__()
+        self.setup_arguments({
+            "--nodes": {"type": int, "default": 10000,
+                        "help": "Approximate number of resolved nodes"},
+            "--repeats": {"type": int, "default": 5, "help": "Number of timed runs"}
+        })
+
+    @staticmethod
+    def make_template(nodes):
+        """ Build a template of about the given number of nodes where steps share
+        a chain of fragments through $ref and $allOf
+        """
+
+        # A chain of fragments, each building on the one before
+        fragments = {"base": {"options": {f"option_{index}": index for index in range(20)},
+                              "prompts": [f"prompt {index}" for index in range(10)]}}
+        previous = "base"
+        for level in range(10):
+            name = f"level_{level}"
+            fragments[name] = {
+                "$allOf": f"#/fragments/{previous}",
+                "options": {f"level_{level}_option": level},
+                "settings": {"depth": level, "labels": {"name": name}}
+            }
+            previous = name
+
+        # Steps that use the fragments until we reach the size
+        steps = {}
+        index = 0
+        while len(steps) * 40 < nodes:
+            steps[f"step_{index}"] = {
+                "$ref": f"#/fragments/level_{index % 10}",
+                "title": f"Step {index}",
+                "options": {"step": index}
+            }
+            index += 1
+
+        # Done
+        return {"fragments": fragments, "steps": steps}
+
+    @staticmethod
+    def count_nodes(obj):
+        """ Count the dicts, lists and values in the object """
+        if isinstance(obj, dict):
+            return 1 + sum(YAMLRefBenchmark.count_nodes(value) for value in obj.values())
+        if isinstance(obj, list):
+            return 1 + sum(YAMLRefBenchmark.count_nodes(value) for value in obj)
+        return 1
+
+    def run(self):
+        """ Run the tool """
+
+        self.setup_python_path()
+        from utils.yaml_utils import YAMLKeyResolver # pylint: disable=import-outside-toplevel
+
+        template = self.make_template(self.get_argument_value("--nodes"))
+        repeats = self.get_argument_value("--repeats")
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            resolved = YAMLKeyResolver.resolve_refs(template)
+            timings.append(time.perf_counter() - start)
+
+        print(f"Source nodes: {self.count_nodes(template)}")
+        print(f"Resolved nodes: {self.count_nodes(resolved)}")
+        print(f"Best of {repeats}: {min(timings) * 1000:.1f} ms")
+
+        # Zero is ok
+        return 0
+
+if __name__ == "__main__":
+
+    # Run an instance of the tool
+    os._exit(YAMLRefBenchmark().run())
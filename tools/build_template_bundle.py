@@ -0,0 +1,31 @@
+""" Compile all the flow templates into one bundle file that is quick to load at startup """
+import os
+from tool_utils import  ToolBase # pylint: disable=import-error
+
+class TemplateBundleBuilder(ToolBase):
+    """ Tool class to build the template bundle """
+
+    def run(self):
+        """ Run the tool """
+
+        # Templates paths are relative to the root
+        self.setup_python_path()
+        os.chdir(self.get_base_path())
+        from utils.template_mgr import TemplateManager # pylint: disable=import-outside-toplevel
+
+        try:
+            bundle = TemplateManager().build_bundle()
+        except ValueError as e:
+            print(f"Template bundle not built: {e}")
+            return 1
+
+        # Zero is ok
+        template_count = sum(len(templates) for templates in bundle["templates"].values())
+        print(f"Bundled {len(bundle['groups'])} groups and {template_count} templates")
+        print(f"Content hash: {bundle['content_hash']}")
+        return 0
+
+if __name__ == "__main__":
+
+    # Run an instance of the tool
+    os._exit(TemplateBundleBuilder().run())
@@ -3,7 +3,9 @@ import streamlit as st
 from typing import Dict, Any
 from utils.get_text import TxtGetter as TxtGetter
 from st_ui.step_list import StepContainer
-from utils.step_utils import BaseFlowStep, StepConfigException, StepStatus
+from utils.step_utils import BaseFlowStep
+from utils.step_status import StepConfigException, StepStatus
+from utils.flow_plan import FlowPlan, StepStatusEvaluator
 
 
 class BaseFlowApp:
@@ -18,6 +20,13 @@ class BaseFlowApp:
         self.config = config
         self.steps = {}
 
+        # Plan shared by every load of this template version, built by load_steps
+        self.config_digest = FlowPlan.config_digest(config)
+        self.plan = None
+
+        # Step statuses for this rerun, set up by show_steps
+        self.status_evaluator = None
+
         # Title and description
         st.title(config['title'])
         st.write(config['description'])
@@ -58,8 +67,15 @@ class BaseFlowApp:
         step_names = list(self.steps.keys())
         return step_names
 
+    def get_plan(self):
+        """ Get the flow plan, None until the steps are loaded """
+        return self.plan
+
     def get_prev_step(self, step_name):
         """ Get the step previous to the named one - or None """
+        if self.plan is not None:
+            prev_step_name = self.plan.prev[step_name]
+            return self.steps[prev_step_name] if prev_step_name is not None else None
         step_names = self.get_step_names()
         cur_index = step_names.index(step_name)
         if cur_index == 0:
@@ -69,6 +85,9 @@ class BaseFlowApp:
 
     def get_next_step(self, step_name):
         """ Get the step after to the named one - or None """
+        if self.plan is not None:
+            next_step_name = self.plan.next[step_name]
+            return self.steps[next_step_name] if next_step_name is not None else None
         step_names = self.get_step_names()
         cur_index = step_names.index(step_name)
         if cur_index >= len(step_names) -1:
@@ -111,6 +130,12 @@ class BaseFlowApp:
         self.steps[step_name] = step
 
     def load_steps(self):
+        """ Create the steps, checking them and building the plan the first time the
+        template version is seen
+        """
+
+        # Steps were already checked if we have a plan
+        plan = FlowPlan.get(self.config_digest)
 
         # Enum steps and add them
         for step_name, step_config in self.config['steps'].items():
@@ -121,13 +146,21 @@ class BaseFlowApp:
             step_class_name = step_config['class']
 
             # Add the step
-            self.add_step(
-                step = BaseFlowStep.create_instance(
-                    class_name=step_class_name,
-                    name=step_name,
-                    app=self,
-                )
+            step = BaseFlowStep.create_instance(
+                class_name=step_class_name,
+                name=step_name,
+                app=self,
             )
+            if plan is None:
+                self.add_step(step)
+            else:
+                self.steps[step_name] = step
+
+        # Build and share the plan
+        if plan is None:
+            plan = FlowPlan.build(self.steps, self.config)
+            FlowPlan.put(self.config_digest, plan)
+        self.plan = plan
 
     def show_steps(self):
         """ Show the steps in the UI """
@@ -165,6 +198,10 @@ class BaseFlowApp:
             # Render the step in the container
             step_container.render_step(step_headng, fn_step_content_wrapper, expand, hide)
 
+        # Work out every step's status in one pass
+        self.status_evaluator = StepStatusEvaluator(self)
+        self.status_evaluator.evaluate(flow_state)
+
         # Show each of the steps
         for _, step in self.steps.items():
             step.show(flow_state, render_step)
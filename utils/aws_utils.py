@@ -1,5 +1,7 @@
 """ Helpers for AWS """
+import threading
 import boto3
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, NoRegionError
 
 
@@ -13,6 +15,58 @@ class AWSUtils:
     CONFIGURED = "Ok, {region}, Key: {access_key}****"
     UNEXPECTED_ERROR = "An unexpected error occurred: {error}"
 
+    # Client settings per service, anything not listed uses the default
+    CLIENT_CONFIGS = {
+        'default': {
+            'max_pool_connections': 10,
+            'retries': {'mode': 'standard', 'max_attempts': 3},
+        },
+        's3': {
+            'max_pool_connections': 50,
+            'retries': {'mode': 'standard', 'max_attempts': 5},
+        },
+        'bedrock-runtime': {
+            'max_pool_connections': 50,
+            'read_timeout': 300,
+            'retries': {'mode': 'adaptive', 'max_attempts': 5},
+        },
+    }
+
+    # Clients shared across threads keyed by (service, region)
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    @staticmethod
+    def get_client(service_name, region_name=None):
+        """
+        Get a client for the service and region, created once and then shared.
+        boto3 clients are thread safe once created, creation itself is serialised.
+        """
+        key = (service_name, region_name)
+        client = AWSUtils._clients.get(key)
+        if client is not None:
+            return client
+
+        with AWSUtils._clients_lock:
+            client = AWSUtils._clients.get(key)
+            if client is None:
+                settings = AWSUtils.CLIENT_CONFIGS.get(
+                    service_name, AWSUtils.CLIENT_CONFIGS['default'])
+                client = boto3.client(
+                    service_name,
+                    region_name=region_name,
+                    config=Config(**settings))
+                AWSUtils._clients[key] = client
+
+        # Done
+        return client
+
+    @staticmethod
+    def clear_clients():
+        """ Drop the shared clients so the next call creates new ones """
+        with AWSUtils._clients_lock:
+            AWSUtils._clients.clear()
+
     @staticmethod
     def is_aws_configured() -> tuple[bool, str]:
         """
@@ -48,4 +102,4 @@ class AWSUtils:
         except NoRegionError:
             return False, AWSUtils.REGION_NOT_CONFIGURED
         except Exception as e: #pylint: disable = broad-exception-caught
-            return False, AWSUtils.UNEXPECTED_ERROR.format(error=str(e))
\ No newline at end of file
+            return False, AWSUtils.UNEXPECTED_ERROR.format(error=str(e))
@@ -0,0 +1,139 @@
+""" Bedrock prompt caching support """
+import contextlib
+import contextvars
+import io
+import json
+
+# Usage dict for the calls being recorded in this context, see record_usage
+_CALL_USAGE = contextvars.ContextVar("bedrock_call_usage", default=None)
+
+
+class BedrockPromptCachingClient:
+    """ Wraps a bedrock-runtime client to mark stable prompt prefixes as cacheable
+
+    The system prompt and the first user message (which carries any retrieved context)
+    are tagged with an ephemeral cache point so repeat chat turns read them from the
+    Bedrock prompt cache. LangChain drops the cache token counts from the response, so
+    calls made inside record_usage report their counts to that block instead. Nothing about
+    a call is kept on the client, which can be shared by concurrent sessions.
+    """
+
+    CACHE_CONTROL = {"type": "ephemeral"}
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        """ Delegate anything we don't wrap to the underlying client """
+        return getattr(self.client, name)
+
+    @staticmethod
+    def add_cache_points(body):
+        """ Add cache control markers to the system prompt and first user message """
+
+        # System prompt - convert to a content block list so it can carry the marker
+        system = body.get("system")
+        if isinstance(system, str) and system:
+            body["system"] = [{
+                "type": "text",
+                "text": system,
+                "cache_control": BedrockPromptCachingClient.CACHE_CONTROL
+            }]
+
+        # First user message - mark the last block of its content
+        for message in body.get("messages", []):
+            if message.get("role") != "user":
+                continue
+            content = message.get("content")
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            if content:
+                content[-1]["cache_control"] = BedrockPromptCachingClient.CACHE_CONTROL
+                message["content"] = content
+            break
+
+        # Done
+        return body
+
+    @staticmethod
+    @contextlib.contextmanager
+    def record_usage():
+        """ Collect the usage of the calls made in this block, in this thread, into a new dict """
+        usage = {}
+        token = _CALL_USAGE.set(usage)
+        try:
+            yield usage
+        finally:
+            _CALL_USAGE.reset(token)
+
+    @staticmethod
+    def extract_usage(response_body, headers):
+        """ Get the token counts from the response body, falling back to headers """
+        usage = response_body.get("usage", {}) if isinstance(response_body, dict) else {}
+
+        def count(body_key, header_key):
+            return int(usage.get(body_key, headers.get(header_key, 0)) or 0)
+
+        return {
+            "input_tokens": count("input_tokens", "x-amzn-bedrock-input-token-count"),
+            "output_tokens": count("output_tokens", "x-amzn-bedrock-output-token-count"),
+            "cache_read_input_tokens": count(
+                "cache_read_input_tokens", "x-amzn-bedrock-cache-read-input-token-count"),
+            "cache_write_input_tokens": count(
+                "cache_creation_input_tokens", "x-amzn-bedrock-cache-write-input-token-count"),
+        }
+
+    def invoke_model(self, **kwargs):
+        """ Add the cache points, invoke and record the usage """
+
+        # Rewrite the request body
+        body = json.loads(kwargs["body"])
+        kwargs["body"] = json.dumps(BedrockPromptCachingClient.add_cache_points(body))
+
+        # Call through
+        response = self.client.invoke_model(**kwargs)
+
+        # If recording read the body to get the usage, then replace it so the caller can read it
+        usage = _CALL_USAGE.get()
+        if usage is not None:
+            raw_body = response["body"].read()
+            headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+            usage.update(BedrockPromptCachingClient.extract_usage(json.loads(raw_body), headers))
+            response["body"] = io.BytesIO(raw_body)
+
+        # Done
+        return response
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        """ Add the cache points, and record the usage as the stream is read """
+
+        # Rewrite the request body
+        body = json.loads(kwargs["body"])
+        kwargs["body"] = json.dumps(BedrockPromptCachingClient.add_cache_points(body))
+
+        # Call through and, if recording, watch the events go by
+        response = self.client.invoke_model_with_response_stream(**kwargs)
+        usage = _CALL_USAGE.get()
+        if usage is not None:
+            response["body"] = BedrockPromptCachingClient._track_stream_usage(
+                response["body"], usage)
+
+        # Done
+        return response
+
+    @staticmethod
+    def _track_stream_usage(events, usage):
+        """ Pass the stream events through, picking up the usage from the message events """
+        stream_usage = {}
+        usage.update(BedrockPromptCachingClient.extract_usage({}, {}))
+        for event in events:
+            chunk = event.get("chunk")
+            if chunk:
+                chunk_body = json.loads(chunk["bytes"])
+                if chunk_body.get("type") == "message_start":
+                    stream_usage.update(chunk_body.get("message", {}).get("usage", {}))
+                elif chunk_body.get("type") == "message_delta":
+                    stream_usage.update(chunk_body.get("usage", {}))
+                usage.update(BedrockPromptCachingClient.extract_usage(
+                    {"usage": stream_usage}, {}))
+            yield event
@@ -0,0 +1,275 @@
+""" S3 storage with a bounded read-through cache on local disk """
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from utils.storage_utils import S3StorageBackend
+
+
+class S3DiskCache:
+    """ Size bounded copies of S3 objects on local disk, least recently used first out
+
+    One cache is shared by every backend on the same directory so its limit covers them
+    all. Each copy is written to a new file so files are read, written and removed outside
+    the lock, only the index of entries is changed under it.
+    """
+
+    # Caches shared by directory
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._cache_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_entries()
+
+    @staticmethod
+    def get_shared(cache_dir, max_bytes):
+        """ Get the cache for the directory, created once, the smallest limit asked for applies """
+        cache_dir = os.path.abspath(cache_dir)
+        with S3DiskCache._shared_lock:
+            cache = S3DiskCache._shared.get(cache_dir)
+            if cache is None:
+                cache = S3DiskCache(cache_dir, max_bytes)
+                S3DiskCache._shared[cache_dir] = cache
+        if max_bytes < cache.max_bytes:
+            cache.set_max_bytes(max_bytes)
+        return cache
+
+    @staticmethod
+    def clear_shared():
+        """ Drop the shared caches, the next use loads them from disk again """
+        with S3DiskCache._shared_lock:
+            S3DiskCache._shared.clear()
+
+    def _new_file(self, key: str) -> str:
+        """ Get a new file path for a copy of the key """
+        key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key_hash}-{uuid.uuid4().hex}")
+
+    def _load_entries(self):
+        """ Pick up entries left on disk by an earlier process, oldest first, and remove
+        any files left over from replaced copies or interrupted writes
+        """
+        found = {}
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".meta"):
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as file:
+                        meta = json.load(file)
+                    mtime = entry.stat().st_mtime
+                except (OSError, ValueError):
+                    continue
+                previous = found.get(meta["key"])
+                if previous is None or previous[0] < mtime:
+                    found[meta["key"]] = (mtime, entry.path.removesuffix(".meta"), meta)
+
+        for _mtime, data_file, meta in sorted(found.values(), key=lambda item: item[0]):
+            if os.path.exists(data_file):
+                self._entries[meta["key"]] = {
+                    "file": data_file, "etag": meta["etag"], "size": meta["size"], "checked": 0}
+                self._cache_bytes += meta["size"]
+        stale = self._evict()
+
+        # Anything we aren't using can go
+        in_use = set()
+        for entry in self._entries.values():
+            in_use.update((entry["file"], f"{entry['file']}.meta"))
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.path not in in_use:
+                stale.append({"file": entry.path})
+        S3DiskCache._remove_files(stale)
+
+    def _evict(self) -> list:
+        """ Drop least recently used entries until under the size limit, lock must be held
+        Returns the entries whose files need removing
+        """
+        evicted = []
+        while self._cache_bytes > self.max_bytes and self._entries:
+            _key, entry = self._entries.popitem(last=False)
+            self._cache_bytes -= entry["size"]
+            evicted.append(entry)
+        return evicted
+
+    @staticmethod
+    def _remove_files(entries: list):
+        """ Remove the files of the entries """
+        for entry in entries:
+            for file_path in (entry["file"], f"{entry['file']}.meta"):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+    def set_max_bytes(self, max_bytes):
+        """ Change the size limit, evicting as needed """
+        with self._lock:
+            self.max_bytes = max_bytes
+            evicted = self._evict()
+        S3DiskCache._remove_files(evicted)
+
+    def get(self, key: str):
+        """ Get (entry, data) for the key or None if not cached """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            with open(entry["file"], "rb") as file:
+                return entry, file.read()
+        except FileNotFoundError:
+            # Replaced, evicted or removed from disk - forget it unless it was replaced
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._entries.pop(key)
+                    self._cache_bytes -= entry["size"]
+            return None
+
+    def put(self, key: str, etag: str, data: bytes):
+        """ Add or replace the copy of the key """
+        if len(data) > self.max_bytes:
+            self.remove(key)
+            return
+
+        # Write the new copy, the meta file last as it marks the copy complete
+        entry = {"file": self._new_file(key), "etag": etag, "size": len(data),
+                 "checked": time.monotonic()}
+        meta = json.dumps({"key": key, "etag": etag, "size": len(data)}).encode("utf-8")
+        try:
+            for file_path, content in ((entry["file"], data), (f"{entry['file']}.meta", meta)):
+                with open(file_path, "wb") as file:
+                    file.write(content)
+        except OSError:
+            S3DiskCache._remove_files([entry])
+            raise
+
+        # Swap it in
+        with self._lock:
+            stale = []
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._cache_bytes -= previous["size"]
+                stale.append(previous)
+            self._entries[key] = entry
+            self._cache_bytes += entry["size"]
+            stale.extend(self._evict())
+        S3DiskCache._remove_files(stale)
+
+    def remove(self, key: str):
+        """ Drop the copy of the key """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._cache_bytes -= entry["size"]
+        if entry is not None:
+            S3DiskCache._remove_files([entry])
+
+
+class CachedS3StorageBackend(S3StorageBackend):
+    """ S3 storage with a bounded read-through cache on local disk
+
+    Cached objects are checked with a conditional GET on their ETag so a hit costs a
+    request but no download, within max_age_seconds of the last check the disk copy is
+    used without asking S3. Writes go through to the cache, deletes and renames remove
+    entries and the least recently used entries are evicted over max_bytes. Backends on
+    the same bucket share one cache.
+    """
+
+    def __init__(self, path, region_name=None, cache_dir=None,
+                 max_bytes=256 * 1024 * 1024, max_age_seconds=0):
+        super().__init__(path, region_name)
+        cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "s3_storage_cache")
+        self.cache = S3DiskCache.get_shared(os.path.join(cache_dir, self.bucket_name), max_bytes)
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def read_binary(self, path: str) -> bytes:
+        """ Read a binary file, from the disk cache if it is still current """
+        key = self._normalize_path(path)
+        cached = self.cache.get(key)
+
+        if cached is not None:
+            entry, data = cached
+
+            # Recently checked - use as is
+            if time.monotonic() - entry["checked"] < self.max_age_seconds:
+                self.hits += 1
+                return data
+
+            # Ask S3 if it has changed
+            self._check_bucket_exists()
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=key, IfNoneMatch=entry["etag"])
+            except ClientError as exc:
+                if exc.response['Error']['Code'] in ('304', 'NotModified'):
+                    entry["checked"] = time.monotonic()
+                    self.hits += 1
+                    return data
+                self.cache.remove(key)
+                self._on_client_error()
+                err_msg = f"Could not read file at {key}: {exc}"
+                raise FileNotFoundError(err_msg) from exc
+        else:
+            response = self._get_object(key)
+
+        # Download and cache
+        self.misses += 1
+        data = response['Body'].read()
+        self.cache.put(key, response['ETag'], data)
+        return data
+
+    def write_binary(self, path: str, data: bytes) -> None:
+        """ Write a binary file to S3 and the cache """
+        key = self._normalize_path(path)
+        try:
+            response = self._put_object(key, data)
+        except IOError:
+            self.cache.remove(key)
+            raise
+        self.cache.put(key, response['ETag'], data)
+
+    def delete(self, path: str) -> None:
+        """ Delete a file in S3 and the cache """
+        self.cache.remove(self._normalize_path(path))
+        super().delete(path)
+
+    def open_write(self, path: str, encoding: str = None):
+        """ Open a file as a write stream, the cached copy is dropped """
+        self.cache.remove(self._normalize_path(path))
+        return super().open_write(path, encoding)
+
+    def _stream_written(self, key: str, response: dict) -> None:
+        """ Drop anything cached while the stream was open """
+        self.cache.remove(key)
+
+    def delete_many(self, paths: list) -> None:
+        """ Delete the files in S3 and the cache """
+        paths = list(paths)
+        for path in paths:
+            self.cache.remove(self._normalize_path(path))
+        super().delete_many(paths)
+
+    def copy_many(self, pairs: list) -> None:
+        """ Copy within S3, the destinations are fetched again on next read """
+        pairs = list(pairs)
+        for _source_path, destination_path in pairs:
+            self.cache.remove(self._normalize_path(destination_path))
+        super().copy_many(pairs)
+
+    def copy(self, source_path: str, destination_path: str) -> None:
+        """ Copy a file within S3, the destination is fetched again on next read """
+        self.cache.remove(self._normalize_path(destination_path))
+        super().copy(source_path, destination_path)
@@ -1,11 +1,12 @@
 """ Utility class to handle secure retrieval of params and secrets """
 import os
 import json
-from functools import lru_cache
+import copy
+import time
+import threading
 import logging
 import hashlib
-import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 import toml
 from utils.aws_utils import AWSUtils
 
@@ -40,6 +41,62 @@ class VersionInfo:
         """ The commit sha that triggered the build """
         return self.config.get('build', {}).get('github_sha', 'n/a')
 
+class ConfigSectionCache:
+    """ Process wide cache of parsed config sections keyed by config path and section
+
+    Entries expire after ttl_seconds. Hits and misses are counted so the effect on
+    parameter store calls can be checked.
+    """
+
+    def __init__(self, ttl_seconds=300):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, config_path, section):
+        """ Return the value if cached and fresh, otherwise raise KeyError """
+        key = (config_path, section)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() >= entry[0]:
+                self._entries.pop(key, None)
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            value = entry[1]
+
+        # Copy so callers can't change the cached value
+        return copy.deepcopy(value)
+
+    def put(self, config_path, section, value):
+        """ Add or replace a section """
+        expires = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[(config_path, section)] = (expires, copy.deepcopy(value))
+
+    def invalidate(self, config_path=None, section=None):
+        """ Remove matching entries, no arguments clears everything """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                path_match = config_path is None or key[0] == config_path
+                section_match = section is None or key[1] == section
+                if path_match and section_match:
+                    del self._entries[key]
+
+    def get_stats(self):
+        """ Get the hit and miss counters and the number of entries """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def reset_stats(self):
+        """ Zero the hit and miss counters """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
 class ConfigParamRetriever():
     """ Implements secure parameter retreival from configured location
 
@@ -52,6 +109,28 @@ class ConfigParamRetriever():
 
     """
     local_config_dir = "local_data/configs"
+
+    # Shared by all instances so lookups hit across calls
+    section_cache = ConfigSectionCache(
+        ttl_seconds=float(os.getenv('CONFIG_CACHE_TTL_SECONDS', '300')))
+
+    # Background refresh of prefetched sections
+    _refresh_lock = threading.Lock()
+    _refresh_thread = None
+    _refresh_stop = None
+    _refresh_ready = None
+
+    # Default seconds between change checks, an SSM check pages through describe_parameters
+    # so it runs far less often than the local file check
+    LOCAL_WATCH_SECONDS = 5
+    SSM_WATCH_SECONDS = 300
+
+    # Errors a refresh logs and rides out, it is retried on the next interval
+    REFRESH_ERRORS = (ClientError, BotoCoreError, OSError, RuntimeError)
+
+    # Last seen section versions per config path
+    _section_versions = {}
+
     def __init__(self, config_path=None):
         """ Read enviroment variable for config location (if set), otherwise default """
 
@@ -112,7 +191,6 @@ class ConfigParamRetriever():
             error_message = f"Unexpected error parsing config '{self.config_path}': {str(e)}"
             raise ValueError(error_message) from e
 
-    @lru_cache(maxsize=10)
     def _fetch_section_from_local(self, key):
         """ Read a config section from local storage """
         # Match agaisnt local list rather than use path directly as that is not secure
@@ -148,20 +226,217 @@ class ConfigParamRetriever():
 
         config_path = self.config_path.removeprefix("ssm::")
         parameter_name = f"{config_path}/{key}"
-        ssm_client = boto3.client('ssm')
+        ssm_client = AWSUtils.get_client('ssm')
         response = ssm_client.get_parameter(Name=parameter_name, WithDecryption=True)
         parameter_value = response['Parameter']['Value']
         return self.__parse_section_helper(parameter_value)
 
+    def _fetch_all_sections_from_ssm(self):
+        """ Read every config section under the SSM prefix using paginated bulk reads """
+
+        config_path = self.config_path.removeprefix("ssm::").rstrip('/')
+        ssm_client = AWSUtils.get_client('ssm')
+        paginator = ssm_client.get_paginator('get_parameters_by_path')
+        sections = {}
+        for page in paginator.paginate(Path=config_path, Recursive=True, WithDecryption=True):
+            for parameter in page.get('Parameters', []):
+                key = parameter['Name'].removeprefix(f"{config_path}/")
+                try:
+                    sections[key] = self.__parse_section_helper(parameter['Value'])
+                except ValueError as e:
+                    # Leave it to the lazy fetch to report
+                    logging.warning(f"Skipping config section '{key}' in prefetch: {e}")
+
+        # Done
+        return sections
+
+    def prefetch(self):
+        """ Load all sections into the cache in as few calls as possible, returns the count
+        Only SSM configs are prefetched, local configs are cheap to read on demand
+        """
+
+        if not self.config_path.startswith('ssm::'):
+            return 0
+
+        sections = self._fetch_all_sections_from_ssm()
+        for key, value in sections.items():
+            ConfigParamRetriever.section_cache.put(self.config_path, key, value)
+
+        # Done
+        logging.info(f"Prefetched {len(sections)} config sections from '{self.config_path}'")
+        return len(sections)
+
+    def _get_section_versions_from_local(self):
+        """ Get a version stamp (file mtime) for each local config section """
+
+        config_path = self.config_path.removeprefix("local::")
+        local_configs = self.get_local_configs()
+        if config_path not in local_configs:
+            return {}
+
+        versions = {}
+        for entry in os.scandir(local_configs[config_path]):
+            key, ext = os.path.splitext(entry.name)
+            if ext in (".json", ".toml") and entry.is_file():
+                versions[key] = max(versions.get(key, 0), entry.stat().st_mtime_ns)
+
+        # Done
+        return versions
+
+    def _get_section_versions_from_ssm(self):
+        """ Get the parameter version for each SSM config section, values are not read """
+
+        config_path = self.config_path.removeprefix("ssm::").rstrip('/')
+        ssm_client = AWSUtils.get_client('ssm')
+        paginator = ssm_client.get_paginator('describe_parameters')
+        versions = {}
+        parameter_filters = [{'Key': 'Path', 'Option': 'Recursive', 'Values': [config_path]}]
+        for page in paginator.paginate(ParameterFilters=parameter_filters):
+            for parameter in page.get('Parameters', []):
+                key = parameter['Name'].removeprefix(f"{config_path}/")
+                versions[key] = parameter.get('Version')
+
+        # Done
+        return versions
+
+    def get_section_versions(self):
+        """ Get a version stamp for each section in the config """
+
+        if self.config_path.startswith('local::'):
+            return self._get_section_versions_from_local()
+        return self._get_section_versions_from_ssm()
+
+    def check_for_changes(self):
+        """ Compare section versions with the last check and drop changed sections from the cache
+        Returns the names of the sections that were added, changed or removed
+        """
+
+        versions = self.get_section_versions()
+        previous = ConfigParamRetriever._section_versions.get(self.config_path)
+        ConfigParamRetriever._section_versions[self.config_path] = versions
+
+        # First check sets the baseline
+        if previous is None:
+            return []
+
+        changed = sorted(
+            key for key in set(versions) | set(previous)
+            if versions.get(key) != previous.get(key))
+        for key in changed:
+            ConfigParamRetriever.invalidate_cache(self.config_path, key)
+
+        # Done
+        if changed:
+            logging.info(f"Config sections changed in '{self.config_path}': {', '.join(changed)}")
+        return changed
+
+    @classmethod
+    def start_background_refresh(cls, interval_seconds=None, config_path=None,
+                                 watch_interval_seconds=None):
+        """ Prefetch and then keep the cache warm and watch for changes from a daemon thread
+        Changed sections are dropped from the cache every watch_interval_seconds, SSM configs
+        are also prefetched in full every interval_seconds. Nothing is fetched on the calling
+        thread, use wait_for_refresh to wait for the first prefetch.
+        Does nothing if a refresh is already running, returns True if started
+        """
+
+        with cls._refresh_lock:
+            if cls._refresh_thread is not None and cls._refresh_thread.is_alive():
+                return False
+
+            retriever = cls(config_path)
+            is_ssm = not retriever.config_path.startswith('local::')
+
+            # Refresh before entries expire so lookups keep hitting
+            if interval_seconds is None:
+                interval_seconds = max(1.0, cls.section_cache.ttl_seconds / 2)
+            if watch_interval_seconds is None:
+                default_watch = cls.SSM_WATCH_SECONDS if is_ssm else cls.LOCAL_WATCH_SECONDS
+                watch_interval_seconds = float(
+                    os.getenv('CONFIG_WATCH_SECONDS', str(default_watch)))
+
+            def prefetch():
+                try:
+                    retriever.prefetch()
+                except cls.REFRESH_ERRORS as e:
+                    logging.warning(f"Config prefetch from '{retriever.config_path}' failed: {e}")
+
+            def check_for_changes():
+                try:
+                    retriever.check_for_changes()
+                except cls.REFRESH_ERRORS as e:
+                    logging.warning(
+                        f"Config change check for '{retriever.config_path}' failed: {e}")
+
+            def refresh_loop(stop_event, ready_event):
+                # Baseline versions before loading so changes in between are picked up
+                check_for_changes()
+
+                # Initial load is one paginated call rather than a chain of lazy fetches
+                if is_ssm:
+                    prefetch()
+                ready_event.set()
+
+                last_prefetch = time.monotonic()
+                while not stop_event.wait(min(watch_interval_seconds, interval_seconds)):
+                    check_for_changes()
+                    if is_ssm and time.monotonic() - last_prefetch >= interval_seconds:
+                        prefetch()
+                        last_prefetch = time.monotonic()
+
+            cls._refresh_stop = threading.Event()
+            cls._refresh_ready = threading.Event()
+            cls._refresh_thread = threading.Thread(
+                target=refresh_loop,
+                args=(cls._refresh_stop, cls._refresh_ready),
+                name="config-refresh",
+                daemon=True)
+            cls._refresh_thread.start()
+            return True
+
+    @classmethod
+    def wait_for_refresh(cls, timeout=None):
+        """ Wait for the first prefetch of the background refresh, returns True once done """
+        ready_event = cls._refresh_ready
+        return ready_event is not None and ready_event.wait(timeout)
+
+    @classmethod
+    def stop_background_refresh(cls):
+        """ Stop the background refresh if running """
+
+        with cls._refresh_lock:
+            if cls._refresh_stop is not None:
+                cls._refresh_stop.set()
+            if cls._refresh_thread is not None:
+                cls._refresh_thread.join()
+            cls._refresh_thread = None
+            cls._refresh_stop = None
+            cls._refresh_ready = None
+
     def _fetch_section(self, key):
-        """ Fetch a config section from the store """
+        """ Fetch a config section from the cache or the store """
+
+        # Try the cache
+        try:
+            return ConfigParamRetriever.section_cache.get(self.config_path, key)
+        except KeyError:
+            pass
 
         # Check if its a local config
         if self.config_path.startswith('local::'):
-            return self._fetch_section_from_local(key)
+            value = self._fetch_section_from_local(key)
+        else:
+            # Default to ssm config
+            value = self._fetch_section_from_ssm_param(key)
+
+        # Cache and return
+        ConfigParamRetriever.section_cache.put(self.config_path, key, value)
+        return value
 
-        # Default to ssm config
-        return self._fetch_section_from_ssm_param(key)
+    @staticmethod
+    def invalidate_cache(config_path=None, section=None):
+        """ Drop cached sections so they are fetched again, no arguments clears everything """
+        ConfigParamRetriever.section_cache.invalidate(config_path, section)
 
     def __getitem__(self, key):
         """ Access a parameter like a dictionary. """
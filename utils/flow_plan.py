@@ -0,0 +1,223 @@
+""" Flow plans built once per config and step statuses worked out per rerun """
+from collections import OrderedDict
+from types import MappingProxyType
+import json
+import hashlib
+import threading
+from utils.step_status import StepConfigException, StatusCriteria
+from utils.step_status import STATUS_OPTION_DEFAULTS
+
+class FlowPlan:
+    """ Everything about a flow that only depends on its config
+
+    Holds the step order, previous and next steps, dependency step names, the token
+    maps used to format prompts and each step's merged options. Plans are keyed by a
+    digest of the flow config so a changed template gets a new plan.
+    """
+
+    # Plans shared by all sessions, least recently used dropped first
+    MAX_PLANS = 64
+    _plans = OrderedDict()
+    _plans_lock = threading.Lock()
+
+    # Digests of recently seen configs by id, each kept with its config so the id isn't reused
+    MAX_DIGESTS = 64
+    _digests = OrderedDict()
+    _digests_lock = threading.Lock()
+
+    def __init__(self, step_names, dependencies, token_maps, step_options):
+        self.step_names = list(step_names)
+        index = {step_name: position for position, step_name in enumerate(self.step_names)}
+        self.prev = {step_name: self.step_names[position - 1] if position > 0 else None
+                     for step_name, position in index.items()}
+        self.next = {step_name: self.step_names[position + 1]
+                     if position < len(self.step_names) - 1 else None
+                     for step_name, position in index.items()}
+        self.dependencies = dependencies
+        self.token_maps = token_maps
+        self.step_options = {step_name: MappingProxyType(options)
+                             for step_name, options in step_options.items()}
+        self.status_sets = {step_name: FlowPlan.status_sets_from_options(options)
+                            for step_name, options in step_options.items()}
+
+    @staticmethod
+    def status_sets_from_options(options):
+        """ The statuses matching each of the status options """
+        return {option_name: StatusCriteria.get_statuses(options.get(option_name, default))
+                for option_name, default in STATUS_OPTION_DEFAULTS.items()}
+
+    @staticmethod
+    def _with_str_keys(value):
+        """ Copy of the value with dict keys as their repr, so keys of any type sort """
+        if isinstance(value, dict):
+            return {repr(key): FlowPlan._with_str_keys(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [FlowPlan._with_str_keys(item) for item in value]
+        return value
+
+    @staticmethod
+    def config_digest(config):
+        """ Digest of the flow config, the same for every load of the same template version
+        Worked out once per config object
+        """
+        with FlowPlan._digests_lock:
+            entry = FlowPlan._digests.get(id(config))
+            if entry is not None and entry[0] is config:
+                FlowPlan._digests.move_to_end(id(config))
+                return entry[1]
+
+        text = json.dumps(FlowPlan._with_str_keys(config), sort_keys=True, default=str)
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with FlowPlan._digests_lock:
+            FlowPlan._digests[id(config)] = (config, digest)
+            FlowPlan._digests.move_to_end(id(config))
+            while len(FlowPlan._digests) > FlowPlan.MAX_DIGESTS:
+                FlowPlan._digests.popitem(last=False)
+
+        # Done
+        return digest
+
+    @staticmethod
+    def merge_options(flow_config, step_config):
+        """ Flow level step options overridden by the step's own """
+        merged = {}
+        for config in [flow_config, step_config]:
+            options = config.get('step_options') if isinstance(config, dict) else None
+            if isinstance(options, dict):
+                merged.update(options)
+        return merged
+
+    @staticmethod
+    def token_path(steps, step, dep_path, dep_step_name):
+        """ Where a dependency's value is found in state, the output key and any sub key """
+        sub_key = step.subkey_from_path(dep_path, dep_step_name)
+        dep_output_key = steps[dep_step_name].get_output_key()
+        return f"{dep_output_key}.{sub_key}" if sub_key else dep_output_key
+
+    @staticmethod
+    def build(steps, flow_config):
+        """ Build the plan from the loaded steps, in flow order
+        Raises StepConfigException if a step depends on itself or a later step
+        """
+
+        step_names = list(steps.keys())
+        index = {step_name: position for position, step_name in enumerate(step_names)}
+
+        dependencies = {}
+        token_maps = {}
+        step_options = {}
+        for step_name, step in steps.items():
+
+            # Dependencies must run first
+            dep_step_names = []
+            token_map = {}
+            for key, dep_path in step.get_depends_on().items():
+                dep_step_name = step.step_name_from_path(dep_path)
+                if index.get(dep_step_name, len(step_names)) >= index[step_name]:
+                    raise StepConfigException(
+                        f"Problem loading step '{step_name}'. Dependency step '{dep_step_name}' "
+                        f"referenced by dependency '{key}' must come before it in the flow")
+                if dep_step_name not in dep_step_names:
+                    dep_step_names.append(dep_step_name)
+
+                token_map[key] = FlowPlan.token_path(steps, step, dep_path, dep_step_name)
+
+            dependencies[step_name] = dep_step_names
+            token_maps[step_name] = token_map
+            step_options[step_name] = FlowPlan.merge_options(flow_config, step.get_step_config())
+
+        # Done
+        return FlowPlan(step_names, dependencies, token_maps, step_options)
+
+    @staticmethod
+    def get(digest):
+        """ Get the plan for the config digest or None """
+        with FlowPlan._plans_lock:
+            plan = FlowPlan._plans.get(digest)
+            if plan is not None:
+                FlowPlan._plans.move_to_end(digest)
+            return plan
+
+    @staticmethod
+    def put(digest, plan):
+        """ Save the plan for the config digest """
+        with FlowPlan._plans_lock:
+            FlowPlan._plans[digest] = plan
+            FlowPlan._plans.move_to_end(digest)
+            while len(FlowPlan._plans) > FlowPlan.MAX_PLANS:
+                FlowPlan._plans.popitem(last=False)
+
+    @staticmethod
+    def clear():
+        """ Drop all the saved plans and digests """
+        with FlowPlan._plans_lock:
+            FlowPlan._plans.clear()
+        with FlowPlan._digests_lock:
+            FlowPlan._digests.clear()
+
+class StepStatusEvaluator:
+    """ Status of every step in the flow for one rerun
+
+    Each step's status is worked out once per rerun by its own get_step_status, so steps
+    that override input_data_ready, prev_step_is_done or output_data_ready keep their
+    rules. What other statuses read of a step, its output being ready and its acks, is
+    noted at the same time. Checking a step again after it has run only re-reads that for
+    the step and the steps it relies on and only works statuses out again if it changed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._facts = {}
+        self._related = {}
+        self._statuses = {}
+
+    @staticmethod
+    def read_facts(step, flow_state):
+        """ What statuses read of the step, (output ready, start acked, changes acked) """
+        return (step.output_data_ready(flow_state), step.check_ack('start'),
+                step.check_ack('changes'))
+
+    def _get_related(self, step):
+        """ The previous step and dependency steps, looked up once """
+        step_name = step.get_name()
+        related = self._related.get(step_name)
+        if related is None:
+            related = (step.get_prev_step(), step.get_dependency_steps())
+            self._related[step_name] = related
+        return related
+
+    def evaluate(self, flow_state):
+        """ Work out the status of every step """
+        self._facts = {}
+        self._statuses = {}
+        for step_name in self.app.get_step_names():
+            step = self.app.get_step(step_name)
+            self._facts[step_name] = StepStatusEvaluator.read_facts(step, flow_state)
+            self._statuses[step_name] = step.get_step_status(flow_state)
+
+    def get_status(self, step, flow_state):
+        """ Get the status of the step from the last evaluation """
+        step_name = step.get_name()
+        status = self._statuses.get(step_name)
+        if status is None:
+            status = step.get_step_status(flow_state)
+            self._statuses[step_name] = status
+        return status
+
+    def refresh_status(self, step, flow_state):
+        """ Get the status of the step after it has run, re-reading the state it depends on """
+        prev_step, dep_steps = self._get_related(step)
+        related_steps = [step] + dep_steps + ([prev_step] if prev_step is not None else [])
+
+        # Re-read, any change means other statuses may have changed too
+        changed = False
+        for related_step in related_steps:
+            facts = StepStatusEvaluator.read_facts(related_step, flow_state)
+            if facts != self._facts.get(related_step.get_name()):
+                self._facts[related_step.get_name()] = facts
+                changed = True
+        if changed:
+            self._statuses = {}
+
+        # Done
+        return self.get_status(step, flow_state)
@@ -1,27 +1,263 @@
 """ Lang chain and LLM wrappers """
-import boto3
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError, BotoCoreError
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnableWithMessageHistory
 from langchain_core.messages import SystemMessage
 from langchain_aws import ChatBedrock
 from langchain_community.chat_message_histories import ChatMessageHistory
 from utils.aws_utils import AWSUtils
+from utils.flow_utils import FlowUtils
+from utils.bedrock_caching import BedrockPromptCachingClient
+from utils.llm_scheduling import LLMCallPriority, LLMCallScheduler, LatencyTracker, HedgePolicy
 
 class InternalStubModel:
     """Class for internal stubbed models."""
-    def __init__(self, behaviour):
+    def __init__(self, behaviour, model_id="internal.mock", delay=0.0):
         self.behaviour = behaviour
+        self.model_id = model_id
+        self.delay = delay
 
     def invoke(self, input_data):
         """Simulate model behavior based on the stub configuration."""
+        if self.delay:
+            time.sleep(self.delay)
         if self.behaviour == "echo":
             return type("MockResponse", (object,), {"content": input_data["input"]})
         return type("MockResponse", (object,), {"content": "Stubbed response"})
 
+    def stream(self, input_data):
+        """ Yield the response a word at a time, any delay comes before the first word """
+        words = self.invoke(input_data).content.split(' ')
+        for index, word in enumerate(words):
+            yield word if index == 0 else ' ' + word
+
+
+class SimulatedStubModel(InternalStubModel): # pylint: disable=too-many-instance-attributes
+    """ Stub model that simulates the latency, throughput and failures of a real model
+    for offline load testing and scheduler tuning
+    """
+
+    FILLER_WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do".split()
+
+    def __init__( # pylint: disable=too-many-arguments
+            self,
+            model_id="internal.simulated",
+            *,
+            time_to_first_token=0.5,
+            time_to_first_token_jitter=0.2,
+            tokens_per_second=50.0,
+            output_tokens=200,
+            stall_probability=0.0,
+            stall_seconds=10.0,
+            throttle_probability=0.0,
+            seed=None):
+        super().__init__("simulate", model_id=model_id)
+        self.time_to_first_token = time_to_first_token
+        self.time_to_first_token_jitter = time_to_first_token_jitter
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.stall_probability = stall_probability
+        self.stall_seconds = stall_seconds
+        self.throttle_probability = throttle_probability
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        """ Draw the random values for one call """
+        with self._lock:
+            throttled = self.random.random() < self.throttle_probability
+            stalled = self.random.random() < self.stall_probability
+            jitter = self.random.uniform(-1.0, 1.0) * self.time_to_first_token_jitter
+        return throttled, stalled, jitter
+
+    def get_generation_time(self, jitter=0.0, stalled=False):
+        """ Seconds the simulated call takes """
+        seconds = max(0.0, self.time_to_first_token * (1.0 + jitter))
+        if self.tokens_per_second > 0:
+            seconds += self.output_tokens / self.tokens_per_second
+        if stalled:
+            seconds += self.stall_seconds
+        return seconds
+
+    def generate_text(self, prompt):
+        """ Make an output of output_tokens words that starts with the prompt """
+        words = prompt.split()[:self.output_tokens]
+        filler = self.FILLER_WORDS
+        while len(words) < self.output_tokens:
+            words.append(filler[len(words) % len(filler)])
+        return ' '.join(words)
+
+    @staticmethod
+    def throttling_error(operation_name):
+        """ The error Bedrock raises when it throttles a call """
+        error_response = {"Error": {
+            "Code": "ThrottlingException",
+            "Message": "Simulated throttling, too many requests"}}
+        return ClientError(error_response, operation_name)
+
+    def invoke(self, input_data):
+        """ Sleep for the simulated time then answer, or raise a throttling error """
+        throttled, stalled, jitter = self._draw()
+        if throttled:
+            raise SimulatedStubModel.throttling_error("InvokeModel")
+
+        time.sleep(self.get_generation_time(jitter, stalled))
+        content = self.generate_text(input_data["input"])
+        return type("MockResponse", (object,), {"content": content})
+
+    def stream(self, input_data):
+        """ Yield the output a word at a time at the simulated rate, any stall comes
+        before the first word
+        """
+        throttled, stalled, jitter = self._draw()
+        if throttled:
+            raise SimulatedStubModel.throttling_error("InvokeModelWithResponseStream")
+
+        first_token_seconds = max(0.0, self.time_to_first_token * (1.0 + jitter))
+        if stalled:
+            first_token_seconds += self.stall_seconds
+        time.sleep(first_token_seconds)
+        words = self.generate_text(input_data["input"]).split(' ')
+        for index, word in enumerate(words):
+            if index and self.tokens_per_second > 0:
+                time.sleep(1.0 / self.tokens_per_second)
+            yield word if index == 0 else ' ' + word
+
+
+class StreamedCall: # pylint: disable=too-many-instance-attributes
+    """ One streamed model call made on a worker thread so it can be hedged
+
+    first_token resolves when the first chunk arrives, or with the error if the call fails
+    before then. result resolves with the content and usage. cancel gives the scheduler
+    slot back at once and the stream is closed when its next chunk arrives.
+    """
+
+    def __init__(self, model_id, stream_fn, estimated_tokens=0,
+                 priority=LLMCallPriority.INTERACTIVE):
+        self.model_id = model_id
+        self.stream_fn = stream_fn
+        self.estimated_tokens = estimated_tokens
+        self.priority = priority
+        self.first_token = Future()
+        self.result = Future()
+        self._cancelled = threading.Event()
+        self._slot_lock = threading.Lock()
+        self._holds_slot = False
+
+    def _release_slot(self):
+        """ Give the scheduler slot back if we still hold it """
+        with self._slot_lock:
+            holds_slot, self._holds_slot = self._holds_slot, False
+        if holds_slot:
+            LangChainUtils.get_scheduler().release(self.model_id)
+
+    def cancel(self):
+        """ Stop the call and free its slot for other callers """
+        self._cancelled.set()
+        self._release_slot()
+
+    def run(self, tracker):
+        """ Wait for a slot then read the stream, recording the first token latency """
+        usage = {}
+        try:
+            LangChainUtils.get_scheduler().acquire(
+                self.model_id, self.estimated_tokens, self.priority)
+            with self._slot_lock:
+                self._holds_slot = True
+            if self._cancelled.is_set():
+                raise CancelledError()
+
+            # Read the stream until it ends or we are cancelled
+            start = time.monotonic()
+            parts = []
+            stream = self.stream_fn(usage)
+            try:
+                for chunk in stream:
+                    if not self.first_token.done():
+                        tracker.record(self.model_id, time.monotonic() - start)
+                        self.first_token.set_result(True)
+                    if self._cancelled.is_set():
+                        raise CancelledError()
+                    parts.append(chunk)
+            finally:
+                stream.close()
+
+            # An empty answer is still an answer
+            if not self.first_token.done():
+                self.first_token.set_result(True)
+            self.result.set_result((''.join(parts), usage))
+
+        except Exception as exc: # pylint: disable=broad-exception-caught
+            # Hand the error to the caller, as an executor would
+            if not self.first_token.done():
+                self.first_token.set_exception(exc)
+            self.result.set_exception(exc)
+        finally:
+            self._release_slot()
+
 
 class LangChainUtils:
     ''' handles details about LLM models '''
 
+    # Process wide call scheduler, created on first use
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+
+    # Process wide latency tracking for hedging
+    latency_tracker = LatencyTracker()
+
+    # Worker threads and policies for hedged calls, shared by every session
+    HEDGE_WORKERS = 32
+    _hedge_executor = None
+    _hedge_policies = {}
+    _hedge_lock = threading.Lock()
+
+    # Extra simulated stub model choices registered at run time
+    _simulated_choices = {}
+
+    # Context window for model choices that don't give one
+    DEFAULT_CONTEXT_TOKENS = 200000
+
+    # Errors a model call can raise, ChatBedrock wraps client errors in ValueError
+    CALL_ERRORS = (ClientError, BotoCoreError, ValueError)
+
+    # Response metadata key for the usage the prompt caching client recorded for the call
+    BEDROCK_USAGE_KEY = "bedrock_usage"
+
+    @staticmethod
+    def register_simulated_model_choice(name, description='', context_tokens=None,
+                                        **simulation_kwargs):
+        """ Add a simulated stub model choice, keyword arguments are SimulatedStubModel settings """
+        LangChainUtils._simulated_choices[name] = {
+            "description" : description or f"Simulated stub model '{name}'",
+            "model_id" : f"internal.simulated.{name}",
+            "model_kwargs" : {"behaviour": 'simulate', **simulation_kwargs},
+            "context_tokens" : context_tokens or LangChainUtils.DEFAULT_CONTEXT_TOKENS,
+            "provider" : "internal"
+        }
+
+    @staticmethod
+    def get_scheduler():
+        """ Get the process wide LLM call scheduler """
+        with LangChainUtils._scheduler_lock:
+            if LangChainUtils._scheduler is None:
+                LangChainUtils._scheduler = LLMCallScheduler()
+            return LangChainUtils._scheduler
+
+    @staticmethod
+    def get_scheduler_metrics():
+        """ Get the queue depth and wait time metrics of the scheduler """
+        return LangChainUtils.get_scheduler().get_metrics()
+
+    @staticmethod
+    def get_model_id(chat_model):
+        """ Get the key the scheduler uses for the model """
+        return getattr(chat_model, "model_id", None) or type(chat_model).__name__
+
     @staticmethod
     def get_chat_model_choices():
         """ Get the stock model choices """
@@ -37,30 +273,35 @@ class LangChainUtils:
                     "description" : "Claude 3 Sonnet with standard settings",
                     "model_id" : "anthropic.claude-3-sonnet-20240229-v1:0",
                     "model_kwargs" : {"max_tokens": 10000, "temperature": 0.7},
+                    "context_tokens" : 200000,
                     "provider" : "AWS_bedrock"
                 },
                 "Claude 3 Haiku - Standard" : {
                     "description" : "Claude 3 Haiku with standard settings",
                     "model_id" : "anthropic.claude-3-haiku-20240307-v1:0",
                     "model_kwargs" : {"max_tokens": 10000, "temperature": 0.7},
+                    "context_tokens" : 200000,
                     "provider" : "AWS_bedrock"
                 },
                 "Claude 3 Sonnet - Creative" : {
                     "description" : "Claude 3 Sonnet with high temperature, prone to hallucinations",
                     "model_id" : "anthropic.claude-3-sonnet-20240229-v1:0",
                     "model_kwargs" : {"max_tokens": 10000, "temperature": 1.0},
+                    "context_tokens" : 200000,
                     "provider" : "AWS_bedrock"
                 },
                 "Claude 3 Sonnet - Accurate" : {
                     "description" : "Claude 3 Sonnet with low temperature, not creative",
                     "model_id" : "anthropic.claude-3-sonnet-20240229-v1:0",
                     "model_kwargs" : {"max_tokens": 10000, "temperature": 0.1},
+                    "context_tokens" : 200000,
                     "provider" : "AWS_bedrock"
                 },
                 "Claude 3 Sonnet - Ten Tokens Max" : {
                     "description" : "Claude 3 Sonnet with very short context window",
                     "model_id" : "anthropic.claude-3-sonnet-20240229-v1:0",
                     "model_kwargs" : {"max_tokens": 10, "temperature": 0.7},
+                    "context_tokens" : 200000,
                     "provider" : "AWS_bedrock"
                 },
             }
@@ -75,19 +316,74 @@ class LangChainUtils:
                     "model_id" : "internal.mock",
                     "model_kwargs" : {"behaviour": 'echo'},
                     "provider" : "internal"
+                },
+            "Mock Model - Simulated Latency" : {
+                    "description" :
+                        "Simulates typical model latency and throughput for load testing",
+                    "model_id" : "internal.simulated",
+                    "model_kwargs" : {
+                        "behaviour": 'simulate',
+                        "time_to_first_token": 0.8,
+                        "tokens_per_second": 60,
+                        "output_tokens": 300
+                    },
+                    "provider" : "internal"
+                },
+            "Mock Model - Simulated Slow and Flaky" : {
+                    "description" : "Simulates stalls and throttling errors for load testing",
+                    "model_id" : "internal.simulated.flaky",
+                    "model_kwargs" : {
+                        "behaviour": 'simulate',
+                        "time_to_first_token": 2.0,
+                        "tokens_per_second": 20,
+                        "output_tokens": 300,
+                        "stall_probability": 0.05,
+                        "stall_seconds": 30.0,
+                        "throttle_probability": 0.1
+                    },
+                    "provider" : "internal"
+                },
+            "Mock Model - Simulated Long Output" : {
+                    "description" : "Simulates long outputs at a steady rate for load testing",
+                    "model_id" : "internal.simulated.long",
+                    "model_kwargs" : {
+                        "behaviour": 'simulate',
+                        "time_to_first_token": 0.8,
+                        "tokens_per_second": 80,
+                        "output_tokens": 4000
+                    },
+                    "provider" : "internal"
                 }
             }
 
 
         # Add them
         choices.update(internal_models)
+        choices.update(LangChainUtils._simulated_choices)
 
         # Done
         return choices
 
     @staticmethod
-    def get_chat_model(model_choice, region_name=None):
-        """ get the model to use for chat based on the choice """
+    def get_max_input_tokens(model_choice):
+        """ Get the tokens the model choice can take as input, its context less its output """
+
+        chat_model_choices = LangChainUtils.get_chat_model_choices()
+        if model_choice not in chat_model_choices:
+            raise ValueError(f"Invalid model choice '{model_choice}")
+        model_choice = chat_model_choices[model_choice]
+
+        # Output comes out of the same context window
+        context_tokens = model_choice.get('context_tokens', LangChainUtils.DEFAULT_CONTEXT_TOKENS)
+        model_kwargs = model_choice['model_kwargs']
+        output_tokens = model_kwargs.get('max_tokens', model_kwargs.get('output_tokens', 0))
+        return max(0, context_tokens - output_tokens)
+
+    @staticmethod
+    def get_chat_model(model_choice, region_name=None, prompt_caching=False):
+        """ get the model to use for chat based on the choice
+        prompt_caching marks the system prompt and first user message as cacheable
+        """
 
         # Get the values for the model choice
         chat_model_choices = LangChainUtils.get_chat_model_choices()
@@ -96,15 +392,28 @@ class LangChainUtils:
 
         model_choice = chat_model_choices[model_choice]
 
+        # Apply any scheduler limits for the model
+        LangChainUtils.get_scheduler().configure_model(
+            model_choice['model_id'],
+            max_concurrency=model_choice.get('max_concurrency'),
+            tokens_per_minute=model_choice.get('tokens_per_minute'))
+
         # Handle internal stubbed models
         if model_choice["provider"] == "internal":
-            return InternalStubModel(model_choice["model_kwargs"]["behaviour"])
+            model_kwargs = dict(model_choice["model_kwargs"])
+            if model_kwargs.pop("behaviour") == "simulate":
+                return SimulatedStubModel(model_id=model_choice["model_id"], **model_kwargs)
+            return InternalStubModel(
+                model_choice["model_kwargs"]["behaviour"],
+                model_id=model_choice["model_id"],
+                delay=model_choice["model_kwargs"].get("delay", 0.0))
 
         # Set up the Bedrock client
-        bedrock_runtime = boto3.client(
-            service_name='bedrock-runtime',
-            region_name=region_name
-        )
+        bedrock_runtime = AWSUtils.get_client('bedrock-runtime', region_name=region_name)
+
+        # Wrap to add prompt cache points if asked
+        if prompt_caching:
+            bedrock_runtime = BedrockPromptCachingClient(bedrock_runtime)
 
         # Initialize the ChatBedrock model
         chat = ChatBedrock(
@@ -116,6 +425,88 @@ class LangChainUtils:
         # Done
         return chat
 
+    @staticmethod
+    def get_hedge_executor():
+        """ Get the worker threads hedged calls stream on """
+        with LangChainUtils._hedge_lock:
+            if LangChainUtils._hedge_executor is None:
+                LangChainUtils._hedge_executor = ThreadPoolExecutor(
+                    max_workers=LangChainUtils.HEDGE_WORKERS, thread_name_prefix="hedge")
+            return LangChainUtils._hedge_executor
+
+    @staticmethod
+    def get_hedge_policy(model_choice, hedge_model_choice=None, hedge_region=None,
+                         prompt_caching=False, **kwargs):
+        """ Get the hedge policy that sends the hedge to another model choice and/or region
+        Other keyword arguments are passed to HedgePolicy. Policies are built once and shared
+        """
+        key = (model_choice, hedge_model_choice, hedge_region, prompt_caching,
+               tuple(sorted(kwargs.items())))
+        with LangChainUtils._hedge_lock:
+            policy = LangChainUtils._hedge_policies.get(key)
+        if policy is not None:
+            return policy
+
+        hedge_model = LangChainUtils.get_chat_model(
+            hedge_model_choice or model_choice,
+            region_name=hedge_region,
+            prompt_caching=prompt_caching)
+        with LangChainUtils._hedge_lock:
+            return LangChainUtils._hedge_policies.setdefault(
+                key, HedgePolicy(hedge_model, **kwargs))
+
+    @staticmethod
+    def hedged_call( # pylint: disable=too-many-arguments
+            stream_fn,
+            primary_model,
+            hedge,
+            estimated_tokens=0,
+            priority=LLMCallPriority.INTERACTIVE):
+        """ Stream from the primary model, and from the hedge model too if the primary's first
+        token is slow or it fails. stream_fn(model, usage) yields the text. The first to stream
+        a token wins and the other is cancelled. Returns the content and usage of the winner
+        """
+
+        tracker = LangChainUtils.latency_tracker
+        executor = LangChainUtils.get_hedge_executor()
+
+        def start(model):
+            """ Start streaming from the model on a worker thread """
+            call = StreamedCall(
+                LangChainUtils.get_model_id(model),
+                lambda usage: stream_fn(model, usage),
+                estimated_tokens,
+                priority)
+            executor.submit(call.run, tracker)
+            return call
+
+        # First token in time
+        primary = start(primary_model)
+        done, _ = wait([primary.first_token], timeout=hedge.get_delay(tracker, primary.model_id))
+        if primary.first_token in done and primary.first_token.exception() is None:
+            hedge.record(hedge_sent=False, hedge_won=False)
+            return primary.result.result()
+
+        # Slow or failed - send the hedge and take the first to stream a token
+        hedge_call = start(hedge.hedge_model)
+        calls = [primary, hedge_call]
+        errors = []
+        while calls:
+            done, _ = wait([call.first_token for call in calls], return_when=FIRST_COMPLETED)
+            for call in [call for call in calls if call.first_token in done]:
+                calls.remove(call)
+                if call.first_token.exception() is not None:
+                    errors.append(call.first_token.exception())
+                    continue
+                for other in calls:
+                    other.cancel()
+                hedge.record(hedge_sent=True, hedge_won=call is hedge_call)
+                return call.result.result()
+
+        # Both failed
+        hedge.record(hedge_sent=True, hedge_won=False)
+        raise errors[0]
+
     @staticmethod
     def print_available_aws_bedrock_models():
         ''' print a list of available models '''
@@ -123,7 +514,7 @@ class LangChainUtils:
         if not aws_configured:
             print(_reason)
 
-        bedrock_client = boto3.client('bedrock')
+        bedrock_client = AWSUtils.get_client('bedrock')
 
         response = bedrock_client.list_foundation_models()
 
@@ -136,32 +527,104 @@ class LangChainUtils:
 
 
     @staticmethod
-    def simple_prompt_response(chat_model, initial_system_prompt, human_prompt):
+    def estimate_prompt_tokens(*texts):
+        """ Estimate the tokens the texts will use in a prompt """
+        return sum(FlowUtils.estimate_tokens(text) for text in texts if text)
+
+    @staticmethod
+    def simple_prompt_response(chat_model, initial_system_prompt, human_prompt,
+                               priority=LLMCallPriority.INTERACTIVE):
         """ Simply prompt the model and get a response """
 
-        # Check if the chat_model is a stub
-        if hasattr(chat_model, "invoke") and isinstance(chat_model, InternalStubModel):
-            # Directly invoke the stub model
-            response = chat_model.invoke({"input": human_prompt})
+        # Wait for our turn
+        estimated_tokens = LangChainUtils.estimate_prompt_tokens(
+            initial_system_prompt, human_prompt)
+        scheduler = LangChainUtils.get_scheduler()
+        with scheduler.slot(LangChainUtils.get_model_id(chat_model), estimated_tokens, priority):
+
+            # Check if the chat_model is a stub
+            if hasattr(chat_model, "invoke") and isinstance(chat_model, InternalStubModel):
+                # Directly invoke the stub model
+                response = chat_model.invoke({"input": human_prompt})
+                return response.content
+
+            prompt = ChatPromptTemplate.from_messages([
+                SystemMessage(content=initial_system_prompt),
+                ("human", human_prompt)
+            ])
+            chain = prompt | chat_model
+            response = chain.invoke({"input": ""})
             return response.content
 
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessage(content=initial_system_prompt),
-            ("human", human_prompt)
-        ])
-        chain = prompt | chat_model
-        response = chain.invoke({"input": ""})
-        return response.content
+    @staticmethod
+    def get_usage(response):
+        """ Get the token usage for the response including any prompt cache counts """
+
+        usage = {}
+        usage_metadata = getattr(response, "usage_metadata", None)
+        if usage_metadata:
+            usage["input_tokens"] = usage_metadata.get("input_tokens", 0)
+            usage["output_tokens"] = usage_metadata.get("output_tokens", 0)
+
+        # Prompt cache counts recorded by the caching client for this call
+        usage.update(getattr(response, "response_metadata", {}).get(
+            LangChainUtils.BEDROCK_USAGE_KEY, {}))
+
+        # Done
+        return usage
 
     @staticmethod
-    def chat_prompt_response(chat_model, initial_system_prompt, human_prompt, prior_chat_history=None):
-        """ Prompt the model with the initial prompts and chat history as context """
+    def chat_prompt_response( # pylint: disable=too-many-arguments
+            chat_model,
+            initial_system_prompt,
+            human_prompt,
+            prior_chat_history=None,
+            usage=None,
+            *,
+            priority=LLMCallPriority.INTERACTIVE,
+            hedge=None):
+        """ Prompt the model with the initial prompts and chat history as context
+        If a usage dict is passed it is filled with the token counts for the call
+        If a HedgePolicy is passed a slow call is hedged with a second request
+        """
+
+        history_text = [message['content'] for message in prior_chat_history or []]
+        estimated_tokens = LangChainUtils.estimate_prompt_tokens(
+            initial_system_prompt, human_prompt, *history_text)
+
+        # Make the call, hedged if asked
+        call_usage = {}
+        if hedge is None:
+            model_id = LangChainUtils.get_model_id(chat_model)
+            with LangChainUtils.get_scheduler().slot(model_id, estimated_tokens, priority):
+                content = LangChainUtils._chat_prompt_response(
+                    chat_model,
+                    initial_system_prompt,
+                    human_prompt,
+                    prior_chat_history,
+                    call_usage)
+        else:
+            def stream_fn(model, stream_usage):
+                """ Stream the response from the model """
+                return LangChainUtils._stream_chat_response(
+                    model,
+                    initial_system_prompt,
+                    human_prompt,
+                    prior_chat_history,
+                    stream_usage)
+            content, call_usage = LangChainUtils.hedged_call(
+                stream_fn, chat_model, hedge, estimated_tokens, priority)
+
+        # Report usage if asked
+        if usage is not None:
+            usage.update(call_usage)
 
-        # Check if the chat_model is a stub
-        if hasattr(chat_model, "invoke") and isinstance(chat_model, InternalStubModel):
-            # Directly invoke the stub model
-            response = chat_model.invoke({"input": human_prompt})
-            return response.content
+        # Done
+        return content
+
+    @staticmethod
+    def _get_chat_chain(chat_model, initial_system_prompt, prior_chat_history):
+        """ Make the chain that prompts the model with the chat history """
 
         prompt = ChatPromptTemplate.from_messages([
             ("system", initial_system_prompt),
@@ -182,18 +645,74 @@ class LangChainUtils:
         chain = prompt | chat_model
 
         # Wrap the chain with message history
-        chain_with_history = RunnableWithMessageHistory(
+        return RunnableWithMessageHistory(
             chain,
             lambda session_id: chat_history,
             input_messages_key="input",
             history_messages_key="history"
         )
 
+    @staticmethod
+    def _chunk_text(chunk):
+        """ Get the text of a streamed message chunk """
+        if isinstance(chunk.content, str):
+            return chunk.content
+        return ''.join(part.get("text", "") for part in chunk.content if isinstance(part, dict))
+
+    @staticmethod
+    def _stream_chat_response(chat_model, initial_system_prompt, human_prompt,
+                              prior_chat_history, usage):
+        """ Make the chat call once scheduled, yielding the text as it arrives """
+
+        # Stub models stream themselves
+        if isinstance(chat_model, InternalStubModel):
+            yield from chat_model.stream({"input": human_prompt})
+            return
+
+        chain_with_history = LangChainUtils._get_chat_chain(
+            chat_model, initial_system_prompt, prior_chat_history)
+
+        # Stream and build up the whole message for the usage
+        response = None
+        with BedrockPromptCachingClient.record_usage() as bedrock_usage:
+            for chunk in chain_with_history.stream(
+                    {"input": human_prompt},
+                    config={"configurable": {"session_id": "default"}}):
+                response = chunk if response is None else response + chunk
+                text = LangChainUtils._chunk_text(chunk)
+                if text:
+                    yield text
+
+        # Report usage if asked
+        if usage is not None and response is not None:
+            response.response_metadata[LangChainUtils.BEDROCK_USAGE_KEY] = bedrock_usage
+            usage.update(LangChainUtils.get_usage(response))
+
+    @staticmethod
+    def _chat_prompt_response(chat_model, initial_system_prompt, human_prompt,
+                              prior_chat_history, usage):
+        """ Make the chat call once scheduled """
+
+        # Check if the chat_model is a stub
+        if hasattr(chat_model, "invoke") and isinstance(chat_model, InternalStubModel):
+            # Directly invoke the stub model
+            response = chat_model.invoke({"input": human_prompt})
+            return response.content
+
+        chain_with_history = LangChainUtils._get_chat_chain(
+            chat_model, initial_system_prompt, prior_chat_history)
+
         # Run the chain
-        response = chain_with_history.invoke(
-            {"input": human_prompt},
-            config={"configurable": {"session_id": "default"}}
-        )
+        with BedrockPromptCachingClient.record_usage() as bedrock_usage:
+            response = chain_with_history.invoke(
+                {"input": human_prompt},
+                config={"configurable": {"session_id": "default"}}
+            )
+        response.response_metadata[LangChainUtils.BEDROCK_USAGE_KEY] = bedrock_usage
+
+        # Report usage if asked
+        if usage is not None:
+            usage.update(LangChainUtils.get_usage(response))
 
         # Done
         return response.content
\ No newline at end of file
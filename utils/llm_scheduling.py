@@ -0,0 +1,253 @@
+""" Scheduling, rate limiting and hedging of LLM calls """
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from enum import IntEnum
+from contextlib import contextmanager
+
+
+class LLMCallPriority(IntEnum):
+    """ Priority classes for LLM calls, lower values are served first """
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    BATCH = 2
+
+
+class TokenBucket:
+    """ Token bucket rate limiter, callers must hold a lock """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        """ Add the tokens accrued since the last refill """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, tokens):
+        """ Seconds until the tokens are available, 0 if available now
+        Requests bigger than the bucket only wait for a full bucket
+        """
+        self._refill()
+        needed = min(tokens, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, tokens):
+        """ Take the tokens from the bucket """
+        self._refill()
+        self.tokens -= min(tokens, self.capacity)
+
+
+class LLMCallScheduler:
+    """ Process wide scheduler for LLM calls
+
+    Each model id has a concurrency cap, an optional token bucket based on estimated
+    tokens per minute and a priority queue so interactive calls go ahead of
+    background and batch work. Queue depth and wait times are kept as metrics.
+    """
+
+    def __init__(self, default_max_concurrency=8, default_tokens_per_minute=None):
+        self.default_max_concurrency = default_max_concurrency
+        self.default_tokens_per_minute = default_tokens_per_minute
+        self._lock = threading.Lock()
+        self._models = {}
+        self._sequence = itertools.count()
+
+    def _new_model_state(self, max_concurrency, tokens_per_minute):
+        """ Create the per model state """
+        return {
+            "condition": threading.Condition(),
+            "queue": [],
+            "active": 0,
+            "max_concurrency": max_concurrency,
+            "bucket": TokenBucket(tokens_per_minute) if tokens_per_minute else None,
+            "calls": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "calls_by_priority": {priority.name: 0 for priority in LLMCallPriority},
+        }
+
+    def _get_model_state(self, model_id):
+        """ Get or create the state for the model """
+        with self._lock:
+            if model_id not in self._models:
+                self._models[model_id] = self._new_model_state(
+                    self.default_max_concurrency,
+                    self.default_tokens_per_minute)
+            return self._models[model_id]
+
+    def configure_model(self, model_id, max_concurrency=None, tokens_per_minute=None):
+        """ Set the limits for a model, None leaves the current setting """
+        state = self._get_model_state(model_id)
+        with state["condition"]:
+            if max_concurrency is not None:
+                if max_concurrency < 1:
+                    raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+                state["max_concurrency"] = max_concurrency
+            if tokens_per_minute is not None:
+                current = state["bucket"]
+                if current is None or current.capacity != tokens_per_minute:
+                    state["bucket"] = (TokenBucket(tokens_per_minute)
+                                       if tokens_per_minute > 0 else None)
+            state["condition"].notify_all()
+
+    def acquire(self, model_id, estimated_tokens=0, priority=LLMCallPriority.INTERACTIVE):
+        """ Block until the call can go ahead, returns the seconds waited """
+
+        state = self._get_model_state(model_id)
+        condition = state["condition"]
+        ticket = (int(priority), next(self._sequence))
+        start = time.monotonic()
+
+        with condition:
+            heapq.heappush(state["queue"], ticket)
+            try:
+                while True:
+                    # Only the head of the queue can go, and only if there is a free slot
+                    if state["queue"][0] != ticket or state["active"] >= state["max_concurrency"]:
+                        condition.wait()
+                        continue
+
+                    # Wait for the rate limit
+                    bucket = state["bucket"]
+                    delay = bucket.wait_time(estimated_tokens) if bucket else 0.0
+                    if delay > 0:
+                        condition.wait(delay)
+                        continue
+                    break
+            except BaseException:
+                # Leave the queue if interrupted
+                state["queue"].remove(ticket)
+                heapq.heapify(state["queue"])
+                condition.notify_all()
+                raise
+
+            # Take the slot
+            heapq.heappop(state["queue"])
+            state["active"] += 1
+            if state["bucket"]:
+                state["bucket"].consume(estimated_tokens)
+
+            # Metrics
+            waited = time.monotonic() - start
+            state["calls"] += 1
+            state["total_wait_seconds"] += waited
+            state["max_wait_seconds"] = max(state["max_wait_seconds"], waited)
+            state["calls_by_priority"][LLMCallPriority(priority).name] += 1
+
+            # Let the next in the queue check
+            condition.notify_all()
+
+        # Done
+        return waited
+
+    def release(self, model_id):
+        """ Release a slot taken by acquire """
+        state = self._get_model_state(model_id)
+        with state["condition"]:
+            state["active"] -= 1
+            state["condition"].notify_all()
+
+    @contextmanager
+    def slot(self, model_id, estimated_tokens=0, priority=LLMCallPriority.INTERACTIVE):
+        """ Context manager to hold a slot for the duration of a call """
+        waited = self.acquire(model_id, estimated_tokens, priority)
+        try:
+            yield waited
+        finally:
+            self.release(model_id)
+
+    def get_metrics(self):
+        """ Get the queue depth, active calls and wait times per model """
+        with self._lock:
+            model_ids = list(self._models.keys())
+
+        metrics = {}
+        for model_id in model_ids:
+            state = self._models[model_id]
+            with state["condition"]:
+                calls = state["calls"]
+                metrics[model_id] = {
+                    "queue_depth": len(state["queue"]),
+                    "active": state["active"],
+                    "max_concurrency": state["max_concurrency"],
+                    "calls": calls,
+                    "total_wait_seconds": state["total_wait_seconds"],
+                    "mean_wait_seconds": state["total_wait_seconds"] / calls if calls else 0.0,
+                    "max_wait_seconds": state["max_wait_seconds"],
+                    "calls_by_priority": dict(state["calls_by_priority"]),
+                }
+
+        # Done
+        return metrics
+
+
+class LatencyTracker:
+    """ Keeps a window of recent first token latencies per model id """
+
+    def __init__(self, window=200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}
+
+    def record(self, model_id, seconds):
+        """ Record a successful call latency """
+        with self._lock:
+            if model_id not in self._latencies:
+                self._latencies[model_id] = deque(maxlen=self.window)
+            self._latencies[model_id].append(seconds)
+
+    def percentile(self, model_id, percentile, min_samples=1):
+        """ Get the latency at the percentile, None if there are too few samples """
+        with self._lock:
+            samples = sorted(self._latencies.get(model_id, []))
+        if len(samples) < max(1, min_samples):
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+
+class HedgePolicy: # pylint: disable=too-many-instance-attributes
+    """ Opt in policy to send a second request if the first one is slow
+
+    The hedge is sent when the primary has not streamed its first token after the given
+    percentile of its recent first token latencies. Until there are enough samples
+    default_delay is used.
+    """
+
+    def __init__( # pylint: disable=too-many-arguments
+            self,
+            hedge_model,
+            percentile=95,
+            default_delay=10.0,
+            min_delay=0.5,
+            min_samples=20):
+        self.hedge_model = hedge_model
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self.hedges_sent = 0
+        self.hedges_won = 0
+
+    def get_delay(self, tracker, model_id):
+        """ Seconds to wait for the primary before sending the hedge """
+        delay = tracker.percentile(model_id, self.percentile, self.min_samples)
+        if delay is None:
+            delay = self.default_delay
+        return max(self.min_delay, delay)
+
+    def record(self, hedge_sent, hedge_won):
+        """ Count the hedges sent and won """
+        with self._lock:
+            self.hedges_sent += int(hedge_sent)
+            self.hedges_won += int(hedge_won)
@@ -0,0 +1,98 @@
+""" Storage held in memory """
+import time
+import threading
+from utils.storage_utils import StorageBackend
+
+
+class MemoryStorageBackend(StorageBackend):
+    """ Storage held in memory, for tests and benchmarks """
+
+    def __init__(self, name=''):
+        super().__init__()
+        self.name = name
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _get(self, path: str) -> dict:
+        """ Get the entry for a path """
+        key = StorageBackend.normalize_key(path)
+        with self._lock:
+            entry = self._files.get(key)
+        if entry is None:
+            raise FileNotFoundError(f"No file at {path}")
+        return entry
+
+    def read_binary(self, path: str) -> bytes:
+        """ Read a binary file """
+        return self._get(path)["data"]
+
+    def write_binary(self, path: str, data: bytes) -> None:
+        """ Write a binary file """
+        key = StorageBackend.normalize_key(path)
+        data = bytes(data)
+        entry = {"data": data, "mtime": time.time(), "etag": StorageBackend.make_etag(data)}
+        with self._lock:
+            self._files[key] = entry
+
+    def read_text(self, path: str, encoding: str = "utf-8") -> str:
+        """ Read a text file """
+        return self.read_binary(path).decode(encoding)
+
+    def write_text(self, path: str, data: str, encoding: str = "utf-8") -> None:
+        """ Write a text file """
+        self.write_binary(path, data.encode(encoding))
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        """ Rename a file """
+        old_key = StorageBackend.normalize_key(old_path)
+        new_key = StorageBackend.normalize_key(new_path)
+        with self._lock:
+            if old_key not in self._files:
+                raise FileNotFoundError(f"No file at {old_path}")
+            self._files[new_key] = self._files.pop(old_key)
+
+    def delete(self, path: str) -> None:
+        """ Delete a file """
+        key = StorageBackend.normalize_key(path)
+        with self._lock:
+            if self._files.pop(key, None) is None:
+                raise FileNotFoundError(f"No file at {path}")
+
+    def list_files(self, folder: str) -> list:
+        """ List all files in a folder and return their relative paths """
+        return [entry["path"] for entry in self.scan(folder) if entry["type"] == "file"]
+
+    def list_folders(self, folder: str) -> list:
+        """ List all folders in a folder and return their relative paths """
+        return [entry["path"] for entry in self.scan(folder) if entry["type"] == "folder"]
+
+    def file_exists(self, path: str) -> bool:
+        """ Check if a file exists """
+        key = StorageBackend.normalize_key(path)
+        with self._lock:
+            return key in self._files
+
+    def copy(self, source_path: str, destination_path: str) -> None:
+        """ Copy a file from source to destination """
+        entry = dict(self._get(source_path))
+        entry["mtime"] = time.time()
+        key = StorageBackend.normalize_key(destination_path)
+        with self._lock:
+            self._files[key] = entry
+
+    def get_version(self, path: str):
+        """ Get the etag for a file, None if missing """
+        key = StorageBackend.normalize_key(path)
+        with self._lock:
+            entry = self._files.get(key)
+        return entry["etag"] if entry is not None else None
+
+    def scan(self, folder: str, recursive: bool = False) -> list:
+        """ List the entries in the folder with metadata """
+        key = StorageBackend.normalize_key(folder)
+        prefix = f"{key}/" if key else ""
+        with self._lock:
+            files = [(path[len(prefix):], len(entry["data"]), entry["mtime"], entry["etag"])
+                     for path, entry in sorted(self._files.items())
+                     if path.startswith(prefix)]
+        return StorageBackend.make_scan_entries(files, recursive)
@@ -0,0 +1,195 @@
+""" Seekable ranged reads and multipart writes of S3 objects """
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import io
+from botocore.exceptions import ClientError
+
+
+class AbortOnErrorMixin: # pylint: disable=too-few-public-methods
+    """ Write stream mixin, leaving a with block on an exception calls abort not close """
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+
+class S3RangeReader(io.RawIOBase):
+    """ Seekable read stream over an S3 object using ranged GETs
+    Wrap in io.BufferedReader so each GET fetches a whole buffer
+    """
+
+    def __init__(self, s3_client, bucket_name, key):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return self._position
+
+    def readall(self):
+        """ Read the rest of the object in one GET """
+        return self._read_range(self.size - self._position)
+
+    def readinto(self, buffer):
+        data = self._read_range(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _read_range(self, size):
+        """ GET up to size bytes from the current position """
+        if self._position >= self.size or size <= 0:
+            return b""
+
+        # Pin the version we started with so a concurrent write fails rather than mixes
+        end = min(self._position + size, self.size) - 1
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                Range=f"bytes={self._position}-{end}",
+                IfMatch=self.etag)
+        except ClientError as exc:
+            err_msg = f"Could not read range {self._position}-{end} of {self.key}: {exc}"
+            raise IOError(err_msg) from exc
+
+        data = response['Body'].read()
+        self._position += len(data)
+        return data
+
+
+class S3MultipartWriter( # pylint: disable=too-many-instance-attributes
+        AbortOnErrorMixin, io.RawIOBase):
+    """ Write stream to an S3 object
+    Small objects are written with one put, above the threshold the data is sent as a
+    multipart upload with up to max_workers parts in flight. Leaving a with block on an
+    exception aborts the upload.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, *, # pylint: disable=too-many-arguments
+                 part_size, threshold, max_workers, on_commit=None):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.threshold = max(threshold, part_size)
+        self.max_workers = max_workers
+        self.on_commit = on_commit
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._executor = None
+        self._futures = []
+        self._part_number = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buffer.extend(data)
+
+        # Start the multipart upload once we know the object is big
+        if self._upload_id is None and len(self._buffer) >= self.threshold:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+            self._upload_id = response['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        if self._upload_id is not None:
+            while len(self._buffer) >= self.part_size:
+                self._submit_part(bytes(self._buffer[:self.part_size]))
+                del self._buffer[:self.part_size]
+
+        return len(data)
+
+    def _submit_part(self, data):
+        """ Queue a part, waiting if the pool is full to bound memory """
+        pending = [future for future in self._futures if not future.done()]
+        if len(pending) >= self.max_workers:
+            wait(pending, return_when=FIRST_COMPLETED)
+        self._part_number += 1
+        self._futures.append(self._executor.submit(self._upload_part, self._part_number, data))
+
+    def _upload_part(self, part_number, data):
+        """ Upload one part and return its completion entry """
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                response = self.s3_client.put_object(
+                    Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                response = self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts})
+            if self.on_commit is not None:
+                self.on_commit(response)
+        except ClientError as exc:
+            self.abort()
+            err_msg = f"Could not write binary data to {self.key}: {exc}"
+            raise IOError(err_msg) from exc
+        finally:
+            self._release()
+            super().close()
+
+    def abort(self):
+        """ Close without writing, any multipart upload is aborted """
+        if self._upload_id is not None:
+            for future in self._futures:
+                future.cancel()
+            self._release()
+            try:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id)
+            except ClientError:
+                pass
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def _release(self):
+        """ Shut down the part uploads """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
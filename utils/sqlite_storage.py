@@ -0,0 +1,253 @@
+""" Storage in a single SQLite database file """
+import os
+import time
+import sqlite3
+import threading
+from utils.storage_utils import StorageBackend
+
+
+class SqliteStorageBackend(StorageBackend):
+    """ Storage in a single SQLite database file
+
+    Files are rows keyed by path with the parent folder indexed so listing a folder is an
+    index lookup. The listing indexes also carry size, mtime and etag so list_files, scan
+    and get_version are answered from the index without reading the rows, whose data comes
+    before those columns. The database runs in WAL mode so readers do not block each other
+    or the writer. Rename and copy are single transactions. Each thread gets its own
+    connection, those of finished threads are closed when the next one is opened.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS files ("
+        " path TEXT PRIMARY KEY,"
+        " parent TEXT NOT NULL,"
+        " data BLOB NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime REAL NOT NULL,"
+        " etag TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS files_listing ON files (parent, path, size, mtime, etag)",
+        "CREATE INDEX IF NOT EXISTS files_scan ON files (path, size, mtime, etag)",
+    )
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            for statement in SqliteStorageBackend.SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Get the connection for this thread """
+        thread = threading.current_thread()
+        entry = self._connections.get(thread.ident)
+        if entry is not None and entry[0] is thread:
+            return entry[1]
+
+        # Open one, closing any left by threads that have finished
+        with self._connections_lock:
+            for ident, (owner, connection) in list(self._connections.items()):
+                if not owner.is_alive():
+                    connection.close()
+                    del self._connections[ident]
+            connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._connections[thread.ident] = (thread, connection)
+        return connection
+
+    def close(self):
+        """ Close every thread's connection, they are opened again when next used """
+        with self._connections_lock:
+            for _owner, connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+    @staticmethod
+    def _split_key(path: str):
+        """ Get the key and its parent folder key """
+        key = StorageBackend.normalize_key(path)
+        if not key:
+            raise ValueError(f"Invalid path: '{path}' - a file name is required")
+        return key, key.rpartition('/')[0]
+
+    @staticmethod
+    def _prefix_range(folder: str):
+        """ Get the key prefix for a folder and the first key after it """
+        key = StorageBackend.normalize_key(folder)
+        if not key:
+            return "", None
+        # '0' sorts straight after '/'
+        return f"{key}/", f"{key}0"
+
+    def read_binary(self, path: str) -> bytes:
+        """ Read a binary file """
+        key, _parent = SqliteStorageBackend._split_key(path)
+        row = self._connection().execute("SELECT data FROM files WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"No file at {path}")
+        return bytes(row[0])
+
+    def write_binary(self, path: str, data: bytes) -> None:
+        """ Write a binary file """
+        key, parent = SqliteStorageBackend._split_key(path)
+        data = bytes(data)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO files (path, parent, data, size, mtime, etag)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, parent, data, len(data), time.time(), StorageBackend.make_etag(data)))
+
+    def read_text(self, path: str, encoding: str = "utf-8") -> str:
+        """ Read a text file """
+        return self.read_binary(path).decode(encoding)
+
+    def write_text(self, path: str, data: str, encoding: str = "utf-8") -> None:
+        """ Write a text file """
+        self.write_binary(path, data.encode(encoding))
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        """ Rename a file, replacing any file at the new path """
+        old_key, _old_parent = SqliteStorageBackend._split_key(old_path)
+        new_key, new_parent = SqliteStorageBackend._split_key(new_path)
+        if old_key == new_key:
+            return
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM files WHERE path = ?", (new_key,))
+            cursor = connection.execute(
+                "UPDATE files SET path = ?, parent = ? WHERE path = ?",
+                (new_key, new_parent, old_key))
+            if cursor.rowcount == 0:
+                raise FileNotFoundError(f"No file at {old_path}")
+
+    def delete(self, path: str) -> None:
+        """ Delete a file """
+        key, _parent = SqliteStorageBackend._split_key(path)
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute("DELETE FROM files WHERE path = ?", (key,))
+        if cursor.rowcount == 0:
+            raise FileNotFoundError(f"No file at {path}")
+
+    def list_files(self, folder: str) -> list:
+        """ List all files in a folder and return their relative paths """
+        key = StorageBackend.normalize_key(folder)
+        prefix = f"{key}/" if key else ""
+        rows = self._connection().execute(
+            "SELECT path FROM files WHERE parent = ? ORDER BY path", (key,))
+        return [row[0][len(prefix):] for row in rows]
+
+    def list_folders(self, folder: str) -> list:
+        """ List all folders in a folder and return their relative paths """
+        return [entry["path"] for entry in self.scan(folder) if entry["type"] == "folder"]
+
+    def file_exists(self, path: str) -> bool:
+        """ Check if a file exists """
+        key, _parent = SqliteStorageBackend._split_key(path)
+        row = self._connection().execute("SELECT 1 FROM files WHERE path = ?", (key,)).fetchone()
+        return row is not None
+
+    def copy(self, source_path: str, destination_path: str) -> None:
+        """ Copy a file from source to destination """
+        source_key, _source_parent = SqliteStorageBackend._split_key(source_path)
+        destination_key, destination_parent = SqliteStorageBackend._split_key(destination_path)
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute(
+                "INSERT OR REPLACE INTO files (path, parent, data, size, mtime, etag)"
+                " SELECT ?, ?, data, size, ?, etag FROM files WHERE path = ?",
+                (destination_key, destination_parent, time.time(), source_key))
+        if cursor.rowcount == 0:
+            raise FileNotFoundError(f"No file at {source_path}")
+
+    def scan(self, folder: str, recursive: bool = False) -> list:
+        """ List the entries in the folder with metadata """
+        prefix, upper = SqliteStorageBackend._prefix_range(folder)
+        connection = self._connection()
+        columns = "SELECT path, size, mtime, etag FROM files"
+
+        if recursive:
+            if upper is None:
+                rows = connection.execute(f"{columns} ORDER BY path")
+            else:
+                rows = connection.execute(
+                    f"{columns} WHERE path >= ? AND path < ? ORDER BY path", (prefix, upper))
+            files = [(path[len(prefix):], size, mtime, etag) for path, size, mtime, etag in rows]
+            return StorageBackend.make_scan_entries(files, recursive=True)
+
+        # Direct children from the parent index, folders from the distinct parents below
+        key = prefix.rstrip('/')
+        rows = connection.execute(f"{columns} WHERE parent = ? ORDER BY path", (key,))
+        files = [(path[len(prefix):], size, mtime, etag) for path, size, mtime, etag in rows]
+        if upper is None:
+            parents = connection.execute("SELECT DISTINCT parent FROM files WHERE parent != ''")
+        else:
+            parents = connection.execute(
+                "SELECT DISTINCT parent FROM files WHERE parent >= ? AND parent < ?",
+                (prefix, upper))
+        folders = sorted({row[0][len(prefix):].split('/')[0] for row in parents})
+
+        result = [StorageBackend.make_scan_entry(folder_name, "folder") for folder_name in folders]
+        result.extend(StorageBackend.make_scan_entries(files, recursive=False))
+        return result
+
+    def get_version(self, path: str):
+        """ Get the etag for a file, None if missing """
+        key, _parent = SqliteStorageBackend._split_key(path)
+        row = self._connection().execute("SELECT etag FROM files WHERE path = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete_many(self, paths: list) -> None:
+        """ Delete the files in one transaction, files that do not exist are ignored """
+        keys = [(SqliteStorageBackend._split_key(path)[0],) for path in paths]
+        connection = self._connection()
+        with connection:
+            connection.executemany("DELETE FROM files WHERE path = ?", keys)
+
+    def copy_many(self, pairs: list) -> None:
+        """ Copy each (source, destination) pair in one transaction """
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            for source_path, destination_path in pairs:
+                source_key, _source_parent = SqliteStorageBackend._split_key(source_path)
+                destination_key, destination_parent = \
+                    SqliteStorageBackend._split_key(destination_path)
+                cursor = connection.execute(
+                    "INSERT OR REPLACE INTO files (path, parent, data, size, mtime, etag)"
+                    " SELECT ?, ?, data, size, ?, etag FROM files WHERE path = ?",
+                    (destination_key, destination_parent, now, source_key))
+                if cursor.rowcount == 0:
+                    raise FileNotFoundError(f"No file at {source_path}")
+
+    def move_prefix(self, source_folder: str, destination_folder: str) -> int:
+        """ Move every file under the source folder with a single update """
+        source_prefix, source_upper = SqliteStorageBackend._prefix_range(source_folder)
+        if source_upper is None:
+            raise ValueError("A source folder is required to move a prefix")
+        source_key = source_prefix.rstrip('/')
+        destination_key = StorageBackend.normalize_key(destination_folder)
+        destination_prefix = f"{destination_key}/" if destination_key else ""
+        start = len(source_prefix) + 1
+
+        connection = self._connection()
+        with connection:
+            # Replace anything already at the destination paths
+            connection.execute(
+                "DELETE FROM files WHERE path IN"
+                " (SELECT ? || substr(path, ?) FROM files WHERE path >= ? AND path < ?)",
+                (destination_prefix, start, source_prefix, source_upper))
+            cursor = connection.execute(
+                "UPDATE files SET"
+                " path = ? || substr(path, ?),"
+                " parent = CASE WHEN parent = ? THEN ? ELSE ? || substr(parent, ?) END"
+                " WHERE path >= ? AND path < ?",
+                (destination_prefix, start, source_key, destination_key,
+                 destination_prefix, start, source_prefix, source_upper))
+        return cursor.rowcount
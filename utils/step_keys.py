@@ -0,0 +1,165 @@
+""" Session state keys and acknowledgements for flow steps """
+from abc import ABC, abstractmethod
+import streamlit as st
+from utils.step_status import StepConfigException
+
+class BaseFlowStep_ack_mgmb(ABC):
+    """ Abstract class to manaage acknowledgement status
+    i.e. buttons like confirm and start that have a state
+    """
+
+    @abstractmethod
+    def format_internal_key(self, pdata : bool, *args):
+        """ Abstract method implemented by implementation """
+
+    @abstractmethod
+    def get_option(self, option_name, default=None):
+        """ Abstract method implemented by implementation """
+
+    def _validate_ack(self, ack):
+        """ check its a valid acknowledgement type """
+        if not ack in ['changes', 'start']:
+            raise StepConfigException(f"bad acknowledgment type '{ack}'")
+
+    def get_ack_key(self, ack):
+        """ Return False if acknowlegement is required but has not yet been recieved """
+        self._validate_ack(ack)
+        ack_key = self.format_internal_key(True, ack, 'acknowledgement')
+        return ack_key
+
+    def get_ack_status_description_text(self, ack):
+        """ Get the descripton text to display for the ack,
+        either from the part after the '|' in the option value or
+        by using a default string with the button name
+        """
+        self._validate_ack(ack)
+        opt_ack_value = self.get_option(f"ack_{ack}", ack)
+        parts = opt_ack_value.split('|')
+        if len(parts) > 1:
+            return parts[1]
+        return f"Click {parts[0]} to proceed."
+
+    def get_ack_button_text(self, ack):
+        """ Get the button text """
+        self._validate_ack(ack)
+        opt_ack_value = self.get_option(f"ack_{ack}", ack)
+        parts = opt_ack_value.split('|')
+        return parts[0]
+
+    def get_ack_button(self, ack):
+        """ Return a dict that represents a button"""
+        self._validate_ack(ack)
+        action = {
+            "text" : self.get_ack_button_text(ack),
+            "on_click" : lambda : self.on_ack(ack)
+        }
+
+        return action
+
+    def check_ack(self, ack):
+        """ Return False if acknowlegement is required but has not yet been recieved """
+        self._validate_ack(ack)
+        opt_ack_value = self.get_option(f"ack_{ack}", None)
+        if not opt_ack_value:
+            return True
+        ack_key = self.get_ack_key(ack)
+        if True is st.session_state.get(ack_key):
+            return True
+        return False
+
+    def on_ack(self, ack):
+        """ Set acknowledged in state """
+        self._validate_ack(ack)
+        ack_key = self.get_ack_key(ack)
+        st.session_state[ack_key] = True
+
+class StepKeyIndex:
+    """ Index of session state keys by step key prefix
+
+    Keys are added under their step's prefix as steps create them through
+    format_internal_key so finding a step's keys doesn't scan all of session state. A
+    prefix is scanned on its first lookup, and again whenever session state has changed
+    size since, which picks up keys written some other way. The index is held in session
+    state as volatile data so loading or creating a saved state clears it.
+    """
+
+    STATE_KEY = 'vdata__step_key_index'
+
+    @staticmethod
+    def _get_index():
+        """ Get the index for this session, a dict of prefix to its keys and state size """
+        index = st.session_state.get(StepKeyIndex.STATE_KEY)
+        if not isinstance(index, dict):
+            index = {}
+            st.session_state[StepKeyIndex.STATE_KEY] = index
+        return index
+
+    @staticmethod
+    def register(prefix, key):
+        """ Record a key against its step prefix if that prefix is indexed """
+        entry = StepKeyIndex._get_index().get(prefix)
+        if entry is not None:
+            entry["keys"][key] = None
+
+    @staticmethod
+    def get_keys(prefix):
+        """ Get the keys in session state starting with the prefix """
+        index = StepKeyIndex._get_index()
+        size = len(st.session_state)
+        entry = index.get(prefix)
+        if entry is None or entry["size"] != size:
+            keys = dict.fromkeys(st_key for st_key in st.session_state.keys()
+                                 if st_key.startswith(prefix) and st_key != StepKeyIndex.STATE_KEY)
+            entry = {"keys": keys, "size": size}
+            index[prefix] = entry
+        return [key for key in entry["keys"] if key in st.session_state]
+
+
+class BaseFlowStepKeyMgmt(ABC):
+    """ Abstract class to Manage and format keys for a step """
+
+    @abstractmethod
+    def get_name(self):
+        """ Abstract method to get the name of the step """
+
+    @abstractmethod
+    def get_unique_key_prefix(self, pdata=True):
+        """ Get the prefix for all this steps keys , pdata true for persitable else volatile """
+
+    def get_output_key(self):
+        """ Get the unique output key for this step where all the steps output is stored """
+        unique_key_prefix = self.get_unique_key_prefix()
+        return f'{unique_key_prefix}_output_key'
+
+    def format_internal_key(self, pdata : bool, *args):
+        """ creates a unique state key, pdata true for persitable else volatile"""
+        if not args:
+            raise ValueError("At least one additional argument is required")
+
+        # Format, index and return
+        unique_key_prefix = self.get_unique_key_prefix(pdata)
+        key =  unique_key_prefix + '_' + '_'.join(args)
+        StepKeyIndex.register(unique_key_prefix, key)
+        return key
+
+    def get_internal_keys(self, include_pdata=True, include_vdata=True):
+        """ Get a list of the current keys matching the parameters """
+
+        # Look up the keys that belong to this step
+        internal_keys = []
+        if include_pdata:
+            internal_keys.extend(StepKeyIndex.get_keys(self.get_unique_key_prefix(pdata=True)))
+        if include_vdata:
+            internal_keys.extend(StepKeyIndex.get_keys(self.get_unique_key_prefix(pdata=False)))
+
+        # Remove output key if present
+        output_key = self.get_output_key()
+        if output_key in internal_keys:
+            internal_keys.remove(output_key)
+
+        # Done
+        return internal_keys
+
+    def get_output_subkeys(self):
+        """ Virtual - return sub keys that will be in the output dict """
+        return []
@@ -0,0 +1,122 @@
+""" Step statuses and the option criteria matched against them """
+from enum import IntEnum, Enum, auto
+
+class StepConfigException(Exception):
+    """ exception class for flow config parsing errors """
+
+
+class StepStatus(IntEnum):
+    """ Enum to represent the status of a step """
+    WAITING = auto()
+    ENQUEUED = auto()
+    ACTIVE_ACK_START = auto()
+    ACTIVE = auto()
+    ACTIVE_ACK_CHANGES = auto()
+    DONE = auto()
+
+    def get_name(self):
+        """Returns a human-readable name for the status."""
+        names = {
+            self.WAITING: "WAITING",
+            self.ENQUEUED: "ENQUEUED",
+            self.ACTIVE_ACK_START: "STARTING",
+            self.ACTIVE: "ACTIVE",
+            self.ACTIVE_ACK_CHANGES: "CONFIRM",
+            self.DONE: "DONE"
+        }
+        return names.get(self, "Unknown")
+
+    def get_description(self):
+        """Returns a description of the status."""
+        descriptions = {
+            self.WAITING: "Step can't start since it's dependent on upstream outputs",
+            self.ENQUEUED: "Not started yet as the previous step is not done",
+            self.ACTIVE_ACK_START:
+                "The step is active but is configured to prompt the user to acknowledge the start",
+            self.ACTIVE: "The step is active, working or prompting for input",
+            self.ACTIVE_ACK_CHANGES:
+                "The step is done but is configured and waiting for user to acknowledge changes",
+            self.DONE: "The step is done and next step can start"
+        }
+        return descriptions.get(self, "No description available")
+
+    @staticmethod
+    def get_icon(status):
+        """ Maps a StepStatus Unicode icon."""
+        icon_map = {
+            StepStatus.WAITING: "\u23F3",  # Hourglass
+            StepStatus.ENQUEUED: "\u2B55",  # Hollow Red Circle
+            StepStatus.ACTIVE_ACK_START: "\U0001F514",  # Bell
+            StepStatus.ACTIVE: "\u25B6\uFE0F",  # Play Button
+            StepStatus.ACTIVE_ACK_CHANGES: "\u270B",  # Raised Hand
+            StepStatus.DONE: "\u2705",  # White Heavy Check Mark
+        }
+
+        return icon_map.get(status, "\u2753")  # Question Mark for unknown status
+
+class StatusCriteria(Enum):
+    """ Enum for all the options criteria that can be matched against a status """
+    afterActive = 'afterActive'
+    waitingEnqueuedAndAckOnly = 'waitingEnqueuedAndAckOnly'
+    anyActive = 'anyActive'
+    always = 'always'
+    never = 'never'
+    waitingOnly = 'waitingOnly'
+    enqueuedOnly = 'enqueuedOnly'
+    activeAckStartOnly = 'activeAckStartOnly'
+    activeOnly = 'activeOnly'
+    activeAckChangesOnly = 'activeAckChangesOnly'
+    doneOnly = 'doneOnly'
+
+    @staticmethod
+    def get_statuses(opt_criteria) -> frozenset:
+        """ returns the set of statuses that match the criteria """
+        try:
+            enum_criteria = StatusCriteria(opt_criteria)
+        except ValueError as exc:
+            valid_options = ", ".join([criteria.value for criteria in StatusCriteria])
+            err_msg = f"Unknown option '{opt_criteria}'. Valid options are: {valid_options}"
+            raise StepConfigException(err_msg) from exc
+
+        return STATUS_CRITERIA_MAP[enum_criteria]
+
+    @staticmethod
+    def status_matches_criteria(opt_criteria: str, step_status: StepStatus) -> bool:
+        """ returns true if the status matches the criteria """
+        return step_status in StatusCriteria.get_statuses(opt_criteria)
+
+# The statuses matching each criteria
+STATUS_CRITERIA_MAP = {
+    StatusCriteria.afterActive: frozenset({
+        StepStatus.ACTIVE_ACK_START,
+        StepStatus.ACTIVE,
+        StepStatus.ACTIVE_ACK_CHANGES,
+        StepStatus.DONE
+        }),
+    StatusCriteria.anyActive: frozenset({
+        StepStatus.ACTIVE_ACK_START,
+        StepStatus.ACTIVE,
+        StepStatus.ACTIVE_ACK_CHANGES
+        }),
+    StatusCriteria.waitingEnqueuedAndAckOnly: frozenset({
+        StepStatus.WAITING,
+        StepStatus.ENQUEUED,
+        StepStatus.ACTIVE_ACK_CHANGES,
+        StepStatus.ACTIVE_ACK_START
+        }),
+    StatusCriteria.always: frozenset(StepStatus),
+    StatusCriteria.never: frozenset(),
+    StatusCriteria.waitingOnly: frozenset({StepStatus.WAITING}),
+    StatusCriteria.enqueuedOnly: frozenset({StepStatus.ENQUEUED}),
+    StatusCriteria.activeAckStartOnly: frozenset({StepStatus.ACTIVE_ACK_START}),
+    StatusCriteria.activeOnly: frozenset({StepStatus.ACTIVE}),
+    StatusCriteria.activeAckChangesOnly: frozenset({StepStatus.ACTIVE_ACK_CHANGES}),
+    StatusCriteria.doneOnly: frozenset({StepStatus.DONE})
+}
+
+# Options that select the statuses something is shown in, with their defaults
+STATUS_OPTION_DEFAULTS = {
+    'visibility': StatusCriteria.always,
+    'expandability': StatusCriteria.anyActive,
+    'status_description_visibility': StatusCriteria.waitingEnqueuedAndAckOnly
+}
@@ -1,246 +1,25 @@
 """ Class hierarchy for flow steps """
-from enum import IntEnum, Enum, auto
-from abc import ABC, abstractmethod
+from abc import abstractmethod
 from typing import Dict, Any
+from types import MappingProxyType
 import time
 import re
+import copy
 import streamlit as st
 from st_ui.json_viewer import JSONViewer
 from utils.langchain_utils import LangChainUtils
 from utils.get_text import TxtGetter
 from utils.flow_utils import FlowUtils
-
-class StepConfigException(Exception):
-    """ exception class for flow config parsing errors """
+from utils.summary_utils import MapReduceSummariser
+from utils.llm_scheduling import LLMCallPriority
+from utils.step_status import StepConfigException, StepStatus
+from utils.step_keys import BaseFlowStep_ack_mgmb, BaseFlowStepKeyMgmt
+from utils.flow_plan import FlowPlan, StepStatusEvaluator
 
 # Forward def for type hint
 class BaseFlowApp:
     """ Forward declaration for the base flow app class """
 
-class BaseFlowStep_ack_mgmb(ABC):
-    """ Abstract class to manaage acknowledgement status
-    i.e. buttons like confirm and start that have a state
-    """
-
-    @abstractmethod
-    def format_internal_key(self, pdata : bool, *args):
-        """ Abstract method implemented by implementation """
-
-    @abstractmethod
-    def get_option(self, option_name, default=None):
-        """ Abstract method implemented by implementation """
-
-    def _validate_ack(self, ack):
-        """ check its a valid acknowledgement type """
-        if not ack in ['changes', 'start']:
-            raise StepConfigException(f"bad acknowledgment type '{ack}'")
-
-    def get_ack_key(self, ack):
-        """ Return False if acknowlegement is required but has not yet been recieved """
-        self._validate_ack(ack)
-        ack_key = self.format_internal_key(True, ack, 'acknowledgement')
-        return ack_key
-
-    def get_ack_status_description_text(self, ack):
-        """ Get the descripton text to display for the ack,
-        either from the part after the '|' in the option value or
-        by using a default string with the button name
-        """
-        self._validate_ack(ack)
-        opt_ack_value = self.get_option(f"ack_{ack}", ack)
-        parts = opt_ack_value.split('|')
-        if len(parts) > 1:
-            return parts[1]
-        return f"Click {parts[0]} to proceed."
-
-    def get_ack_button_text(self, ack):
-        """ Get the button text """
-        self._validate_ack(ack)
-        opt_ack_value = self.get_option(f"ack_{ack}", ack)
-        parts = opt_ack_value.split('|')
-        return parts[0]
-
-    def get_ack_button(self, ack):
-        """ Return a dict that represents a button"""
-        self._validate_ack(ack)
-        action = {
-            "text" : self.get_ack_button_text(ack),
-            "on_click" : lambda : self.on_ack(ack)
-        }
-
-        return action
-
-    def check_ack(self, ack):
-        """ Return False if acknowlegement is required but has not yet been recieved """
-        self._validate_ack(ack)
-        opt_ack_value = self.get_option(f"ack_{ack}", None)
-        if not opt_ack_value:
-            return True
-        ack_key = self.get_ack_key(ack)
-        if True is st.session_state.get(ack_key):
-            return True
-        return False
-
-    def on_ack(self, ack):
-        """ Set acknowledged in state """
-        self._validate_ack(ack)
-        ack_key = self.get_ack_key(ack)
-        st.session_state[ack_key] = True
-
-class BaseFlowStepKeyMgmt(ABC):
-    """ Abstract class to Manage and format keys for a step """
-
-    @abstractmethod
-    def get_name(self):
-        """ Abstract method to get the name of the step """
-
-    @abstractmethod
-    def get_unique_key_prefix(self, pdata=True):
-        """ Get the prefix for all this steps keys , pdata true for persitable else volatile """
-
-    def get_output_key(self):
-        """ Get the unique output key for this step where all the steps output is stored """
-        unique_key_prefix = self.get_unique_key_prefix()
-        return f'{unique_key_prefix}_output_key'
-
-    def format_internal_key(self, pdata : bool, *args):
-        """ creates a unique state key, pdata true for persitable else volatile"""
-        if not args:
-            raise ValueError("At least one additional argument is required")
-
-        # Format and return
-        unique_key_prefix = self.get_unique_key_prefix(pdata)
-        key =  unique_key_prefix + '_' + '_'.join(args)
-        return key
-
-    def get_internal_keys(self, include_pdata=True, include_vdata=True):
-        """ Get a list of the current keys matching the parameters """
-
-        # Search for keys that belong to this step
-        internal_keys = []
-        unique_pdata_key_prefix = self.get_unique_key_prefix(pdata=True)
-        unique_vdata_key_prefix = self.get_unique_key_prefix(pdata=False)
-        for st_key in st.session_state.keys():
-
-            if include_pdata and st_key.startswith(unique_pdata_key_prefix):
-                internal_keys.append(st_key)
-            if include_vdata and st_key.startswith(unique_vdata_key_prefix):
-                internal_keys.append(st_key)
-
-        # Remove output key if present
-        output_key = self.get_output_key()
-        if output_key in internal_keys:
-            internal_keys.remove(output_key)
-
-        # Done
-        return internal_keys
-
-    def get_output_subkeys(self):
-        """ Virtual - return sub keys that will be in the output dict """
-        return []
-
-
-class StepStatus(IntEnum):
-    """ Enum to represent the status of a step """
-    WAITING = auto()
-    ENQUEUED = auto()
-    ACTIVE_ACK_START = auto()
-    ACTIVE = auto()
-    ACTIVE_ACK_CHANGES = auto()
-    DONE = auto()
-
-    def get_name(self):
-        """Returns a human-readable name for the status."""
-        names = {
-            self.WAITING: "WAITING",
-            self.ENQUEUED: "ENQUEUED",
-            self.ACTIVE_ACK_START: "STARTING",
-            self.ACTIVE: "ACTIVE",
-            self.ACTIVE_ACK_CHANGES: "CONFIRM",
-            self.DONE: "DONE"
-        }
-        return names.get(self, "Unknown")
-
-    def get_description(self):
-        """Returns a description of the status."""
-        descriptions = {
-            self.WAITING: "Step can't start since it's dependent on upstream outputs",
-            self.ENQUEUED: "Not started yet as the previous step is not done",
-            self.ACTIVE_ACK_START: "The step is active but is configured to prompt the user to acknowledge the start",
-            self.ACTIVE: "The step is active, working or prompting for input",
-            self.ACTIVE_ACK_CHANGES: "The step is done but is configured and waiting for user to acknowledge changes",
-            self.DONE: "The step is done and next step can start"
-        }
-        return descriptions.get(self, "No description available")
-
-    @staticmethod
-    def get_icon(status):
-        """ Maps a StepStatus Unicode icon."""
-        icon_map = {
-            StepStatus.WAITING: "\u23F3",  # Hourglass
-            StepStatus.ENQUEUED: "\u2B55",  # Hollow Red Circle
-            StepStatus.ACTIVE_ACK_START: "\U0001F514",  # Bell
-            StepStatus.ACTIVE: "\u25B6\uFE0F",  # Play Button
-            StepStatus.ACTIVE_ACK_CHANGES: "\u270B",  # Raised Hand
-            StepStatus.DONE: "\u2705",  # White Heavy Check Mark
-        }
-
-        return icon_map.get(status, "\u2753")  # Question Mark for unknown status
-
-class StatusCriteria(Enum):
-    """ Enum for all the options criteria that can be matched against a status """
-    afterActive = 'afterActive'
-    waitingEnqueuedAndAckOnly = 'waitingEnqueuedAndAckOnly'
-    anyActive = 'anyActive'
-    always = 'always'
-    never = 'never'
-    waitingOnly = 'waitingOnly'
-    enqueuedOnly = 'enqueuedOnly'
-    activeAckStartOnly = 'activeAckStartOnly'
-    activeOnly = 'activeOnly'
-    activeAckChangesOnly = 'activeAckChangesOnly'
-    doneOnly = 'doneOnly'
-
-    @staticmethod
-    def status_matches_criteria(opt_criteria: str, step_status: StepStatus) -> bool:
-        """ returns true if the status matches the criteria """
-        try:
-            enum_criteria = StatusCriteria(opt_criteria)
-        except ValueError as exc:
-            valid_options = ", ".join([criteria.value for criteria in StatusCriteria])
-            err_msg = f"Unknown option '{opt_criteria}'. Valid options are: {valid_options}"
-            raise StepConfigException(err_msg) from exc
-
-        criteria_map = {
-            StatusCriteria.afterActive: {
-                StepStatus.ACTIVE_ACK_START,
-                StepStatus.ACTIVE,
-                StepStatus.ACTIVE_ACK_CHANGES,
-                StepStatus.DONE
-                },
-            StatusCriteria.anyActive: {
-                StepStatus.ACTIVE_ACK_START,
-                StepStatus.ACTIVE,
-                StepStatus.ACTIVE_ACK_CHANGES
-                },
-            StatusCriteria.waitingEnqueuedAndAckOnly: {
-                StepStatus.WAITING,
-                StepStatus.ENQUEUED,
-                StepStatus.ACTIVE_ACK_CHANGES,
-                StepStatus.ACTIVE_ACK_START
-                },
-            StatusCriteria.always: set(StepStatus),
-            StatusCriteria.never: set(),
-            StatusCriteria.waitingOnly: {StepStatus.WAITING},
-            StatusCriteria.enqueuedOnly: {StepStatus.ENQUEUED},
-            StatusCriteria.activeAckStartOnly: {StepStatus.ACTIVE_ACK_START},
-            StatusCriteria.activeOnly: {StepStatus.ACTIVE},
-            StatusCriteria.activeAckChangesOnly: {StepStatus.ACTIVE_ACK_CHANGES},
-            StatusCriteria.doneOnly: {StepStatus.DONE}
-        }
-
-        return step_status in criteria_map[enum_criteria]
-
 class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
     """ Common data and functions for flow steps """
 
@@ -256,6 +35,9 @@ class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
 
         self.heading = self.step_config.get('heading', None)
 
+        # Merged options and status sets, built when first needed if there is no plan
+        self._unplanned = {}
+
         # Constants
         self.pdata_prefix = 'pdata_'
         self.vdata_prefix = 'vdata_'
@@ -269,9 +51,27 @@ class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
 
         return f'{prefix}{self.get_name()}'
 
+    def get_options_table(self):
+        """ The step's options merged with the flow's, from the plan if we have one """
+        plan = self.get_plan()
+        if plan is not None:
+            return plan.step_options[self.get_name()]
+        if "options" not in self._unplanned:
+            self._unplanned["options"] = MappingProxyType(FlowPlan.merge_options(
+                self.get_app().get_config(), self.get_step_config()))
+        return self._unplanned["options"]
+
     def get_option(self, option_name, default=None):
         """ Get a step option, precedence order if step level config, then flow config """
 
+        # Simple names are one lookup in the merged options, which the plan shares
+        # between sessions so dicts and lists are copied
+        if '.' not in option_name:
+            option_value = self.get_options_table().get(option_name, default)
+            if isinstance(option_value, (dict, list)):
+                return copy.deepcopy(option_value)
+            return option_value
+
         step_config = self.get_step_config()
         flow_config = self.get_app().get_config()
 
@@ -280,6 +80,40 @@ class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
         option_value = FlowUtils.nested_get(step_config, f"step_options.{option_name}", option_value)
         return option_value
 
+    def get_status_set(self, option_name):
+        """ The statuses matching one of the status options, e.g. visibility """
+        plan = self.get_plan()
+        if plan is not None:
+            return plan.status_sets[self.get_name()][option_name]
+        if "status_sets" not in self._unplanned:
+            self._unplanned["status_sets"] = FlowPlan.status_sets_from_options(
+                self.get_options_table())
+        return self._unplanned["status_sets"][option_name]
+
+    def get_step_status(self, flow_state):
+        """ Get the current status of the step """
+
+        # Waiting for data from dependency steps
+        if not self.input_data_ready(flow_state):
+            return StepStatus.WAITING
+        # Waiting for previous step to be done
+        elif not self.prev_step_is_done(flow_state):
+            return StepStatus.ENQUEUED
+        # If our data is not ready we are active
+        elif not self.output_data_ready(flow_state):
+            if not self.check_ack('start'):
+                return StepStatus.ACTIVE_ACK_START
+            return StepStatus.ACTIVE
+        elif not self.check_ack('changes'):
+            return StepStatus.ACTIVE_ACK_CHANGES
+        else:
+            return StepStatus.DONE
+
+    def get_status_evaluator(self):
+        """ Get the app's status evaluator for this rerun or None """
+        evaluator = getattr(self.app, 'status_evaluator', None)
+        return evaluator if isinstance(evaluator, StepStatusEvaluator) else None
+
     def show(self, flow_state, render_step):
         """ Asses status and show the step """
 
@@ -287,39 +121,22 @@ class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
         step_config = self.get_step_config()
         step_state = self.get_app().get_state()
 
-        def get_step_status():
-            """ Get the current status of the step """
-
-            # Waiting for data from dependency steps
-            if not self.input_data_ready(flow_state):
-                return StepStatus.WAITING
-            # Waiting for previous step to be done
-            elif not self.prev_step_is_done(flow_state):
-                return StepStatus.ENQUEUED
-            # If our data is not ready we are active
-            elif not self.output_data_ready(flow_state):
-                if not self.check_ack('start'):
-                    return StepStatus.ACTIVE_ACK_START
-                return StepStatus.ACTIVE
-            elif not self.check_ack('changes'):
-                return StepStatus.ACTIVE_ACK_CHANGES
-            else:
-                return StepStatus.DONE
-
-        # Get status now
-        step_status = get_step_status()
+        # Get status now, from the app's evaluation of all the steps if it has one
+        evaluator = self.get_status_evaluator()
+        if evaluator is not None:
+            step_status = evaluator.get_status(self, flow_state)
+        else:
+            step_status = self.get_step_status(flow_state)
 
         # Determine visibility
-        opt_visibility = self.get_option('visibility', StatusCriteria.always)
-        visible = StatusCriteria.status_matches_criteria(opt_visibility, step_status)
+        visible = step_status in self.get_status_set('visibility')
 
         # Determine expandability
-        opt_expandability = self.get_option('expandability', StatusCriteria.anyActive)
-        expand = StatusCriteria.status_matches_criteria(opt_expandability, step_status)
+        expand = step_status in self.get_status_set('expandability')
 
         # Status description visible
-        opt_status_description_visibility = self.get_option('status_description_visibility', StatusCriteria.waitingEnqueuedAndAckOnly)
-        status_description_visible = StatusCriteria.status_matches_criteria(opt_status_description_visibility, step_status)
+        status_description_visible = \
+            step_status in self.get_status_set('status_description_visibility')
 
         def format_status_description():
             """ Format a string that describes the steps status """
@@ -413,7 +230,10 @@ class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
             fn_step_content=fn_step_content)
 
         # Rerun if step status changed
-        updated_step_status = get_step_status()
+        if evaluator is not None:
+            updated_step_status = evaluator.refresh_status(self, flow_state)
+        else:
+            updated_step_status = self.get_step_status(flow_state)
         if updated_step_status != step_status:
             st.rerun()
 
@@ -523,9 +343,20 @@ class BaseFlowStep(BaseFlowStepKeyMgmt, BaseFlowStep_ack_mgmb):
         dependency_step = dependency_path.split('.')[0]
         return dependency_step
 
+    def get_plan(self):
+        """ Get the app's flow plan or None if it has not been built """
+        plan = getattr(self.app, 'plan', None)
+        return plan if isinstance(plan, FlowPlan) else None
+
     def get_dependency_steps(self):
         """ Get list of step objects this step is dependent on """
 
+        # From the plan if we have one
+        plan = self.get_plan()
+        if plan is not None:
+            return [self.app.get_step(dep_step_name)
+                    for dep_step_name in plan.dependencies[self.get_name()]]
+
         dependencies = self.get_depends_on()
         dep_steps = []
         for dep in dependencies.keys():
@@ -826,7 +657,7 @@ class RetrieveDataStep(BaseFlowStep):
         )
 
         # Our internal log key
-        self.internal_log_key = f'{self.pdata_prefix}{self.name}_retrieved_data_log'
+        self.internal_log_key = self.format_internal_key(True, 'retrieved_data_log')
 
 
     def do(self, step_config, state_dict, step_status):
@@ -888,6 +719,126 @@ class RetrieveDataStep(BaseFlowStep):
         data_sources_step = self.app.get_step(data_sources_step_name)
         return data_sources_step.get_output_subkeys()
 
+class CondenseDataStep(BaseFlowStep):
+    """ Map reduce summarise any retrieved data that is too large for the model """
+
+    def __init__(self, name, app):
+
+        # Defaults for this step type
+        defaults = {
+            'heading' : 'Condense data',
+            'max_input_tokens' : None,
+            'prompt_reserve_tokens' : 4000,
+            'chunk_tokens' : 4000,
+            'max_concurrency' : 4,
+            'step_options' : {
+                  'ack_start' : None
+            }
+        }
+
+        # Parent
+        super().__init__(
+            name=name,
+            app=app,
+            defaults=defaults
+        )
+
+        # Our internal log and failure keys
+        self.internal_log_key = self.format_internal_key(True, 'condensed_data_log')
+        self.internal_failed_key = self.format_internal_key(True, 'condense_failed')
+
+    @staticmethod
+    def get_input_budget(step_config, chat_model_choice):
+        """ Tokens the retrieved data can use in the prompt, from the config or else the
+        chosen model's input limit less the reserve for the rest of the prompt
+        """
+        if step_config['max_input_tokens'] is not None:
+            return step_config['max_input_tokens']
+        max_input_tokens = LangChainUtils.get_max_input_tokens(chat_model_choice)
+        return max(step_config['chunk_tokens'],
+                   max_input_tokens - step_config['prompt_reserve_tokens'])
+
+    def condense(self, step_config, data, chat_model_choice, write_to_log):
+        """ Condense the items that stop the data fitting, None if any of them fails """
+
+        # The user is waiting on this so the calls are interactive
+        budget = self.get_input_budget(step_config, chat_model_choice)
+        summariser = MapReduceSummariser(
+            chat_model=LangChainUtils.get_chat_model(chat_model_choice),
+            chunk_tokens=step_config['chunk_tokens'],
+            max_concurrency=step_config['max_concurrency'],
+            map_prompt=step_config.get('map_prompt'),
+            reduce_prompt=step_config.get('reduce_prompt'),
+            max_input_tokens=budget,
+            priority=LLMCallPriority.INTERACTIVE)
+
+        # If it all fits use it as is, otherwise condense items over their share
+        estimates = {key: FlowUtils.estimate_tokens(text) for key, text in data.items()}
+        item_limit = budget
+        if sum(estimates.values()) > budget:
+            item_limit = budget // max(1, len(data))
+        write_to_log(f"Input budget {budget} estimated tokens.")
+
+        condensed = {}
+        for key, text in data.items():
+            if estimates[key] <= item_limit:
+                condensed[key] = text
+                write_to_log(f"'{key}' estimated tokens {estimates[key]}, used as is.")
+                continue
+
+            try:
+                condensed[key] = summariser.summarise(text, write_to_log)
+                condensed_tokens = FlowUtils.estimate_tokens(condensed[key])
+                write_to_log(f"'{key}' condensed from {estimates[key]} "
+                             f"to {condensed_tokens} estimated tokens.")
+            except LangChainUtils.CALL_ERRORS as e:
+                write_to_log(f"Failed to condense '{key}' :{e}.")
+                return None
+
+        # Done
+        return condensed
+
+    def do(self, step_config, state_dict, step_status):
+        """ Condense the retrieved items that stop the data fitting in the prompt """
+
+        def write_to_log(log_item):
+            """ append an item to the internal log """
+            state_dict[self.internal_log_key].append(log_item)
+
+        # Run once, a failure is kept so reruns don't repeat the calls until a retry
+        output_key = self.get_output_key()
+        if None is state_dict.get(output_key) and not state_dict.get(self.internal_failed_key):
+            state_dict[self.internal_log_key] = []
+            with st.spinner("Condensing data..."):
+                condensed = self.condense(
+                    step_config,
+                    state_dict[self.get_dependency_key('data')],
+                    state_dict[self.get_dependency_key('chat_model_choice')],
+                    write_to_log)
+
+            # Set the output if all done, otherwise record the failure
+            if condensed is not None:
+                state_dict[output_key] = condensed
+            else:
+                state_dict[self.internal_failed_key] = True
+
+        # Write the log data if present
+        if state_dict.get(self.internal_log_key) is not None:
+            for log_item in state_dict[self.internal_log_key]:
+                st.write(log_item)
+
+        # Offer to try again after a failure
+        if state_dict.get(self.internal_failed_key):
+            st.button("Retry", key=self.format_internal_key(False, 'retry'),
+                      on_click=lambda: state_dict.pop(self.internal_failed_key, None))
+
+    def get_output_subkeys(self):
+        """ Return sub keys that will be in the output dict """
+        # The keys are the same as the data we condense
+        data_step_name = self.get_depends_on('data')
+        data_step = self.app.get_step(data_step_name)
+        return data_step.get_output_subkeys()
+
 class SelectPromptFragmentsStep(BaseFlowStep):
     """ Select one or more prompt fragments """
 
@@ -968,9 +919,13 @@ class FormatPromptStep(BaseFlowStep):
         template = step_config['template']
         token_map = {}
 
-        # Build the token map
-        depends_on = self.get_depends_on()
+        # Use the token map from the plan if we have one
+        plan = self.get_plan()
+        depends_on = self.get_depends_on() if plan is None else {}
+        if plan is not None:
+            token_map = plan.token_maps[self.get_name()]
 
+        # Build the token map
         for key, dep_path in depends_on.items():
             dep_step_name = self.step_name_from_path(dep_path)
             dep_step = self.app.get_step(dep_step_name)
@@ -1005,6 +960,20 @@ class ChatLoopStep(BaseFlowStep):
             defaults=defaults
         )
 
+    @staticmethod
+    def get_hedge(step_config, chat_model_choice, prompt_caching):
+        """ The shared hedge policy if a hedge model or region is configured, otherwise None """
+        hedge_model_choice = step_config.get("hedge_model_choice", None)
+        hedge_region = step_config.get("hedge_region", None)
+        if not (hedge_model_choice or hedge_region):
+            return None
+        return LangChainUtils.get_hedge_policy(
+            chat_model_choice,
+            hedge_model_choice=hedge_model_choice,
+            hedge_region=hedge_region,
+            prompt_caching=prompt_caching,
+            percentile=step_config.get("hedge_percentile", 95))
+
     def do(self, step_config, state_dict, step_status):
         """ Setup and run the chat loop"""
 
@@ -1012,20 +981,38 @@ class ChatLoopStep(BaseFlowStep):
         initial_system_prompt = state_dict[self.get_dependency_key('initial_system_prompt')]
         initial_human_prompt = state_dict[self.get_dependency_key('initial_human_prompt')]
         chat_model_choice = state_dict[self.get_dependency_key('chat_model_choice')]
-        chat_model = LangChainUtils.get_chat_model(chat_model_choice)
 
         # Get options
         retrieve_context = step_config.get("retrieve_context", True)
         hide_initial_prompt = step_config.get("hide_initial_prompt", True)
         input_place_holder_text = step_config.get("input_place_holder_text", "Type a question.")
+        cache_prompt_prefix = step_config.get("cache_prompt_prefix", False)
 
+        # Get the model
+        chat_model = LangChainUtils.get_chat_model(chat_model_choice, prompt_caching=cache_prompt_prefix)
 
-        def write_chat_message(role, message):
+        # Hedge slow calls with another model or region if configured, the policy is shared
+        hedge = ChatLoopStep.get_hedge(step_config, chat_model_choice, cache_prompt_prefix)
+
+        def format_usage(usage):
+            """ Format the token usage as a short caption """
+            caption = f"Tokens in: {usage.get('input_tokens', 0)}, out: {usage.get('output_tokens', 0)}"
+            if cache_prompt_prefix:
+                caption += f", cache read: {usage.get('cache_read_input_tokens', 0)}"
+                caption += f", cache write: {usage.get('cache_write_input_tokens', 0)}"
+            return caption
+
+        def write_chat_message(role, message, usage=None):
             """ Write a chat message for the role """
 
             # Escape dollar signs to avoid LaTeX type setting
             message = re.sub(r'(?<!\$)\$(?!\$)', '&#36;', message)
-            st.chat_message(role).markdown(message)
+            chat_message = st.chat_message(role)
+            chat_message.markdown(message)
+
+            # Show the token usage if we have it
+            if usage:
+                chat_message.caption(format_usage(usage))
 
 
         def do_chat_loop(
@@ -1051,9 +1038,8 @@ class ChatLoopStep(BaseFlowStep):
                     hide_initial_prompt = False
                 else:
                     # Truncate to length to trim of retrieved context
-                    length = message.get('length', len(message["content"]))
-                    content = message["content"][:length]
-                    write_chat_message(message["role"], content)
+                    content = message["content"][:message.get('length', len(message["content"]))]
+                    write_chat_message(message["role"], content, message.get("usage"))
 
             # Get the human prompt
             human_prompt = st.chat_input(placeholder=input_place_holder_text)
@@ -1079,16 +1065,23 @@ class ChatLoopStep(BaseFlowStep):
                     human_prompt = FlowUtils.add_context_to_prompt(human_prompt)
 
                 # Pass the message history and get the response
+                usage = {}
                 with st.spinner('...'):
                     interaction_occured = True
-                    response = LangChainUtils.chat_prompt_response(chat_model, initial_system_prompt, human_prompt, messages)
+                    response = LangChainUtils.chat_prompt_response(
+                        chat_model,
+                        initial_system_prompt,
+                        human_prompt,
+                        messages,
+                        usage,
+                        hedge=hedge)
 
                 # Show the response and add it to messages
-                write_chat_message("assistant", response)
+                write_chat_message("assistant", response, usage)
 
                 # Update messages
                 state_dict[messages_key].append({"role": "user", "content": human_prompt, "length" : human_prompt_length})
-                state_dict[messages_key].append({"role": "assistant", "content": response})
+                state_dict[messages_key].append({"role": "assistant", "content": response, "usage" : usage})
 
             # Done
             return interaction_occured
@@ -1,11 +1,82 @@
 """ Storage abstraction and implementation """
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
 import shutil
-import boto3
+import hashlib
+import threading
+import uuid
 from botocore.exceptions import ClientError
+from utils.aws_utils import AWSUtils
+from utils.s3_streams import AbortOnErrorMixin, S3RangeReader, S3MultipartWriter
 
-class StorageBackend(ABC):
+class StorageWriteBuffer(AbortOnErrorMixin, io.BytesIO):
+    """ Write stream that collects the data in memory and hands it over on close
+    Leaving a with block on an exception discards the data
+    """
+
+    def __init__(self, on_commit):
+        super().__init__()
+        self._on_commit = on_commit
+        self._aborted = False
+
+    def abort(self):
+        """ Close without committing """
+        self._aborted = True
+        self.close()
+
+    def close(self):
+        if not self.closed and not self._aborted:
+            self._on_commit(self.getvalue())
+        super().close()
+
+
+class LocalFileWriter(AbortOnErrorMixin, io.BufferedWriter):
+    """ Write stream to a temporary file beside the target that replaces it on close
+    Leaving a with block on an exception discards the data and leaves the target as it was
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = os.path.join(
+            os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+        file_descriptor = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        super().__init__(io.FileIO(file_descriptor, "wb"))
+        self._aborted = False
+
+    def abort(self):
+        """ Close without replacing the target """
+        self._aborted = True
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        replaced = False
+        try:
+            super().close()
+            if not self._aborted:
+                os.replace(self.temp_path, self.path)
+                replaced = True
+        finally:
+            if not replaced:
+                try:
+                    os.remove(self.temp_path)
+                except FileNotFoundError:
+                    pass
+
+
+class StorageTextWriter(io.TextIOWrapper):
+    """ Text write stream that aborts the underlying writer on an exception """
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and hasattr(self.buffer, "abort"):
+            self.buffer.abort() # pylint: disable=no-member
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class StorageBackend(ABC): # pylint: disable=too-many-public-methods
     """ Abstract base class to define storage """
     @abstractmethod
     def read_binary(self, path: str) -> bytes:
@@ -47,9 +118,166 @@ class StorageBackend(ABC):
     def copy(self, source_path: str, destination_path: str) -> None:
         """ Copy a file from source to destination """
 
+    @abstractmethod
+    def scan(self, folder: str, recursive: bool = False) -> list:
+        """
+        List the entries in the folder with their metadata in as few calls as possible.
+        Each entry is a dict with path (relative to folder), type ('file' or 'folder'),
+        size, mtime (epoch seconds) and etag. Folders have None for the metadata.
+        """
+
+    def get_version(self, path: str):
+        """ Get a cheap version stamp for a file that changes when the file does
+        None if the file is missing
+        """
+        name = StorageBackend.basename(path)
+        try:
+            entries = self.scan(StorageBackend.dirname(path))
+        except (FileNotFoundError, IOError):
+            return None
+        for entry in entries:
+            if entry["path"] == name and entry["type"] == "file":
+                return entry["etag"]
+        return None
+
+    # Threads used by the default bulk operations
+    BULK_MAX_WORKERS = 16
+
+    def _run_bulk(self, operation, items: list) -> None:
+        """ Run the operation on each item in a thread pool, raise IOError if any failed """
+        if not items:
+            return
+        errors = []
+        workers = min(self.BULK_MAX_WORKERS, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(operation, item) for item in items]:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+        if errors:
+            err_msg = f"{len(errors)} of {len(items)} operations failed, first error: {errors[0]}"
+            raise IOError(err_msg) from errors[0]
+
+    def delete_many(self, paths: list) -> None:
+        """ Delete the files, files that do not exist are ignored """
+
+        def delete(path):
+            try:
+                self.delete(path)
+            except FileNotFoundError:
+                pass
+
+        self._run_bulk(delete, list(paths))
+
+    def copy_many(self, pairs: list) -> None:
+        """ Copy each (source, destination) pair """
+        self._run_bulk(lambda pair: self.copy(pair[0], pair[1]), list(pairs))
+
+    def move_prefix(self, source_folder: str, destination_folder: str) -> int:
+        """ Move every file under the source folder to the destination folder, returns the count """
+        source_folder = source_folder.strip('/')
+        destination_folder = destination_folder.strip('/')
+        if not source_folder:
+            raise ValueError("A source folder is required to move a prefix")
+
+        destination_prefix = f"{destination_folder}/" if destination_folder else ""
+        sources = [entry["path"] for entry in self.scan(source_folder, recursive=True)
+                   if entry["type"] == "file"]
+        self.copy_many([(f"{source_folder}/{path}", f"{destination_prefix}{path}")
+                        for path in sources])
+        self.delete_many([f"{source_folder}/{path}" for path in sources])
+        return len(sources)
+
+    def open_read(self, path: str, encoding: str = None):
+        """
+        Open a file as a read stream, binary unless an encoding is given.
+        Backends without native streaming read the whole file.
+        """
+        return StorageBackend.wrap_stream(io.BytesIO(self.read_binary(path)), encoding)
+
+    def open_write(self, path: str, encoding: str = None):
+        """
+        Open a file as a write stream, binary unless an encoding is given.
+        The file is written when the stream is closed, an exception in a with block discards it.
+        Backends without native streaming write the whole file on close.
+        """
+        writer = StorageWriteBuffer(lambda data: self.write_binary(path, data))
+        return StorageBackend.wrap_stream(writer, encoding)
+
+    @staticmethod
+    def wrap_stream(stream, encoding=None):
+        """ Wrap a binary stream for text if an encoding is given """
+        if encoding is None:
+            return stream
+        if stream.writable():
+            return StorageTextWriter(stream, encoding=encoding)
+        return io.TextIOWrapper(stream, encoding=encoding)
+
+    @staticmethod
+    def make_scan_entry(path, entry_type, size=None, mtime=None, etag=None):
+        """ Build an entry for scan results """
+        return {"path": path, "type": entry_type, "size": size, "mtime": mtime, "etag": etag}
+
+    @staticmethod
+    def make_scan_entries(files, recursive):
+        """
+        Build scan results from (relative path, size, mtime, etag) for every file under a folder.
+        Folders are derived from the paths.
+        """
+        result = []
+        folders = set()
+        for relative_path, size, mtime, etag in files:
+            parts = relative_path.split('/')
+            if not recursive and len(parts) > 1:
+                parts = parts[:2]
+            for index in range(1, len(parts)):
+                folder_path = '/'.join(parts[:index])
+                if folder_path not in folders:
+                    folders.add(folder_path)
+                    result.append(StorageBackend.make_scan_entry(folder_path, "folder"))
+            if recursive or len(parts) == 1:
+                result.append(StorageBackend.make_scan_entry(
+                    relative_path, "file", size=size, mtime=mtime, etag=etag))
+        return result
+
+    @staticmethod
+    def normalize_key(path: str) -> str:
+        """ Normalise a path to a key for stores without real folders """
+        parts = [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+        if '..' in parts:
+            raise ValueError(f"Invalid path: '{path}' - cannot contain '..' ")
+        return '/'.join(parts)
+
+    @staticmethod
+    def make_etag(data: bytes) -> str:
+        """ Content hash used as the etag for stores that keep the data """
+        return hashlib.md5(data, usedforsecurity=False).hexdigest()
+
+    # Backends shared by storage path
+    _instances = {}
+    _instances_lock = threading.Lock()
+
     @staticmethod
     def get_storage(storage_path: str):
-        """ Factory method to return the correct storage class """
+        """ Factory method to return the storage for the path, created once and then shared """
+
+        with StorageBackend._instances_lock:
+            storage = StorageBackend._instances.get(storage_path)
+            if storage is None:
+                storage = StorageBackend._create_storage(storage_path)
+                StorageBackend._instances[storage_path] = storage
+
+        # Done
+        return storage
+
+    @staticmethod
+    def clear_storage_cache():
+        """ Drop the shared backends so the next call creates new ones """
+        with StorageBackend._instances_lock:
+            StorageBackend._instances.clear()
+
+    @staticmethod
+    def _create_storage(storage_path: str):
+        """ Create the correct storage class for the path """
 
         # Check for S3 storage
         if storage_path.startswith("s3::"):
@@ -59,8 +287,35 @@ class StorageBackend(ABC):
                 raise ValueError("Invalid S3 storage path: bucket name is required.")
             s3_path = parts[0]
             region_name = parts[1] if len(parts) > 1 else None
+
+            # Optional local disk cache in front of S3
+            cache_dir = os.getenv('S3_DISK_CACHE_DIR')
+            if cache_dir:
+                # pylint: disable-next=import-outside-toplevel, cyclic-import
+                from utils.cached_s3_storage import CachedS3StorageBackend
+                return CachedS3StorageBackend(
+                    s3_path,
+                    region_name,
+                    cache_dir=cache_dir,
+                    max_bytes=int(float(os.getenv('S3_DISK_CACHE_MAX_MB', '256')) * 1024 * 1024),
+                    max_age_seconds=float(os.getenv('S3_DISK_CACHE_MAX_AGE_SECONDS', '0')))
             return S3StorageBackend(s3_path, region_name)
 
+        # Check for in memory storage
+        if storage_path.startswith("mem::"):
+            # pylint: disable-next=import-outside-toplevel, cyclic-import
+            from utils.mem_storage import MemoryStorageBackend
+            return MemoryStorageBackend(storage_path.removeprefix("mem::"))
+
+        # Check for SQLite storage
+        if storage_path.startswith("sqlite::"):
+            db_path = storage_path.removeprefix("sqlite::")
+            if not db_path:
+                raise ValueError("Invalid SQLite storage path: database file is required.")
+            # pylint: disable-next=import-outside-toplevel, cyclic-import
+            from utils.sqlite_storage import SqliteStorageBackend
+            return SqliteStorageBackend(db_path)
+
         # Check for local storage
         if storage_path.startswith("local::"):
             storage_path = storage_path.removeprefix("local::")
@@ -177,25 +432,110 @@ class LocalStorageBackend(StorageBackend):
         os.makedirs(os.path.dirname(full_destination_path), exist_ok=True)
         shutil.copy2(full_source_path, full_destination_path)
 
+    def get_version(self, path: str):
+        """ Get the stat based etag for a file, None if missing """
+        try:
+            stat = os.stat(self._prep_path(path))
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def move_prefix(self, source_folder: str, destination_folder: str) -> int:
+        """ Move every file under the source folder, a single rename if the destination is new """
+        full_source_path = self._prep_path(source_folder.strip('/'))
+        full_destination_path = self._prep_path(destination_folder.strip('/'))
+        if not source_folder.strip('/') or os.path.exists(full_destination_path) \
+                or not os.path.isdir(full_source_path):
+            return super().move_prefix(source_folder, destination_folder)
+
+        count = len([entry for entry in self.scan(source_folder, recursive=True)
+                     if entry["type"] == "file"])
+        os.makedirs(os.path.dirname(full_destination_path), exist_ok=True)
+        os.rename(full_source_path, full_destination_path)
+        return count
+
+    def open_read(self, path: str, encoding: str = None):
+        """ Open a file as a read stream """
+        full_path = self._prep_path(path)
+        if encoding is None:
+            return open(full_path, "rb") # pylint: disable=consider-using-with
+        return open(full_path, "r", encoding=encoding) # pylint: disable=consider-using-with
+
+    def open_write(self, path: str, encoding: str = None):
+        """ Open a file as a write stream, the file is replaced when the stream is closed
+        and left as it was if a with block exits on an exception
+        """
+        full_path = self._prep_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        return StorageBackend.wrap_stream(LocalFileWriter(full_path), encoding)
+
+    def scan(self, folder: str, recursive: bool = False) -> list:
+        """ List the entries in the folder with metadata using os.scandir
+        The etag is made from the modified time and size so it changes when the file does
+        """
+        full_folder_path = self._prep_path(folder)
+        result = []
+
+        def scan_dir(dir_path, relative_dir):
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    relative_path = f"{relative_dir}{entry.name}"
+                    if entry.is_dir():
+                        result.append(StorageBackend.make_scan_entry(relative_path, "folder"))
+                        if recursive:
+                            scan_dir(entry.path, f"{relative_path}/")
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        result.append(StorageBackend.make_scan_entry(
+                            relative_path, "file",
+                            size=stat.st_size,
+                            mtime=stat.st_mtime,
+                            etag=f"{stat.st_mtime_ns:x}-{stat.st_size:x}"))
+
+        scan_dir(full_folder_path, "")
+        return result
+
 
 class S3StorageBackend(StorageBackend):
     """ S3-based storage backend """
 
+    # Streaming settings
+    MULTIPART_THRESHOLD = 16 * 1024 * 1024
+    MULTIPART_PART_SIZE = 8 * 1024 * 1024
+    MULTIPART_MAX_WORKERS = 4
+    READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+    # Bulk settings, delete_objects takes up to 1000 keys
+    BULK_DELETE_BATCH = 1000
+    BULK_MAX_WORKERS = 32
+
     def __init__(self, path, region_name=None):
         super().__init__()
         parts = path.split('/')
         self.bucket_name = parts[0]
         self.folder = '/'.join(parts[1:]) if len(parts) > 1 else ''
-        self.s3_client = boto3.client('s3', region_name=region_name)
-        self._check_bucket_exists()
+        self.s3_client = AWSUtils.get_client('s3', region_name=region_name)
+        self._bucket_checked = False
+        self._bucket_lock = threading.Lock()
 
     def _check_bucket_exists(self):
-        """ Check if the S3 bucket exists """
-        try:
-            self.s3_client.head_bucket(Bucket=self.bucket_name)
-        except ClientError as exc:
-            err_msg = f"Bucket {self.bucket_name} does not exist or is inaccessible: {exc}"
-            raise ValueError(err_msg) from exc
+        """ Check if the S3 bucket exists, done on first use and again after an error """
+        if self._bucket_checked:
+            return
+
+        with self._bucket_lock:
+            if self._bucket_checked:
+                return
+            try:
+                self.s3_client.head_bucket(Bucket=self.bucket_name)
+            except ClientError as exc:
+                err_msg = f"Bucket {self.bucket_name} does not exist or is inaccessible: {exc}"
+                raise ValueError(err_msg) from exc
+            self._bucket_checked = True
+
+    def _on_client_error(self):
+        """ Recheck the bucket on next use, it may have gone or lost access """
+        self._bucket_checked = False
 
     def _normalize_path(self, path: str) -> str:
         """ Ensure path consistency for S3 keys """
@@ -205,25 +545,37 @@ class S3StorageBackend(StorageBackend):
             normalized = f"{self.folder.rstrip('/')}/{normalized}"
         return normalized
 
-    def read_binary(self, path: str) -> bytes:
-        """ Read a binary file from S3 """
-        key = self._normalize_path(path)
+    def _get_object(self, key: str, **kwargs) -> dict:
+        """ Get the object for the key, raises FileNotFoundError """
+        self._check_bucket_exists()
         try:
-            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-            return response['Body'].read()
+            return self.s3_client.get_object(Bucket=self.bucket_name, Key=key, **kwargs)
         except ClientError as exc:
+            self._on_client_error()
             err_msg = f"Could not read file at {key}: {exc}"
             raise FileNotFoundError(err_msg) from exc
 
-    def write_binary(self, path: str, data: bytes) -> None:
-        """ Write a binary file to S3 """
-        key = self._normalize_path(path)
+    def _put_object(self, key: str, data: bytes) -> dict:
+        """ Put the object for the key, raises IOError """
+        self._check_bucket_exists()
         try:
-            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=data)
+            return self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=data)
         except ClientError as exc:
+            self._on_client_error()
             err_msg = f"Could not write binary data to {key}: {exc}"
             raise IOError(err_msg) from exc
 
+    def read_binary(self, path: str) -> bytes:
+        """ Read a binary file from S3 """
+        key = self._normalize_path(path)
+        response = self._get_object(key)
+        return response['Body'].read()
+
+    def write_binary(self, path: str, data: bytes) -> None:
+        """ Write a binary file to S3 """
+        key = self._normalize_path(path)
+        self._put_object(key, data)
+
     def read_text(self, path: str, encoding: str = "utf-8") -> str:
         """ Read a text file from S3 """
         binary_data = self.read_binary(path)
@@ -248,40 +600,54 @@ class S3StorageBackend(StorageBackend):
     def delete(self, path: str) -> None:
         """ Delete a file in S3 """
         key = self._normalize_path(path)
+        self._check_bucket_exists()
         try:
             self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
         except ClientError as exc:
+            self._on_client_error()
             err_msg = f"Could not delete file at {key}: {exc}"
             raise FileNotFoundError(err_msg) from exc
 
+    def _list_prefix(self, folder: str) -> str:
+        """ Get the key prefix for the direct children of a folder """
+        if folder:
+            return self._normalize_path(folder).rstrip("/") + "/"
+        return self.folder.rstrip("/") + "/" if self.folder else ""
+
+    def _list_pages(self, prefix: str, delimiter='/'):
+        """ Yield list_objects_v2 pages under the prefix, following continuation tokens """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        yield from paginator.paginate(**kwargs)
+
     def _list(self, folder: str, files=True) -> list:
         """ List files in a folder or the root if an empty string is passed """
-        prefix = self._normalize_path(folder).rstrip("/") + "/" if folder else self.folder
+        prefix = self._list_prefix(folder)
+        self._check_bucket_exists()
         try:
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
-            if 'Contents' not in response:
-                return []
-
             result = []
-            for obj in response['Contents']:
-                key = obj['Key']
-                relative_path = key[len(prefix):].lstrip('/')
-                path_parts = relative_path.split('/')
-
-                # Add it if is a file in this directory
-                if files and (len(path_parts) == 1) :
-                    file_name = path_parts[0]
-                    result.append(file_name)
-
-                # Add if its a file in new subfolder
-                elif not files and (len(path_parts) > 1) :
-                    folder_name = path_parts[0]
-                    if folder_name not in result:
-                        result.append(folder_name)
+            for page in self._list_pages(prefix):
+
+                # Objects directly in this folder
+                if files:
+                    for obj in page.get('Contents', []):
+                        file_name = obj['Key'][len(prefix):].lstrip('/')
+                        if file_name:
+                            result.append(file_name)
+
+                # Sub folders are rolled up by the delimiter
+                else:
+                    for common_prefix in page.get('CommonPrefixes', []):
+                        folder_name = common_prefix['Prefix'][len(prefix):].strip('/')
+                        if folder_name:
+                            result.append(folder_name)
 
             # Done
             return result
         except ClientError as exc:
+            self._on_client_error()
             err_msg = f"Could not list files in folder {folder}: {exc}"
             raise IOError(err_msg) from exc
 
@@ -296,6 +662,7 @@ class S3StorageBackend(StorageBackend):
     def file_exists(self, path: str) -> bool:
         """ Check if a file exists in S3 """
         key = self._normalize_path(path)
+        self._check_bucket_exists()
         try:
             self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
             return True
@@ -306,9 +673,139 @@ class S3StorageBackend(StorageBackend):
         """ Copy a file within S3 """
         source_key = self._normalize_path(source_path)
         destination_key = self._normalize_path(destination_path)
+        self._check_bucket_exists()
         try:
             copy_source = {'Bucket': self.bucket_name, 'Key': source_key}
             self.s3_client.copy(copy_source, self.bucket_name, destination_key)
         except ClientError as exc:
+            self._on_client_error()
             err_msg = f"Could not copy {source_key} to {destination_key}: {exc}"
             raise IOError(err_msg) from exc
+
+    def get_version(self, path: str):
+        """ Get the ETag for a file, None if missing """
+        key = self._normalize_path(path)
+        self._check_bucket_exists()
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError:
+            return None
+        return response['ETag'].strip('"')
+
+    def delete_many(self, paths: list) -> None:
+        """ Delete the files in delete_objects batches """
+        keys = [self._normalize_path(path) for path in paths]
+        if not keys:
+            return
+        self._check_bucket_exists()
+
+        def delete_batch(batch):
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            errors = response.get('Errors', [])
+            if errors:
+                first = errors[0]
+                message = first.get('Message', first['Code'])
+                raise IOError(f"Could not delete {first['Key']}: {message}")
+
+        batches = [keys[index:index + self.BULK_DELETE_BATCH]
+                   for index in range(0, len(keys), self.BULK_DELETE_BATCH)]
+        try:
+            self._run_bulk(delete_batch, batches)
+        except IOError:
+            self._on_client_error()
+            raise
+
+    def copy_many(self, pairs: list) -> None:
+        """ Copy each (source, destination) pair with concurrent server side copies
+        Managed copies are used so objects over the 5 GB copy_object limit are copied in parts
+        """
+        self._check_bucket_exists()
+
+        def copy(pair):
+            source_key = self._normalize_path(pair[0])
+            destination_key = self._normalize_path(pair[1])
+            try:
+                copy_source = {'Bucket': self.bucket_name, 'Key': source_key}
+                self.s3_client.copy(copy_source, self.bucket_name, destination_key)
+            except ClientError as exc:
+                err_msg = f"Could not copy {source_key} to {destination_key}: {exc}"
+                raise IOError(err_msg) from exc
+
+        try:
+            self._run_bulk(copy, list(pairs))
+        except IOError:
+            self._on_client_error()
+            raise
+
+    def open_read(self, path: str, encoding: str = None):
+        """ Open a file as a read stream using ranged GETs """
+        key = self._normalize_path(path)
+        self._check_bucket_exists()
+        try:
+            reader = S3RangeReader(self.s3_client, self.bucket_name, key)
+        except ClientError as exc:
+            self._on_client_error()
+            err_msg = f"Could not read file at {key}: {exc}"
+            raise FileNotFoundError(err_msg) from exc
+        stream = io.BufferedReader(reader, buffer_size=self.READ_CHUNK_SIZE)
+        return StorageBackend.wrap_stream(stream, encoding)
+
+    def open_write(self, path: str, encoding: str = None):
+        """ Open a file as a write stream, large files use a parallel multipart upload """
+        key = self._normalize_path(path)
+        self._check_bucket_exists()
+        writer = S3MultipartWriter(
+            self.s3_client,
+            self.bucket_name,
+            key,
+            part_size=self.MULTIPART_PART_SIZE,
+            threshold=self.MULTIPART_THRESHOLD,
+            max_workers=self.MULTIPART_MAX_WORKERS,
+            on_commit=lambda response: self._stream_written(key, response))
+        return StorageBackend.wrap_stream(writer, encoding)
+
+    def _stream_written(self, key: str, response: dict) -> None:
+        """ Called when a write stream has been committed """
+
+    def scan(self, folder: str, recursive: bool = False) -> list:
+        """ List the entries in the folder with metadata from the listing pages """
+        prefix = self._list_prefix(folder)
+        self._check_bucket_exists()
+        try:
+            result = []
+            folders = set()
+
+            def add_folder(folder_path):
+                if folder_path and folder_path not in folders:
+                    folders.add(folder_path)
+                    result.append(StorageBackend.make_scan_entry(folder_path, "folder"))
+
+            for page in self._list_pages(prefix, delimiter=None if recursive else '/'):
+                for common_prefix in page.get('CommonPrefixes', []):
+                    add_folder(common_prefix['Prefix'][len(prefix):].strip('/'))
+
+                for obj in page.get('Contents', []):
+                    relative_path = obj['Key'][len(prefix):].lstrip('/')
+                    if not relative_path or relative_path.endswith('/'):
+                        add_folder(relative_path.rstrip('/'))
+                        continue
+
+                    # Recursive listings have no common prefixes, derive the folders
+                    parts = relative_path.split('/')
+                    for index in range(1, len(parts)):
+                        add_folder('/'.join(parts[:index]))
+
+                    result.append(StorageBackend.make_scan_entry(
+                        relative_path, "file",
+                        size=obj['Size'],
+                        mtime=obj['LastModified'].timestamp(),
+                        etag=obj['ETag'].strip('"')))
+
+            # Done
+            return result
+        except ClientError as exc:
+            self._on_client_error()
+            err_msg = f"Could not scan folder {folder}: {exc}"
+            raise IOError(err_msg) from exc
@@ -0,0 +1,179 @@
+""" Map reduce summarisation for text too large for a single prompt """
+import re
+from concurrent.futures import ThreadPoolExecutor
+from utils.langchain_utils import LangChainUtils
+from utils.llm_scheduling import LLMCallPriority
+from utils.flow_utils import FlowUtils
+
+
+class MapReduceSummariser: # pylint: disable=too-many-instance-attributes
+    """ Splits text into token sized chunks, summarises them in parallel and then
+    reduces the partial summaries hierarchically until they fit in one chunk
+    """
+
+    DEFAULT_MAP_PROMPT = (
+        "You are summarising one part of a larger body of text. "
+        "Summarise the text you are given, keeping all names, numbers, dates, "
+        "decisions and open issues. Do not add any preamble."
+    )
+
+    DEFAULT_REDUCE_PROMPT = (
+        "You are given partial summaries of consecutive parts of a larger body of text. "
+        "Combine them into one summary, removing repetition but keeping all names, "
+        "numbers, dates, decisions and open issues. Do not add any preamble."
+    )
+
+    def __init__( # pylint: disable=too-many-arguments
+            self,
+            chat_model,
+            *,
+            chunk_tokens=4000,
+            max_concurrency=4,
+            map_prompt=None,
+            reduce_prompt=None,
+            max_levels=5,
+            max_input_tokens=None,
+            priority=LLMCallPriority.BATCH):
+
+        if chunk_tokens < 1:
+            raise ValueError(f"chunk_tokens must be at least 1, got {chunk_tokens}")
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+
+        self.chat_model = chat_model
+        self.chunk_tokens = chunk_tokens
+        self.max_concurrency = max_concurrency
+        self.map_prompt = map_prompt or MapReduceSummariser.DEFAULT_MAP_PROMPT
+        self.reduce_prompt = reduce_prompt or MapReduceSummariser.DEFAULT_REDUCE_PROMPT
+        self.max_levels = max_levels
+        self.max_input_tokens = max_input_tokens
+        self.priority = priority
+
+    @staticmethod
+    def split_text(text, chunk_tokens):
+        """ Split the text into chunks of at most chunk_tokens estimated tokens
+        Splits on line boundaries, long lines are split on words
+        """
+
+        # Work in words so the chunk estimate matches FlowUtils.estimate_tokens
+        max_words = max(1, int(chunk_tokens / 1.3))
+        chunks = []
+        current = []
+        current_words = 0
+
+        def flush():
+            """ Close off the current chunk """
+            nonlocal current, current_words
+            if current:
+                chunks.append('\n'.join(current))
+            current = []
+            current_words = 0
+
+        for line in text.split('\n'):
+            line_words = len(re.findall(r'\w+', line))
+
+            # Line too big on its own - split on spaces
+            if line_words > max_words:
+                flush()
+                for word in line.split(' '):
+                    word_count = len(re.findall(r'\w+', word))
+                    if current and current_words + word_count > max_words:
+                        chunks.append(' '.join(current))
+                        current = []
+                        current_words = 0
+                    current.append(word)
+                    current_words += word_count
+                if current:
+                    chunks.append(' '.join(current))
+                current = []
+                current_words = 0
+                continue
+
+            # Start a new chunk if this line would overflow
+            if current_words + line_words > max_words:
+                flush()
+            current.append(line)
+            current_words += line_words
+
+        flush()
+
+        # Done
+        return chunks
+
+    def group_summaries(self, summaries):
+        """ Group consecutive summaries so each group fits in a chunk """
+
+        groups = []
+        current = []
+        current_tokens = 0
+        for summary in summaries:
+            summary_tokens = FlowUtils.estimate_tokens(summary)
+            if current and current_tokens + summary_tokens > self.chunk_tokens:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(summary)
+            current_tokens += summary_tokens
+        if current:
+            groups.append(current)
+
+        # Done
+        return groups
+
+    def fit_to_input(self, summaries):
+        """ Cut the summaries to an equal share each of max_input_tokens, so they can be
+        reduced in one call. Returned as is if there is no limit
+        """
+        if self.max_input_tokens is None:
+            return summaries
+        share = max(1, self.max_input_tokens // len(summaries))
+        return [MapReduceSummariser.split_text(summary, share)[0] for summary in summaries]
+
+    def _summarise_all(self, system_prompt, texts):
+        """ Summarise each of the texts in parallel, preserving order """
+
+        def summarise(text):
+            return LangChainUtils.simple_prompt_response(
+                self.chat_model, system_prompt, text, self.priority)
+
+        if not texts:
+            return []
+        workers = min(self.max_concurrency, len(texts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(summarise, texts))
+
+    def summarise(self, text, on_progress=None):
+        """ Summarise the text, on_progress is called with a message after each level """
+
+        def progress(message):
+            if on_progress is not None:
+                on_progress(message)
+
+        # Nothing to do
+        if not text.strip():
+            return ''
+
+        # Map
+        chunks = MapReduceSummariser.split_text(text, self.chunk_tokens)
+        summaries = self._summarise_all(self.map_prompt, chunks)
+        progress(f"Summarised {len(chunks)} chunks")
+
+        # Reduce until we have one summary
+        level = 0
+        while len(summaries) > 1:
+            level += 1
+            groups = self.group_summaries(summaries)
+
+            # Stop if a level would not merge anything, or we are out of levels,
+            # and join what will fit in the model's input as the final reduction
+            if len(groups) == len(summaries) or level > self.max_levels:
+                groups = [self.fit_to_input(summaries)]
+
+            # Only groups with more than one summary need reducing
+            to_reduce = ['\n\n'.join(group) for group in groups if len(group) > 1]
+            reduced = iter(self._summarise_all(self.reduce_prompt, to_reduce))
+            summaries = [next(reduced) if len(group) > 1 else group[0] for group in groups]
+            progress(f"Reduced to {len(summaries)} summaries")
+
+        # Done
+        return summaries[0]
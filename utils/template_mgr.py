@@ -1,33 +1,505 @@
 """ Utility class to handle browsing and loading of flow templates """
 import os
+import json
+import time
+import pickle
+import hashlib
 import logging
+import threading
+import yaml
 from utils.yaml_utils import YAMLUtils
 from utils.config_utils import ConfigStore
 from utils.storage_utils import StorageBackend
 
+
+class CompiledTemplateCache:
+    """ Loaded and resolved templates shared across sessions
+
+    Entries are keyed by the template and hold the version of every file read to build
+    them, they are reused until one of those files changes. Versions are checked at most
+    every check_interval_seconds. Templates are held pickled so each caller gets its own
+    copy to change, unpickling is much cheaper than reading and resolving the YAML again.
+    """
+
+    def __init__(self, check_interval_seconds=2.0):
+        self.check_interval_seconds = check_interval_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sources_current(sources):
+        """ Check none of the (store, path, version) sources have changed """
+        return all(store.get_version(path) == version for store, path, version in sources)
+
+    def get(self, key, load):
+        """ Get the template for the key, load(sources) is called to build it when needed
+        load should append each (store, path, version) it reads to sources, with the version
+        taken before the read so a file changed while loading is reloaded next time
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        # Reuse if recently checked or still current
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry["checked"] < self.check_interval_seconds or \
+                    CompiledTemplateCache._sources_current(entry["sources"]):
+                entry["checked"] = now
+                with self._lock:
+                    self.hits += 1
+                return pickle.loads(entry["data"])
+
+        # Build, load records the versions of everything read
+        sources = []
+        data = load(sources)
+        entry = {
+            "data": pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+            "sources": sources,
+            "checked": time.monotonic(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self.misses += 1
+
+        # Done
+        return pickle.loads(entry["data"])
+
+    def clear(self):
+        """ Drop all entries and reset the counters """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class TemplateCatalog:
+    """ Index of the template groups and templates with just the fields needed to list them
+
+    The stores are given by label, "templates" and "lib". The catalog is kept in memory
+    and, if a cache (store, path) is given, saved there so a new process can start from
+    it, the templates store is never written to. At most every check_interval_seconds
+    each group folder is listed, one level deep, and the other files a template was built
+    from are checked with get_version. Only templates whose files changed are loaded again.
+    """
+
+    CATALOG_VERSION = 2
+
+    # Fields kept for listing with their defaults
+    META_FIELDS = {"icon": "", "title": "", "description": ""}
+    TEMPLATE_FIELDS = {"title": "", "description": "", "enabled": False}
+
+    def __init__(self, stores, yaml_utils, check_interval_seconds=10.0, cache=None):
+        self.stores = stores
+        self.yaml_utils = yaml_utils
+        self.check_interval_seconds = check_interval_seconds
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._checked = None
+
+    def _load_persisted(self):
+        """ Read the saved catalog, empty if there is none or it is from another version """
+        if self.cache is not None:
+            cache_store, cache_path = self.cache
+            try:
+                catalog = json.loads(cache_store.read_text(cache_path))
+                if catalog.get("version") == TemplateCatalog.CATALOG_VERSION:
+                    return catalog
+            except (IOError, ValueError):
+                pass
+        return {"version": TemplateCatalog.CATALOG_VERSION, "groups": {}, "templates": {}}
+
+    def _persist(self, catalog):
+        """ Save the catalog to the cache store if there is one """
+        if self.cache is None:
+            return
+        cache_store, cache_path = self.cache
+        try:
+            cache_store.write_text(cache_path, json.dumps(catalog))
+        except (IOError, OSError) as e:
+            logging.warning(f"Could not save template catalog: {e}")
+
+    def _list_group_files(self):
+        """ Versions of the meta and template files in the group folders, one listing each """
+        store = self.stores["templates"]
+        versions = {}
+        for folder in store.scan(''):
+            if folder["type"] != "folder":
+                continue
+            for entry in store.scan(folder["path"]):
+                path = f'{folder["path"]}/{entry["path"]}'
+                if entry["type"] == "file" and (
+                        TemplateCatalog.is_template_path(path) or entry["path"] == '_meta.yaml'):
+                    versions[path] = entry["etag"]
+        return versions
+
+    def _load_entry(self, file_path, fields):
+        """ Load a template and keep the fields and the versions of the files it was built from """
+        labels = {id(store): label for label, store in self.stores.items()}
+        sources = []
+        data = self.yaml_utils.load_yaml(file_path, sources)
+        if not data:
+            return None
+        entry = {field: data.get(field, default) for field, default in fields.items()}
+        entry["sources"] = [[labels[id(store)], path, version] for store, path, version in sources]
+        return entry
+
+    def _refresh(self, catalog):
+        """ Bring the catalog up to date, returns True if anything changed """
+
+        # Group files come from the listings, anything else is checked once when needed
+        group_files = self._list_group_files()
+        checked = {("templates", path): version for path, version in group_files.items()}
+
+        def get_version(label, path):
+            if (label, path) not in checked:
+                checked[(label, path)] = self.stores[label].get_version(path)
+            return checked[(label, path)]
+
+        def current(entry):
+            return entry is not None and all(
+                get_version(label, path) == version for label, path, version in entry["sources"])
+
+        # Group meta data
+        groups = {}
+        for meta_file in sorted(path for path in group_files if path.endswith('/_meta.yaml')):
+            folder = meta_file.split('/')[0]
+            entry = catalog["groups"].get(folder)
+            if not current(entry):
+                entry = self._load_entry(meta_file, TemplateCatalog.META_FIELDS)
+            if entry is not None:
+                groups[folder] = entry
+
+        # Templates directly in each group folder
+        templates = {}
+        for path in sorted(group_files):
+            if not TemplateCatalog.is_template_path(path):
+                continue
+            folder, file_name = path.split('/')
+            item_key = os.path.splitext(file_name)[0]
+            entry = catalog["templates"].get(folder, {}).get(item_key)
+            if not current(entry):
+                entry = self._load_entry(path, TemplateCatalog.TEMPLATE_FIELDS)
+            if entry is None:
+                logging.error(f"Could not load flow template '{path}'")
+                continue
+            templates.setdefault(folder, {})[item_key] = entry
+
+        # Done
+        changed = groups != catalog["groups"] or templates != catalog["templates"]
+        catalog["groups"] = groups
+        catalog["templates"] = templates
+        return changed
+
+    def get_catalog(self):
+        """ Get the up to date catalog, callers must not change it """
+        with self._lock:
+            now = time.monotonic()
+            if self._catalog is not None and now - self._checked < self.check_interval_seconds:
+                return self._catalog
+
+            catalog = self._catalog if self._catalog is not None else self._load_persisted()
+            if self._refresh(catalog):
+                self._persist(catalog)
+            self._catalog = catalog
+            self._checked = now
+            return catalog
+
+    @staticmethod
+    def is_template_path(path):
+        """ Check the path is a template directly in a group folder """
+        parts = path.split('/')
+        return len(parts) == 2 and parts[1].endswith('.yaml') and not parts[1].startswith('_')
+
+    @staticmethod
+    def strip_sources(entries):
+        """ Copy the entries without the source versions """
+        return {key: {field: value for field, value in entry.items() if field != "sources"}
+                for key, entry in entries.items()}
+
+
+class TemplateBundle:
+    """ Every template and group compiled ahead of time into one JSON file
+
+    The bundle records a hash of every file used to build it. It is used while the
+    templates and includes still match those hashes, otherwise callers fall back to
+    the live files. Freshness is checked against one listing of each store, files are
+    only read and hashed when their version differs from the one in the bundle.
+    Templates JSON can't hold exactly, such as ones with dates or non string keys, are
+    listed in the bundle but always loaded from the live files.
+    """
+
+    BUNDLE_FILE = '_bundle.json'
+    BUNDLE_VERSION = 2
+
+    def __init__(self, use_case_templates_store, templates_include_lib_store,
+                 check_interval_seconds=10.0):
+        self.stores = {"templates": use_case_templates_store, "lib": templates_include_lib_store}
+        self.check_interval_seconds = check_interval_seconds
+        self._lock = threading.Lock()
+
+        # Bundle file version last read, its content and its compiled templates pickled
+        self._loaded = {"version": None, "bundle": None, "compiled": {}}
+        self._fresh = False
+        self._checked = None
+
+    @staticmethod
+    def _hash(data):
+        """ Content hash of a file """
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def _compile(labels, paths, yaml_utils):
+        """ Load the templates, labels gives the label of each store by id
+        Returns the loaded data, the data kept as compiled, the paths always loaded live
+        and the [version, hash] of every file used by label and path
+        """
+        loaded = {}
+        compiled = {}
+        live = []
+        files = {"templates": {}, "lib": {}}
+        for path in paths:
+            sources = []
+            try:
+                data = yaml_utils.load_yaml(path, sources)
+            except (ValueError, yaml.YAMLError) as e:
+                raise ValueError(f"Could not compile template '{path}': {e}") from e
+            loaded[path] = data
+            if TemplateBundle._json_round_trips(data):
+                compiled[path] = data
+            else:
+                logging.warning(f"Template '{path}' can't be kept as JSON, it will be loaded live")
+                live.append(path)
+            for store, source_path, version in sources:
+                label_files = files[labels[id(store)]]
+                if source_path not in label_files:
+                    label_files[source_path] = [
+                        version, TemplateBundle._hash(store.read_binary(source_path))]
+
+        # Done
+        return loaded, compiled, live, files
+
+    @staticmethod
+    def _listing(loaded):
+        """ The groups and templates listing built from the loaded data """
+        groups = {}
+        templates = {}
+        for path, data in loaded.items():
+            folder, file_name = path.split('/')
+            if file_name == '_meta.yaml':
+                if data:
+                    groups[folder] = {field: data.get(field, default)
+                                      for field, default in TemplateCatalog.META_FIELDS.items()}
+            elif data:
+                templates.setdefault(folder, {})[os.path.splitext(file_name)[0]] = {
+                    field: data.get(field, default)
+                    for field, default in TemplateCatalog.TEMPLATE_FIELDS.items()}
+        return groups, templates
+
+    @staticmethod
+    def build(use_case_templates_store, templates_include_lib_store, yaml_utils):
+        """ Compile every template and group meta file into a bundle dict
+        Raises ValueError if a template can't be loaded
+        """
+        labels = {id(use_case_templates_store): "templates",
+                  id(templates_include_lib_store): "lib"}
+
+        # Every template and meta file in the group folders
+        paths = sorted(
+            entry["path"] for entry in use_case_templates_store.scan('', recursive=True)
+            if entry["type"] == "file" and (TemplateCatalog.is_template_path(entry["path"]) or
+                                            entry["path"].endswith('/_meta.yaml'))
+            and entry["path"].count('/') == 1)
+        loaded, compiled, live, files = TemplateBundle._compile(labels, paths, yaml_utils)
+        groups, templates = TemplateBundle._listing(loaded)
+
+        # One hash for the whole bundle
+        content_hash = TemplateBundle._hash('\n'.join(
+            f"{label}:{path}:{files[label][path][1]}"
+            for label in sorted(files) for path in sorted(files[label])).encode('utf-8'))
+
+        # Done
+        return {
+            "version": TemplateBundle.BUNDLE_VERSION,
+            "content_hash": content_hash,
+            "files": files,
+            "groups": groups,
+            "templates": templates,
+            "compiled": compiled,
+            "live": live,
+        }
+
+    @staticmethod
+    def _json_round_trips(data):
+        """ Check the data comes back the same from JSON, keys and types included """
+        try:
+            return json.loads(json.dumps(data)) == data
+        except (TypeError, ValueError):
+            return False
+
+    def _load(self):
+        """ Read the bundle file if it changed since it was last read """
+        store = self.stores["templates"]
+        version = store.get_version(TemplateBundle.BUNDLE_FILE)
+        if version == self._loaded["version"]:
+            return
+        self._loaded = {"version": version, "bundle": None, "compiled": {}}
+        if version is None:
+            return
+        try:
+            bundle = json.loads(store.read_text(TemplateBundle.BUNDLE_FILE))
+        except (FileNotFoundError, IOError, ValueError) as e:
+            logging.warning(f"Could not read template bundle: {e}")
+            return
+        if bundle.get("version") != TemplateBundle.BUNDLE_VERSION:
+            logging.warning("Ignoring template bundle from another version")
+            return
+        self._loaded["bundle"] = bundle
+        self._loaded["compiled"] = {
+            path: pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            for path, data in bundle["compiled"].items()}
+
+    def _is_current(self, bundle):
+        """ Check the bundle was built from the files in the stores now """
+        versions = {
+            label: {entry["path"]: entry["etag"] for entry in store.scan('', recursive=True)
+                    if entry["type"] == "file"}
+            for label, store in self.stores.items()}
+
+        # Templates added or removed
+        paths = {path for path in versions["templates"] if path.count('/') == 1 and (
+            TemplateCatalog.is_template_path(path) or path.endswith('/_meta.yaml'))}
+        if paths != set(bundle["compiled"]) | set(bundle["live"]):
+            return False
+
+        # Changed files, a different version may still have the same content
+        for label, files in bundle["files"].items():
+            for path, record in files.items():
+                version = versions[label].get(path)
+                if version is None:
+                    return False
+                if version != record[0]:
+                    content = self.stores[label].read_binary(path)
+                    if TemplateBundle._hash(content) != record[1]:
+                        return False
+                    record[0] = version
+
+        # Done
+        return True
+
+    def get(self):
+        """ Get the bundle if it matches the live files, otherwise None """
+        with self._lock:
+            now = time.monotonic()
+            if self._checked is None or now - self._checked >= self.check_interval_seconds:
+                self._load()
+                bundle = self._loaded["bundle"]
+                self._fresh = bundle is not None and self._is_current(bundle)
+                if bundle is not None and not self._fresh:
+                    logging.warning("Template bundle is stale, using the template files")
+                self._checked = now
+            return self._loaded["bundle"] if self._fresh else None
+
+    def get_template(self, file_path):
+        """ Get a copy of a compiled template, None if the bundle is stale or doesn't have it """
+        if self.get() is None:
+            return None
+        data = self._loaded["compiled"].get(file_path)
+        return pickle.loads(data) if data is not None else None
+
+
 class TemplateManager:
     """A class to manage YAML templates and groups."""
 
+    # Catalogs and bundles shared by all sessions, keyed by the store paths
+    _catalogs = {}
+    _bundles = {}
+    _catalogs_lock = threading.Lock()
+
+    # Shared by all sessions
+    compiled_templates = CompiledTemplateCache(
+        check_interval_seconds=float(os.getenv('TEMPLATE_CACHE_CHECK_SECONDS', '2')))
+
     def __init__(self):
         self.base_dir = os.getcwd()
 
         # Create the storage objects defined in config
 
         # Templates
-        use_case_templates_path = ConfigStore.nested_get('paths.use_case_templates')
-        self.use_case_templates_store = StorageBackend.get_storage(use_case_templates_path)
+        self.use_case_templates_path = ConfigStore.nested_get('paths.use_case_templates')
+        self.use_case_templates_store = StorageBackend.get_storage(self.use_case_templates_path)
 
         # Template includes
-        templates_include_lib_path = ConfigStore.nested_get('paths.templates_include_lib')
-        self.templates_include_lib_store = StorageBackend.get_storage(templates_include_lib_path)
+        self.templates_include_lib_path = ConfigStore.nested_get('paths.templates_include_lib')
+        self.templates_include_lib_store = StorageBackend.get_storage(
+            self.templates_include_lib_path)
 
         self.yaml_utils = YAMLUtils(self.use_case_templates_store, self.templates_include_lib_store)
 
     def _load_yaml_file(self, file_path):
         """Load the YAML file with includes and reference resolution."""
 
-        data = self.yaml_utils.load_yaml(file_path)
-        return data
+        # Prebuilt if there is a current bundle
+        data = self.get_bundle().get_template(file_path)
+        if data is not None:
+            return data
+
+        key = (self.use_case_templates_path, self.templates_include_lib_path, file_path)
+        return TemplateManager.compiled_templates.get(
+            key,
+            lambda sources: self.yaml_utils.load_yaml(file_path, sources))
+
+    @staticmethod
+    def clear_caches():
+        """ Drop the shared compiled templates, catalogs, bundles and loaded YAML """
+        TemplateManager.compiled_templates.clear()
+        YAMLUtils.clear_caches()
+        with TemplateManager._catalogs_lock:
+            TemplateManager._catalogs.clear()
+            TemplateManager._bundles.clear()
+
+    def get_bundle(self):
+        """ Get the shared template bundle for the configured stores """
+        key = (self.use_case_templates_path, self.templates_include_lib_path)
+        with TemplateManager._catalogs_lock:
+            bundle = TemplateManager._bundles.get(key)
+            if bundle is None:
+                bundle = TemplateBundle(
+                    self.use_case_templates_store,
+                    self.templates_include_lib_store,
+                    check_interval_seconds=float(os.getenv('TEMPLATE_BUNDLE_CHECK_SECONDS', '10')))
+                TemplateManager._bundles[key] = bundle
+        return bundle
+
+    def build_bundle(self):
+        """ Compile all the templates and save them as the bundle, returns the bundle """
+        bundle = TemplateBundle.build(
+            self.use_case_templates_store, self.templates_include_lib_store, self.yaml_utils)
+        self.use_case_templates_store.write_text(TemplateBundle.BUNDLE_FILE, json.dumps(bundle))
+        return bundle
+
+    def get_catalog(self):
+        """ Get the shared catalog for the configured stores """
+        key = (self.use_case_templates_path, self.templates_include_lib_path)
+        with TemplateManager._catalogs_lock:
+            catalog = TemplateManager._catalogs.get(key)
+            if catalog is None:
+                # Saved in the cache store if one is set, like local:: or sqlite::,
+                # otherwise only kept in memory by the shared catalog
+                cache_store_path = os.getenv('TEMPLATE_CATALOG_STORE')
+                cache_name = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+                catalog = TemplateCatalog(
+                    {"templates": self.use_case_templates_store,
+                     "lib": self.templates_include_lib_store},
+                    self.yaml_utils,
+                    check_interval_seconds=float(os.getenv('TEMPLATE_CATALOG_CHECK_SECONDS', '10')),
+                    cache=(StorageBackend.get_storage(cache_store_path),
+                           f"catalog-{cache_name}.json") if cache_store_path else None)
+                TemplateManager._catalogs[key] = catalog
+        return catalog.get_catalog()
 
     def load_template(self, template):
         """ Load the named template """
@@ -36,40 +508,16 @@ class TemplateManager:
         return self._load_yaml_file(file_path)
 
 
+    def get_listing(self):
+        """ Get the groups and templates from the bundle if current, otherwise the catalog """
+        bundle = self.get_bundle().get()
+        return bundle if bundle is not None else self.get_catalog()
+
     def generate_groups(self):
         """Generate groups of templates for the user to start a session."""
-        options = {}
-
-        folders = self.use_case_templates_store.list_folders('')
-        for folder in folders:
-            meta_file = f'{folder}/_meta.yaml'
-            if self.use_case_templates_store.file_exists(meta_file):
-                meta_data = self._load_yaml_file(meta_file)
-                options[folder] = {
-                    "icon": meta_data.get("icon", ""),
-                    "title": meta_data.get("title", ""),
-                    "description": meta_data.get("description", "")
-                }
-
-        return options
+        return TemplateCatalog.strip_sources(self.get_listing()["groups"])
 
     def get_group_templates(self, subfolder):
         """Get the templates in a specific group."""
-        items = {}
-        file_names = self.use_case_templates_store.list_files(subfolder)
-        for file_name in file_names:
-            if file_name.endswith('.yaml') and not file_name.startswith('_'):
-                file_path = f"{subfolder}/{file_name}"
-                item_data = self._load_yaml_file(file_path)
-                if item_data:
-                    # Use the filename (without extension) as the key
-                    item_key = os.path.splitext(file_name)[0]
-                    items[item_key] = {
-                        "title": item_data.get("title", ""),
-                        "description": item_data.get("description", ""),
-                        "enabled": item_data.get("enabled", False)
-                    }
-                else:
-                    logging.error(f"Could not load flow template '{file_path}'")
-        # Done
-        return items
+        templates = self.get_listing()["templates"].get(subfolder, {})
+        return TemplateCatalog.strip_sources(templates)
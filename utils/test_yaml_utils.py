@@ -3,6 +3,7 @@ import os
 import tempfile
 import shutil
 import unittest
+from unittest.mock import patch
 from utils.yaml_utils import YAMLUtils, YAMLKeyResolver
 from utils.storage_utils import StorageBackend
 
@@ -219,10 +220,45 @@ class TestYAMLKeyResolver(unittest.TestCase):
         with self.assertRaises(ValueError):
             resolver.resolve(data)
 
+    def test_shared_references_are_independent(self):
+        data = {
+            "templates": {
+                "base": {"options": {"a": 1}, "items": [1, 2]},
+                "derived": {"$ref": "#/templates/base", "options": {"b": 2}}
+            },
+            "first": {"$ref": "#/templates/derived"},
+            "second": {"$allOf": "#/templates/derived", "options": {"c": 3}},
+            "third": {"$ref": "#/templates/base"}
+        }
+
+        resolved = self.resolver.resolve(data)
+        self.assertEqual(resolved["first"], {"options": {"a": 1, "b": 2}, "items": [1, 2]})
+        self.assertEqual(resolved["second"]["options"], {"a": 1, "b": 2, "c": 3})
+        self.assertEqual(resolved["third"], {"options": {"a": 1}, "items": [1, 2]})
+
+        # Changing one use does not change the others or the source
+        resolved["first"]["options"]["a"] = 99
+        resolved["first"]["items"].append(3)
+        self.assertEqual(resolved["third"], {"options": {"a": 1}, "items": [1, 2]})
+        self.assertEqual(resolved["templates"]["derived"]["options"], {"a": 1, "b": 2})
+        self.assertEqual(data["templates"]["base"], {"options": {"a": 1}, "items": [1, 2]})
+
+    def test_each_reference_resolved_once(self):
+        data = {"fragment": {"$ref": "#/base"}, "base": {"value": 1}}
+        data.update({f"use{index}": {"$ref": "#/fragment"} for index in range(50)})
+
+        resolver = YAMLKeyResolver()
+        with patch.object(resolver, '_get_by_path', wraps=resolver._get_by_path) as mock_get:
+            resolved = resolver.resolve(data)
+        self.assertEqual(resolved["use49"], {"value": 1})
+        self.assertEqual(mock_get.call_count, 51)
+
 
 class TestYAMLUtils(unittest.TestCase):
     def setUp(self):
 
+        YAMLUtils.clear_caches()
+
         # Create directories
         self.test_dir = tempfile.mkdtemp()
         self.lib_dir = os.path.join(self.test_dir, 'lib')
@@ -341,6 +377,55 @@ class TestYAMLUtils(unittest.TestCase):
 
         result = self.yaml_utils.load_yaml_with_includes('main.yaml')
         self.assertEqual(result, {'key': 'value', 'lib_key': 'lib_value'})
+    def test_include_cache(self):
+        with open(os.path.join(self.lib_dir, 'shared.yaml'), 'w', encoding='utf-8') as f:
+            f.write("shared: one")
+        for name in ['first', 'second']:
+            with open(os.path.join(self.test_dir, f'{name}.yaml'), 'w', encoding='utf-8') as f:
+                f.write(f"name: {name}\n#!lib_include shared.yaml")
+
+        # The include is read once for both templates
+        store = self.yaml_utils.templates_include_lib_store
+        with patch.object(store, 'read_text', wraps=store.read_text) as mock_read:
+            self.assertEqual(self.yaml_utils.load_yaml_with_includes('first.yaml'),
+                             {'name': 'first', 'shared': 'one'})
+            self.assertEqual(self.yaml_utils.load_yaml_with_includes('second.yaml'),
+                             {'name': 'second', 'shared': 'one'})
+            self.assertEqual(mock_read.call_count, 1)
+
+        # A changed include is read again
+        with open(os.path.join(self.lib_dir, 'shared.yaml'), 'w', encoding='utf-8') as f:
+            f.write("shared: two and longer")
+        self.assertEqual(self.yaml_utils.load_yaml_with_includes('first.yaml'),
+                         {'name': 'first', 'shared': 'two and longer'})
+
+    def test_template_cache(self):
+        with open(os.path.join(self.lib_dir, 'shared.yaml'), 'w', encoding='utf-8') as f:
+            f.write("shared: one")
+        with open(os.path.join(self.test_dir, 'main.yaml'), 'w', encoding='utf-8') as f:
+            f.write("name: main\n#!lib_include shared.yaml\n#!lib_include shared.yaml")
+        self.assertEqual(self.yaml_utils.load_yaml('main.yaml'), {'name': 'main', 'shared': 'one'})
+
+        # Reused without reading, each file version checked once and the caller gets a copy
+        stores = [self.yaml_utils.use_case_templates_store,
+                  self.yaml_utils.templates_include_lib_store]
+        with patch.object(stores[0], 'read_text') as mock_read, \
+                patch.object(stores[1], 'get_version', wraps=stores[1].get_version) as mock_version:
+            sources = []
+            data = self.yaml_utils.load_yaml('main.yaml', sources)
+            data['name'] = 'changed'
+            self.assertEqual(self.yaml_utils.load_yaml('main.yaml')['name'], 'main')
+            mock_read.assert_not_called()
+            self.assertEqual(mock_version.call_count, 2)
+            self.assertEqual([path for _, path, _ in sources],
+                             ['main.yaml', 'shared.yaml', 'shared.yaml'])
+
+        # A changed include is loaded again
+        with open(os.path.join(self.lib_dir, 'shared.yaml'), 'w', encoding='utf-8') as f:
+            f.write("shared: two and longer")
+        self.assertEqual(self.yaml_utils.load_yaml('main.yaml'),
+                         {'name': 'main', 'shared': 'two and longer'})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,15 @@
 # pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
 import unittest
 from unittest.mock import MagicMock, patch
-from utils.step_utils import BaseFlowStep, StepConfigException
+from utils.step_utils import BaseFlowStep, FormatPromptStep
+from utils.step_status import StepConfigException, StepStatus
+from utils.flow_plan import FlowPlan, StepStatusEvaluator
 from utils.app_utils import BaseFlowApp
 
 class TestBaseFlowApp(unittest.TestCase):
 
     def setUp(self):
+        FlowPlan.clear()
         self.config = {
             'title': 'Test App',
             'description': 'Test Description',
@@ -106,5 +109,157 @@ class TestBaseFlowApp(unittest.TestCase):
         mock_step2.show.assert_called_once()
         self.state_manager.save_session_to_state.assert_called_once()
 
+class TestFlowPlan(unittest.TestCase):
+
+    def setUp(self):
+        FlowPlan.clear()
+
+    @staticmethod
+    def make_config():
+        return {
+            'title': 'Test App',
+            'description': 'Test Description',
+            'step_options': {'visibility': 'afterActive', 'btn_reset': 'Reset'},
+            'steps': {
+                'options': {
+                    'class': 'SelectPromptFragmentsStep',
+                    'fragment_options': {'style': {'label': 'Style', 'choices': {'A': 'a'}}}
+                },
+                'prompt': {
+                    'class': 'FormatPromptStep',
+                    'depends_on': {'style': 'options.style'},
+                    'template': '{style}',
+                    'step_options': {'btn_reset': None}
+                },
+                'chat': {
+                    'class': 'FormatPromptStep',
+                    'depends_on': {'prompt': 'prompt', 'again': 'prompt'},
+                    'template': '{prompt}'
+                }
+            }
+        }
+
+    def test_plan_built_once(self):
+        app = BaseFlowApp(self.make_config(), MagicMock())
+        with patch.object(FlowPlan, 'build', wraps=FlowPlan.build) as mock_build:
+            app.load_steps()
+            other = BaseFlowApp(self.make_config(), MagicMock())
+            other.load_steps()
+            mock_build.assert_called_once()
+        self.assertIs(app.get_plan(), other.get_plan())
+
+        plan = app.get_plan()
+        self.assertEqual(plan.step_names, ['options', 'prompt', 'chat'])
+        self.assertEqual(plan.dependencies['chat'], ['prompt'])
+        self.assertEqual(plan.token_maps['prompt'], {'style': 'pdata_options_output_key.style'})
+        self.assertEqual(plan.step_options['prompt']['visibility'], 'afterActive')
+        self.assertIsNone(plan.step_options['prompt']['btn_reset'])
+
+        # Lookups go through the plan
+        self.assertIsNone(other.get_prev_step('options'))
+        self.assertIs(other.get_next_step('options'), other.get_step('prompt'))
+        self.assertIs(other.get_prev_step('chat'), other.get_step('prompt'))
+        self.assertIsNone(other.get_next_step('chat'))
+        self.assertEqual(other.get_step('chat').get_dependency_steps(), [other.get_step('prompt')])
+        self.assertEqual(other.get_step('prompt').get_option('visibility'), 'afterActive')
+        self.assertIsNone(other.get_step('prompt').get_option('btn_reset', 'default'))
+
+    def test_changed_template_gets_new_plan(self):
+        app = BaseFlowApp(self.make_config(), MagicMock())
+        app.load_steps()
+        config = self.make_config()
+        config['steps']['chat']['template'] = 'changed {prompt}'
+        other = BaseFlowApp(config, MagicMock())
+        other.load_steps()
+        self.assertIsNot(app.get_plan(), other.get_plan())
+
+    def test_config_digest(self):
+        config = self.make_config()
+        config['steps']['options']['fragment_options']['style']['choices'] = {1: 'a', 'B': 'b'}
+        digest = FlowPlan.config_digest(config)
+        self.assertEqual(FlowPlan.config_digest(self.make_config()),
+                         FlowPlan.config_digest(self.make_config()))
+        self.assertNotEqual(digest, FlowPlan.config_digest(self.make_config()))
+
+        # Worked out once for the same config
+        with patch('utils.flow_plan.json.dumps') as mock_dumps:
+            self.assertEqual(FlowPlan.config_digest(config), digest)
+            mock_dumps.assert_not_called()
+
+    def test_shared_options_not_changed(self):
+        config = self.make_config()
+        config['step_options']['nested'] = {'a': 1}
+        app = BaseFlowApp(config, MagicMock())
+        app.load_steps()
+        step = app.get_step('prompt')
+        step.get_option('nested')['a'] = 2
+        self.assertEqual(step.get_option('nested'), {'a': 1})
+        with self.assertRaises(TypeError):
+            step.get_options_table()['visibility'] = 'always'
+
+    def test_dependency_must_come_first(self):
+        config = self.make_config()
+        config['steps']['options']['depends_on'] = {'later': 'chat'}
+        app = BaseFlowApp(config, MagicMock())
+        with self.assertRaises(StepConfigException):
+            app.load_steps()
+
+class TestStepStatusEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        FlowPlan.clear()
+        self.app = BaseFlowApp(TestFlowPlan.make_config(), MagicMock())
+        self.app.load_steps()
+
+    @patch('streamlit.session_state', {})
+    def test_statuses_in_one_pass(self):
+        flow_state = {}
+        evaluator = StepStatusEvaluator(self.app)
+        steps = [self.app.get_step(name) for name in self.app.get_step_names()]
+        with patch.object(FormatPromptStep, 'get_step_status', autospec=True,
+                          side_effect=BaseFlowStep.get_step_status) as mock_status:
+            evaluator.evaluate(flow_state)
+            statuses = [evaluator.get_status(step, flow_state) for step in steps]
+            # Each step worked out once
+            self.assertEqual(mock_status.call_count, 2)
+        self.assertEqual(statuses, [StepStatus.ACTIVE, StepStatus.WAITING, StepStatus.WAITING])
+
+        # Same answer as working it out step by step
+        for step in steps:
+            self.assertEqual(evaluator.get_status(step, flow_state),
+                             step.get_step_status(flow_state))
+
+        # Nothing changed so nothing is worked out again
+        options = self.app.get_step('options')
+        with patch.object(options, 'get_step_status') as mock_status:
+            self.assertEqual(evaluator.refresh_status(options, flow_state), StepStatus.ACTIVE)
+            mock_status.assert_not_called()
+
+        # A step's output changes the statuses that depend on it
+        flow_state[options.get_output_key()] = {'style': 'a'}
+        self.assertEqual(evaluator.refresh_status(options, flow_state), StepStatus.DONE)
+        prompt = self.app.get_step('prompt')
+        self.assertEqual(evaluator.get_status(prompt, flow_state), StepStatus.ACTIVE)
+
+    @patch('streamlit.session_state', {})
+    def test_step_overrides_used(self):
+
+        class HeldStep(FormatPromptStep):
+            def input_data_ready(self, flow_state):
+                return flow_state.get('release') is not None
+
+        self.app.steps['prompt'] = HeldStep('prompt', self.app)
+        options = self.app.get_step('options')
+        flow_state = {options.get_output_key(): {'style': 'a'}}
+        evaluator = StepStatusEvaluator(self.app)
+        evaluator.evaluate(flow_state)
+        self.assertEqual(evaluator.get_status(self.app.get_step('prompt'), flow_state),
+                         StepStatus.WAITING)
+
+        flow_state['release'] = True
+        evaluator.evaluate(flow_state)
+        self.assertEqual(evaluator.get_status(self.app.get_step('prompt'), flow_state),
+                         StepStatus.ACTIVE)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,6 @@
 # pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 from utils.aws_utils import AWSUtils
 
@@ -69,5 +70,46 @@ class TestAWSUtils(unittest.TestCase):
         self.assertEqual(reason, AWSUtils.PARTIAL_CREDENTIALS)
 
 
+class TestAWSClientFactory(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+
+    def tearDown(self):
+        AWSUtils.clear_clients()
+
+    @patch("utils.aws_utils.boto3.client")
+    def test_client_cached_per_service_and_region(self, mock_client):
+        mock_client.side_effect = lambda *args, **kwargs: object()
+
+        ssm = AWSUtils.get_client('ssm')
+        self.assertIs(AWSUtils.get_client('ssm'), ssm)
+        self.assertIsNot(AWSUtils.get_client('ssm', region_name='eu-west-1'), ssm)
+        self.assertIsNot(AWSUtils.get_client('s3'), ssm)
+        self.assertEqual(mock_client.call_count, 3)
+
+    @patch("utils.aws_utils.boto3.client")
+    def test_client_config(self, mock_client):
+        AWSUtils.get_client('bedrock-runtime', region_name='us-east-1')
+        config = mock_client.call_args.kwargs['config']
+        self.assertEqual(config.max_pool_connections, 50)
+        self.assertEqual(config.retries['mode'], 'adaptive')
+
+        AWSUtils.get_client('sts')
+        config = mock_client.call_args.kwargs['config']
+        self.assertEqual(config.max_pool_connections, 10)
+        self.assertEqual(config.retries['mode'], 'standard')
+
+    @patch("utils.aws_utils.boto3.client")
+    def test_client_created_once_across_threads(self, mock_client):
+        mock_client.side_effect = lambda *args, **kwargs: object()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: AWSUtils.get_client('s3'), range(32)))
+
+        self.assertEqual(mock_client.call_count, 1)
+        self.assertTrue(all(client is clients[0] for client in clients))
+
+
 if __name__ == "__main__":
     unittest.main()
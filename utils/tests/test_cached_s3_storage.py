@@ -0,0 +1,138 @@
+# pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+from utils.storage_utils import StorageBackend
+from utils.cached_s3_storage import CachedS3StorageBackend, S3DiskCache
+from utils.aws_utils import AWSUtils
+
+
+class TestCachedS3StorageBackend(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+        self.temp_dir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        S3DiskCache.clear_shared()
+        self.temp_dir.cleanup()
+
+    def make_storage(self, **kwargs):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        return CachedS3StorageBackend("test-bucket/folder", cache_dir=self.temp_dir.name, **kwargs)
+
+    @mock_aws
+    def test_read_through_and_conditional_get(self):
+        storage = self.make_storage()
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.put_object(Bucket="test-bucket", Key="folder/file.txt", Body=b"one")
+
+        self.assertEqual(storage.read_text("file.txt"), "one")
+        self.assertEqual(storage.read_text("file.txt"), "one")
+        self.assertEqual((storage.hits, storage.misses), (1, 1))
+
+        # Changed elsewhere - the conditional get downloads it again
+        s3_client.put_object(Bucket="test-bucket", Key="folder/file.txt", Body=b"two")
+        self.assertEqual(storage.read_text("file.txt"), "two")
+        self.assertEqual((storage.hits, storage.misses), (1, 2))
+
+        # Entries on disk are reused by a new process
+        S3DiskCache.clear_shared()
+        storage = CachedS3StorageBackend("test-bucket/folder", cache_dir=self.temp_dir.name)
+        self.assertEqual(storage.read_text("file.txt"), "two")
+        self.assertEqual((storage.hits, storage.misses), (1, 0))
+
+    @mock_aws
+    def test_max_age_skips_s3(self):
+        storage = self.make_storage(max_age_seconds=60)
+        storage.write_text("file.txt", "content")
+
+        with patch.object(storage.s3_client, 'get_object') as mock_get:
+            self.assertEqual(storage.read_text("file.txt"), "content")
+            mock_get.assert_not_called()
+
+    @mock_aws
+    def test_write_delete_rename_copy(self):
+        storage = self.make_storage()
+        storage.write_text("file.txt", "content")
+        self.assertEqual(storage.read_text("file.txt"), "content")
+        self.assertEqual(storage.misses, 0)
+
+        storage.rename("file.txt", "renamed.txt")
+        with self.assertRaises(FileNotFoundError):
+            storage.read_text("file.txt")
+        self.assertEqual(storage.read_text("renamed.txt"), "content")
+
+        storage.write_text("other.txt", "other")
+        storage.copy("renamed.txt", "other.txt")
+        self.assertEqual(storage.read_text("other.txt"), "content")
+
+        storage.delete("other.txt")
+        with self.assertRaises(FileNotFoundError):
+            storage.read_text("other.txt")
+
+    @mock_aws
+    def test_size_limit(self):
+        storage = self.make_storage(max_bytes=10)
+        storage.write_text("a.txt", "12345")
+        storage.write_text("b.txt", "12345")
+        self.assertEqual(list(storage.cache._entries.keys()), ["folder/a.txt", "folder/b.txt"])
+
+        # Using a keeps it, b is evicted
+        storage.read_text("a.txt")
+        storage.write_text("c.txt", "123")
+        self.assertEqual(list(storage.cache._entries.keys()), ["folder/a.txt", "folder/c.txt"])
+        self.assertLessEqual(storage.cache._cache_bytes, 10)
+
+        # Too big to cache
+        storage.write_text("big.txt", "x" * 20)
+        self.assertNotIn("folder/big.txt", storage.cache._entries)
+        self.assertEqual(storage.read_text("big.txt"), "x" * 20)
+
+    @mock_aws
+    def test_folders_share_the_bucket_cache(self):
+        first = self.make_storage(max_bytes=10)
+        second = CachedS3StorageBackend("test-bucket/other", cache_dir=self.temp_dir.name,
+                                        max_bytes=10)
+        self.assertIs(first.cache, second.cache)
+
+        first.write_text("a.txt", "12345")
+        second.write_text("b.txt", "12345")
+        second.write_text("c.txt", "12345")
+        self.assertEqual(list(first.cache._entries.keys()), ["other/b.txt", "other/c.txt"])
+        self.assertEqual(first.read_text("a.txt"), "12345")
+
+        # Only the files of the entries are left on disk
+        cache_files = os.listdir(os.path.join(self.temp_dir.name, "test-bucket"))
+        self.assertEqual(len(cache_files), 4)
+
+    @mock_aws
+    def test_replaced_copy_is_cleaned_up_on_load(self):
+        storage = self.make_storage()
+        storage.write_text("file.txt", "one")
+        storage.write_text("file.txt", "two")
+        cache_dir = os.path.join(self.temp_dir.name, "test-bucket")
+        with open(os.path.join(cache_dir, "interrupted-write"), "wb") as file:
+            file.write(b"partial")
+
+        S3DiskCache.clear_shared()
+        storage = self.make_storage()
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertEqual(storage.read_text("file.txt"), "two")
+        self.assertEqual(storage.hits, 1)
+
+    @mock_aws
+    def test_factory_uses_cache_when_configured(self):
+        StorageBackend.clear_storage_cache()
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        with patch.dict(os.environ, {"S3_DISK_CACHE_DIR": self.temp_dir.name}):
+            storage = StorageBackend.get_storage("s3::test-bucket|us-east-1")
+        StorageBackend.clear_storage_cache()
+        self.assertIsInstance(storage, CachedS3StorageBackend)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,12 @@ from unittest.mock import patch, MagicMock
 import json
 import tempfile
 import os
+import time
 import logging
 import toml
-from botocore.exceptions import ClientError
-from utils.config_utils import ConfigStore, VersionInfo
+from botocore.exceptions import ClientError, NoRegionError
+from utils.config_utils import ConfigStore, VersionInfo, ConfigSectionCache
+from utils.aws_utils import AWSUtils
 
 
 class TestConfigStoreLocalStorage(unittest.TestCase):
@@ -82,6 +84,9 @@ class TestVersionInfo(unittest.TestCase):
         self.assertEqual(version_info.get_github_run_number(), 'n/a')
 
 class TestConfigStore(unittest.TestCase):
+    def setUp(self):
+        ConfigStore.invalidate_cache()
+
     @patch.dict(os.environ, {'CONFIG_PATH': 'local::test'})
     def test_get_config_path_from_env(self):
         self.assertEqual(ConfigStore.get_config_path_from_env(), 'local::test')
@@ -144,8 +149,11 @@ class TestConfigStore(unittest.TestCase):
 
 class TestConfigStoreAWSSSM(unittest.TestCase):
 
+    def setUp(self):
+        ConfigStore.invalidate_cache()
+        AWSUtils.clear_clients()
 
-    @patch('utils.config_utils.boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_fetch_json_parameter(self, mock_boto3_client):
         # Mock the AWS response
         mock_client = MagicMock()
@@ -169,7 +177,7 @@ class TestConfigStoreAWSSSM(unittest.TestCase):
         self.assertEqual(result['user'], "db_user")
         self.assertEqual(result['password'], "securepassword")
 
-    @patch('utils.config_utils.boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_fetch_toml_parameter(self, mock_boto3_client):
         # Mock the AWS response
         mock_client = MagicMock()
@@ -193,7 +201,7 @@ class TestConfigStoreAWSSSM(unittest.TestCase):
         self.assertEqual(result['use_case_templates'], "data/use_case_templates")
         self.assertEqual(result['templates_include_lib'], "data/templates_include_lib")
 
-    @patch('utils.config_utils.boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_parameter_not_found(self, mock_boto3_client):
         # Mock the AWS response to raise ParameterNotFound
         mock_client = MagicMock()
@@ -214,7 +222,7 @@ class TestConfigStoreAWSSSM(unittest.TestCase):
         result = store.get('nonexistent', default={"default_key": "default_value"})
         self.assertEqual(result, {"default_key": "default_value"})
 
-    @patch('utils.config_utils.boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_fetch_json_config_path(self, mock_boto3_client):
         # Mock the AWS response
         mock_client = MagicMock()
@@ -232,7 +240,7 @@ class TestConfigStoreAWSSSM(unittest.TestCase):
         result = store['config']
         self.assertEqual(result['key'], "value")
 
-    @patch('utils.config_utils.boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_invalid_toml_format(self, mock_boto3_client):
         # Mock the AWS response with invalid TOML
         mock_client = MagicMock()
@@ -250,7 +258,7 @@ class TestConfigStoreAWSSSM(unittest.TestCase):
         with self.assertRaises(ValueError):
             _settings = store['settings']
 
-    @patch('utils.config_utils.boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_invalid_json_format(self, mock_boto3_client):
         # Mock the AWS response with invalid JSON
         mock_client = MagicMock()
@@ -270,6 +278,226 @@ class TestConfigStoreAWSSSM(unittest.TestCase):
 
 
 
+class TestConfigSectionCache(unittest.TestCase):
+
+    def setUp(self):
+        ConfigStore.invalidate_cache()
+        ConfigStore.section_cache.reset_stats()
+
+    def test_cache_hits_across_instances(self):
+        with patch('utils.config_utils.ConfigStore._fetch_section_from_ssm_param') as mock_fetch:
+            mock_fetch.return_value = {'key': 'value'}
+            ConfigStore.nested_get('section.key', config_path='ssm::/cache/test')
+            ConfigStore.nested_get('section.key', config_path='ssm::/cache/test')
+            value = ConfigStore('ssm::/cache/test')['section']
+
+        self.assertEqual(value, {'key': 'value'})
+        mock_fetch.assert_called_once_with('section')
+        stats = ConfigStore.section_cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_cache_keyed_by_config_path(self):
+        with patch('utils.config_utils.ConfigStore._fetch_section_from_ssm_param') as mock_fetch:
+            mock_fetch.side_effect = [{'key': 'one'}, {'key': 'two'}]
+            self.assertEqual(ConfigStore('ssm::/one')['section']['key'], 'one')
+            self.assertEqual(ConfigStore('ssm::/two')['section']['key'], 'two')
+
+    def test_invalidate(self):
+        with patch('utils.config_utils.ConfigStore._fetch_section_from_local') as mock_fetch:
+            mock_fetch.side_effect = [{'key': 'old'}, {'key': 'new'}]
+            self.assertEqual(ConfigStore('local::test')['section']['key'], 'old')
+            ConfigStore.invalidate_cache('local::test', 'section')
+            self.assertEqual(ConfigStore('local::test')['section']['key'], 'new')
+
+    def test_returns_copies(self):
+        with patch('utils.config_utils.ConfigStore._fetch_section_from_local') as mock_fetch:
+            mock_fetch.return_value = {'key': 'value'}
+            ConfigStore('local::test')['section']['key'] = 'changed'
+            self.assertEqual(ConfigStore('local::test')['section']['key'], 'value')
+
+    def test_ttl_expiry(self):
+        cache = ConfigSectionCache(ttl_seconds=60)
+        cache.put('local::test', 'section', {'key': 'value'})
+        self.assertEqual(cache.get('local::test', 'section'), {'key': 'value'})
+
+        with patch('utils.config_utils.time.monotonic', return_value=10**12):
+            with self.assertRaises(KeyError):
+                cache.get('local::test', 'section')
+        self.assertEqual(cache.get_stats(), {'hits': 1, 'misses': 1, 'size': 0})
+
+    def test_errors_not_cached(self):
+        with patch('utils.config_utils.ConfigStore._fetch_section_from_ssm_param') as mock_fetch:
+            mock_fetch.side_effect = [ValueError('bad'), {'key': 'value'}]
+            with self.assertRaises(ValueError):
+                _section = ConfigStore('ssm::/test')['section']
+            self.assertEqual(ConfigStore('ssm::/test')['section']['key'], 'value')
+
+
+class TestConfigPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        ConfigStore.invalidate_cache()
+        AWSUtils.clear_clients()
+
+    def tearDown(self):
+        ConfigStore.stop_background_refresh()
+
+    @staticmethod
+    def make_ssm_client(pages):
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value.paginate.return_value = pages
+        return mock_client
+
+    @patch('utils.aws_utils.boto3.client')
+    def test_prefetch_fills_cache(self, mock_boto3_client):
+        mock_client = TestConfigPrefetch.make_ssm_client([
+            {'Parameters': [
+                {'Name': '/test/config/db', 'Value': json.dumps({'host': 'db.example.com'})},
+            ]},
+            {'Parameters': [
+                {'Name': '/test/config/paths', 'Value': toml.dumps({'saved_states': 'data'})},
+                {'Name': '/test/config/broken', 'Value': '{not-json}'},
+            ]},
+        ])
+        mock_boto3_client.return_value = mock_client
+
+        with self.assertLogs(level='WARNING'):
+            count = ConfigStore('ssm::/test/config').prefetch()
+        self.assertEqual(count, 2)
+        mock_client.get_paginator.assert_called_once_with('get_parameters_by_path')
+        mock_client.get_paginator.return_value.paginate.assert_called_once_with(
+            Path='/test/config', Recursive=True, WithDecryption=True)
+
+        # Served from the cache without per section calls
+        self.assertEqual(
+            ConfigStore.nested_get('db.host', config_path='ssm::/test/config'), 'db.example.com')
+        self.assertEqual(
+            ConfigStore.nested_get('paths.saved_states', config_path='ssm::/test/config'), 'data')
+        mock_client.get_parameter.assert_not_called()
+
+    def test_prefetch_local_is_noop(self):
+        self.assertEqual(ConfigStore('local::default').prefetch(), 0)
+
+    @patch('utils.aws_utils.boto3.client')
+    def test_background_refresh(self, mock_boto3_client):
+        mock_client = TestConfigPrefetch.make_ssm_client([
+            {'Parameters': [{'Name': '/test/config/db', 'Value': json.dumps({'host': 'one'})}]}])
+        mock_boto3_client.return_value = mock_client
+
+        # Initial prefetch happens on the thread and only one refresher runs
+        self.assertTrue(ConfigStore.start_background_refresh(
+            interval_seconds=0.01, config_path='ssm::/test/config'))
+        self.assertFalse(ConfigStore.start_background_refresh(
+            interval_seconds=0.01, config_path='ssm::/test/config'))
+        self.assertTrue(ConfigStore.wait_for_refresh(timeout=5))
+        self.assertEqual(ConfigStore('ssm::/test/config')['db']['host'], 'one')
+
+        # Refresh picks up the change
+        mock_client.get_paginator.return_value.paginate.return_value = [
+            {'Parameters': [{'Name': '/test/config/db', 'Value': json.dumps({'host': 'two'})}]}]
+        for _ in range(200):
+            if ConfigStore('ssm::/test/config')['db']['host'] == 'two':
+                break
+            time.sleep(0.01)
+        self.assertEqual(ConfigStore('ssm::/test/config')['db']['host'], 'two')
+
+
+    @patch('utils.aws_utils.boto3.client')
+    def test_background_refresh_rides_out_botocore_errors(self, mock_boto3_client):
+        mock_client = MagicMock()
+        mock_client.get_paginator.return_value.paginate.side_effect = NoRegionError()
+        mock_boto3_client.return_value = mock_client
+
+        # Nothing is raised to the caller and the refresher keeps running
+        with self.assertLogs(level=logging.WARNING):
+            self.assertTrue(ConfigStore.start_background_refresh(
+                interval_seconds=0.01, config_path='ssm::/test/config'))
+            self.assertTrue(ConfigStore.wait_for_refresh(timeout=5))
+        self.assertTrue(ConfigStore._refresh_thread.is_alive())
+
+
+class TestConfigHotReload(unittest.TestCase):
+
+    def setUp(self):
+        ConfigStore.invalidate_cache()
+        ConfigStore._section_versions.clear()
+        AWSUtils.clear_clients()
+        self.temp_dir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.config_dir = os.path.join(self.temp_dir.name, 'hot')
+        os.makedirs(self.config_dir)
+        self.write_section('paths', {'saved_states': 'one'})
+        self.write_section('other', {'key': 'value'})
+        self.patcher = patch.object(ConfigStore, 'local_config_dir', self.temp_dir.name)
+        self.patcher.start()
+
+    def tearDown(self):
+        ConfigStore.stop_background_refresh()
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def write_section(self, key, value, mtime_offset=0):
+        file_path = os.path.join(self.config_dir, f'{key}.toml')
+        with open(file_path, 'w', encoding='utf-8') as f:
+            toml.dump(value, f)
+        mtime = time.time() + mtime_offset
+        os.utime(file_path, (mtime, mtime))
+
+    def test_local_change_invalidates_only_changed_section(self):
+        store = ConfigStore('local::hot')
+        self.assertEqual(store.check_for_changes(), [])
+        self.assertEqual(store['paths']['saved_states'], 'one')
+        self.assertEqual(store['other']['key'], 'value')
+
+        # Nothing changed
+        self.assertEqual(store.check_for_changes(), [])
+
+        # Change one section and add another
+        self.write_section('paths', {'saved_states': 'two'}, mtime_offset=10)
+        self.write_section('added', {'key': 'new'})
+        self.assertEqual(store.check_for_changes(), ['added', 'paths'])
+
+        with patch.object(ConfigStore, '_fetch_section_from_local',
+                          wraps=store._fetch_section_from_local) as mock_fetch:
+            self.assertEqual(store['paths']['saved_states'], 'two')
+            self.assertEqual(store['other']['key'], 'value')
+            mock_fetch.assert_called_once_with('paths')
+
+    @patch('utils.aws_utils.boto3.client')
+    def test_ssm_version_poll(self, mock_boto3_client):
+        mock_client = MagicMock()
+        paginate = mock_client.get_paginator.return_value.paginate
+        paginate.return_value = [{'Parameters': [
+            {'Name': '/test/config/db', 'Version': 1},
+            {'Name': '/test/config/paths', 'Version': 3}]}]
+        mock_boto3_client.return_value = mock_client
+
+        store = ConfigStore('ssm::/test/config')
+        self.assertEqual(store.check_for_changes(), [])
+        mock_client.get_paginator.assert_called_with('describe_parameters')
+        paginate.assert_called_with(ParameterFilters=[
+            {'Key': 'Path', 'Option': 'Recursive', 'Values': ['/test/config']}])
+
+        paginate.return_value = [{'Parameters': [
+            {'Name': '/test/config/db', 'Version': 2},
+            {'Name': '/test/config/paths', 'Version': 3}]}]
+        self.assertEqual(store.check_for_changes(), ['db'])
+        mock_client.get_parameter.assert_not_called()
+
+    def test_background_watch(self):
+        self.assertTrue(ConfigStore.start_background_refresh(
+            config_path='local::hot', watch_interval_seconds=0.01))
+        self.assertTrue(ConfigStore.wait_for_refresh(timeout=5))
+        self.assertEqual(ConfigStore('local::hot')['paths']['saved_states'], 'one')
+
+        self.write_section('paths', {'saved_states': 'two'}, mtime_offset=10)
+        for _ in range(200):
+            if ConfigStore('local::hot')['paths']['saved_states'] == 'two':
+                break
+            time.sleep(0.01)
+        self.assertEqual(ConfigStore('local::hot')['paths']['saved_states'], 'two')
+
+
 class TestConfigStoreNestedGet(unittest.TestCase):
 
     @classmethod
@@ -0,0 +1,147 @@
+# pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
+# pylint: disable=no-member
+import unittest
+import tempfile
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.storage_utils import StorageBackend
+from utils.mem_storage import MemoryStorageBackend
+from utils.sqlite_storage import SqliteStorageBackend
+
+
+class KeyValueStorageChecks:
+    """ Checks shared by the backends without real folders """
+
+    def make_storage(self):
+        raise NotImplementedError
+
+    def test_write_read_exists(self):
+        storage = self.make_storage()
+        storage.write_binary("folder/data.bin", b"\x00\x01")
+        storage.write_text("folder/data.txt", "hello")
+        self.assertEqual(storage.read_binary("folder/data.bin"), b"\x00\x01")
+        self.assertEqual(storage.read_text("/folder//data.txt"), "hello")
+        self.assertTrue(storage.file_exists("folder/data.txt"))
+        self.assertFalse(storage.file_exists("folder/missing.txt"))
+        with self.assertRaises(FileNotFoundError):
+            storage.read_text("folder/missing.txt")
+        with self.assertRaises(ValueError):
+            storage.read_text("../outside.txt")
+
+    def test_rename_copy_delete(self):
+        storage = self.make_storage()
+        storage.write_text("a.txt", "a")
+        storage.write_text("b.txt", "b")
+
+        storage.rename("a.txt", "b.txt")
+        self.assertFalse(storage.file_exists("a.txt"))
+        self.assertEqual(storage.read_text("b.txt"), "a")
+
+        storage.copy("b.txt", "sub/c.txt")
+        self.assertEqual(storage.read_text("sub/c.txt"), "a")
+
+        storage.delete("b.txt")
+        self.assertFalse(storage.file_exists("b.txt"))
+        with self.assertRaises(FileNotFoundError):
+            storage.delete("b.txt")
+        with self.assertRaises(FileNotFoundError):
+            storage.rename("b.txt", "d.txt")
+        with self.assertRaises(FileNotFoundError):
+            storage.copy("b.txt", "d.txt")
+
+    def test_list(self):
+        storage = self.make_storage()
+        for path in ["file1.txt", "file2.txt", "sub1/file3.txt",
+                     "sub2/file4.txt", "sub2/deeper/file5.txt", "sub20/file6.txt"]:
+            storage.write_text(path, "content")
+
+        self.assertEqual(sorted(storage.list_files("")), ["file1.txt", "file2.txt"])
+        self.assertEqual(sorted(storage.list_folders("")), ["sub1", "sub2", "sub20"])
+        self.assertEqual(storage.list_files("sub2"), ["file4.txt"])
+        self.assertEqual(storage.list_folders("sub2"), ["deeper"])
+        self.assertEqual(storage.list_files("missing"), [])
+
+
+class TestMemoryStorageBackend(KeyValueStorageChecks, unittest.TestCase):
+
+    def make_storage(self):
+        return MemoryStorageBackend()
+
+    def test_factory(self):
+        StorageBackend.clear_storage_cache()
+        storage = StorageBackend.get_storage("mem::test")
+        self.assertIsInstance(storage, MemoryStorageBackend)
+        self.assertIs(StorageBackend.get_storage("mem::test"), storage)
+        StorageBackend.clear_storage_cache()
+
+
+class TestSqliteStorageBackend(KeyValueStorageChecks, unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.db_path = os.path.join(self.temp_dir.name, "data", "store.db")
+
+    def tearDown(self):
+        StorageBackend.clear_storage_cache()
+        self.temp_dir.cleanup()
+
+    def make_storage(self):
+        return SqliteStorageBackend(self.db_path)
+
+    def test_factory_and_persistence(self):
+        StorageBackend.clear_storage_cache()
+        storage = StorageBackend.get_storage(f"sqlite::{self.db_path}")
+        self.assertIsInstance(storage, SqliteStorageBackend)
+        storage.write_text("state.json", "{}")
+        storage.close()
+        self.assertEqual(SqliteStorageBackend(self.db_path).read_text("state.json"), "{}")
+
+    def test_concurrent_access(self):
+        storage = self.make_storage()
+
+        def write_and_read(index):
+            storage.write_text(f"states/{index}.json", str(index))
+            return storage.read_text(f"states/{index}.json")
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(write_and_read, range(50)))
+        self.assertEqual(results, [str(index) for index in range(50)])
+        self.assertEqual(len(storage.list_files("states")), 50)
+
+    def test_finished_thread_connections_closed(self):
+        storage = self.make_storage()
+
+        def write(index):
+            thread = threading.Thread(target=storage.write_text, args=(f"{index}.txt", "x"))
+            thread.start()
+            thread.join()
+
+        # The first thread's connection goes when the second opens one
+        write(1)
+        first = [connection for _owner, connection in storage._connections.values()]
+        write(2)
+        self.assertEqual(len(storage._connections), 2)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            first[-1].execute("SELECT 1")
+
+        # Close shuts the rest and the storage opens a new one when used again
+        storage.close()
+        self.assertEqual(storage._connections, {})
+        self.assertEqual(storage.read_text("2.txt"), "x")
+
+    def test_listing_uses_covering_indexes(self):
+        storage = self.make_storage()
+        storage.write_text("states/a.json", "{}")
+        connection = storage._connection()
+        columns = "SELECT path, size, mtime, etag FROM files"
+        for query, args in ((f"{columns} WHERE parent = ? ORDER BY path", ("states",)),
+                            (f"{columns} WHERE path >= ? AND path < ? ORDER BY path",
+                             ("states/", "states0"))):
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {query}", args).fetchall()
+            self.assertIn("COVERING INDEX", plan[0][-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
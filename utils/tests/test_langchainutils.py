@@ -1,11 +1,23 @@
 # pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
 import unittest
+import io
+import json
+import time
+import threading
 from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
 from langchain_aws import ChatBedrock
-from utils.langchain_utils import LangChainUtils, InternalStubModel
+from utils.langchain_utils import LangChainUtils, InternalStubModel, SimulatedStubModel
+from utils.bedrock_caching import BedrockPromptCachingClient
+from utils.llm_scheduling import LLMCallScheduler, LLMCallPriority, TokenBucket, HedgePolicy
+from utils.llm_scheduling import LatencyTracker
+from utils.aws_utils import AWSUtils
 
 class TestLangChainUtils(unittest.TestCase):
 
+    def setUp(self):
+        AWSUtils.clear_clients()
+
     @patch('utils.aws_utils.AWSUtils.is_aws_configured')
     def test_get_chat_model_choices(self, mock_is_aws_configured):
         """Test the `get_chat_model_choices` method."""
@@ -23,12 +35,22 @@ class TestLangChainUtils(unittest.TestCase):
         chat = LangChainUtils.get_chat_model("Mock Model - Echo")
         self.assertIsInstance(chat, InternalStubModel)
 
+    def test_get_max_input_tokens(self):
+        self.addCleanup(LangChainUtils._simulated_choices.pop, "unit_test", None)
+        LangChainUtils.register_simulated_model_choice(
+            "unit_test", context_tokens=1000, output_tokens=200)
+        self.assertEqual(LangChainUtils.get_max_input_tokens("unit_test"), 800)
+        self.assertEqual(LangChainUtils.get_max_input_tokens("Mock Model - Echo"),
+                         LangChainUtils.DEFAULT_CONTEXT_TOKENS)
+        with self.assertRaises(ValueError):
+            LangChainUtils.get_max_input_tokens("Invalid Model Choice")
+
     def test_get_chat_model_invalid_choice(self):
         """Test the `get_chat_model` method with an invalid model choice."""
         with self.assertRaises(ValueError):
             LangChainUtils.get_chat_model("Invalid Model Choice", region_name="us-west-2")
 
-    @patch('boto3.client')
+    @patch('utils.aws_utils.boto3.client')
     def test_print_available_aws_bedrock_models_success(self, mock_boto_client):
         """Test the `print_available_aws_bedrock_models` method with mocked Bedrock response."""
         mock_bedrock_client = MagicMock()
@@ -83,5 +105,423 @@ class TestLangChainUtils(unittest.TestCase):
         # Assert the response matches the human prompt (echo behavior)
         self.assertEqual(response, human_prompt)
 
+class RecordingBedrockClient:
+    """ Stub bedrock-runtime client that records the request bodies """
+
+    def __init__(self, usage):
+        self.bodies = []
+        self.usage = usage
+
+    def invoke_model(self, **kwargs):
+        self.bodies.append(json.loads(kwargs["body"]))
+        response_body = {
+            "content": [{"type": "text", "text": "Stubbed answer"}],
+            "stop_reason": "end_turn",
+            "usage": self.usage
+        }
+        return {"body": io.BytesIO(json.dumps(response_body).encode())}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        self.bodies.append(json.loads(kwargs["body"]))
+        events = [
+            {"type": "message_start", "message": {"role": "assistant", "content": [],
+                                                  "usage": self.usage}},
+            {"type": "content_block_start", "index": 0,
+             "content_block": {"type": "text", "text": ""}},
+            {"type": "content_block_delta", "index": 0,
+             "delta": {"type": "text_delta", "text": "Stubbed"}},
+            {"type": "content_block_delta", "index": 0,
+             "delta": {"type": "text_delta", "text": " answer"}},
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+             "usage": {"output_tokens": 5}},
+            {"type": "message_stop"},
+        ]
+        return {"body": [{"chunk": {"bytes": json.dumps(event).encode()}} for event in events]}
+
+class TestBedrockPromptCaching(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+
+    def test_add_cache_points(self):
+        body = {
+            "system": "System prompt",
+            "messages": [
+                {"role": "user", "content": "Context heavy prompt"},
+                {"role": "assistant", "content": "Answer"},
+                {"role": "user", "content": [{"type": "text", "text": "Follow up"}]},
+            ]
+        }
+        body = BedrockPromptCachingClient.add_cache_points(body)
+        cache_control = {"type": "ephemeral"}
+        self.assertEqual(body["system"],
+                         [{"type": "text", "text": "System prompt",
+                           "cache_control": cache_control}])
+        self.assertEqual(body["messages"][0]["content"],
+                         [{"type": "text", "text": "Context heavy prompt",
+                           "cache_control": cache_control}])
+        self.assertEqual(body["messages"][1]["content"], "Answer")
+        self.assertNotIn("cache_control", body["messages"][2]["content"][0])
+
+    def test_chat_prompt_response_marks_prefix_and_reports_usage(self):
+        stub_client = RecordingBedrockClient({
+            "input_tokens": 10,
+            "output_tokens": 5,
+            "cache_read_input_tokens": 2000,
+            "cache_creation_input_tokens": 0
+        })
+        chat_model = ChatBedrock(
+            model_id="anthropic.claude-3-sonnet-20240229-v1:0",
+            client=BedrockPromptCachingClient(stub_client),
+            region_name="us-east-1",
+            model_kwargs={"max_tokens": 100},
+        )
+        prior_chat_history = [
+            {"role": "user", "content": "Summarise this big document"},
+            {"role": "assistant", "content": "Here is the summary"}
+        ]
+
+        usage = {}
+        response = LangChainUtils.chat_prompt_response(
+            chat_model=chat_model,
+            initial_system_prompt="You summarise text.",
+            human_prompt="Shorter please",
+            prior_chat_history=prior_chat_history,
+            usage=usage
+        )
+        self.assertEqual(response, "Stubbed answer")
+
+        # Outgoing payload has the cache points on the stable prefix only
+        body = stub_client.bodies[0]
+        self.assertEqual(body["system"][0]["cache_control"], {"type": "ephemeral"})
+        self.assertEqual(body["messages"][0]["content"][-1]["cache_control"], {"type": "ephemeral"})
+        self.assertEqual(body["messages"][-1]["content"], "Shorter please")
+
+        # Cache counts reported
+        self.assertEqual(usage["cache_read_input_tokens"], 2000)
+        self.assertEqual(usage["cache_write_input_tokens"], 0)
+        self.assertEqual(usage["input_tokens"], 10)
+
+    def test_usage_recorded_per_call(self):
+        class EchoUsageClient: # pylint: disable=too-few-public-methods
+            def invoke_model(self, **kwargs):
+                usage = {"cache_read_input_tokens": json.loads(kwargs["body"])["max_tokens"]}
+                return {"body": io.BytesIO(json.dumps({"usage": usage}).encode())}
+
+        # Two sessions sharing one client each see only their own call's counts
+        client = BedrockPromptCachingClient(EchoUsageClient())
+        barrier = threading.Barrier(2)
+        results = {}
+
+        def session(max_tokens):
+            with BedrockPromptCachingClient.record_usage() as usage:
+                client.invoke_model(body=json.dumps({"max_tokens": max_tokens}))
+                barrier.wait()
+            results[max_tokens] = usage["cache_read_input_tokens"]
+
+        threads = [threading.Thread(target=session, args=(tokens,)) for tokens in (100, 200)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {100: 100, 200: 200})
+
+        # Calls made outside a recording block leave the response alone
+        response = client.invoke_model(body=json.dumps({"max_tokens": 1}))
+        self.assertIn(b"cache_read_input_tokens", response["body"].read())
+
+    def test_hedged_chat_streams_with_cache_points(self):
+        stub_client = RecordingBedrockClient({
+            "input_tokens": 10,
+            "cache_read_input_tokens": 2000,
+            "cache_creation_input_tokens": 0
+        })
+        chat_model = ChatBedrock(
+            model_id="anthropic.claude-3-sonnet-20240229-v1:0",
+            client=BedrockPromptCachingClient(stub_client),
+            region_name="us-east-1",
+            model_kwargs={"max_tokens": 100},
+        )
+        hedge = HedgePolicy(InternalStubModel("fixed"), default_delay=5.0)
+
+        usage = {}
+        response = LangChainUtils.chat_prompt_response(
+            chat_model=chat_model,
+            initial_system_prompt="You summarise text.",
+            human_prompt="Shorter please",
+            usage=usage,
+            hedge=hedge
+        )
+        self.assertEqual(response, "Stubbed answer")
+        self.assertEqual(hedge.hedges_sent, 0)
+        self.assertEqual(stub_client.bodies[0]["system"][0]["cache_control"], {"type": "ephemeral"})
+        self.assertEqual(usage["cache_read_input_tokens"], 2000)
+        self.assertEqual(usage["output_tokens"], 5)
+
+    def test_get_chat_model_prompt_caching_wraps_client(self):
+        with patch('utils.langchain_utils.AWSUtils.is_aws_configured') as mock_aws, \
+                patch('utils.aws_utils.boto3.client') as mock_client:
+            mock_aws.return_value = True, 'mocked reason'
+            mock_client.return_value = RecordingBedrockClient({})
+            chat = LangChainUtils.get_chat_model(
+                "Claude 3 Sonnet - Standard (Default)",
+                region_name="us-east-1",
+                prompt_caching=True)
+            self.assertIsInstance(chat.client, BedrockPromptCachingClient)
+
+class TestLLMCallScheduler(unittest.TestCase):
+
+    @staticmethod
+    def wait_for_queue_depth(scheduler, model_id, depth):
+        for _ in range(500):
+            if scheduler.get_metrics()[model_id]["queue_depth"] == depth:
+                return
+            time.sleep(0.002)
+        raise AssertionError(f"queue never reached depth {depth}")
+
+    def test_concurrency_cap(self):
+        scheduler = LLMCallScheduler(default_max_concurrency=2)
+        lock = threading.Lock()
+        counters = {"active": 0, "peak": 0}
+
+        def call():
+            with scheduler.slot("model"):
+                with lock:
+                    counters["active"] += 1
+                    counters["peak"] = max(counters["peak"], counters["active"])
+                time.sleep(0.01)
+                with lock:
+                    counters["active"] -= 1
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counters["peak"], 2)
+        metrics = scheduler.get_metrics()["model"]
+        self.assertEqual(metrics["calls"], 8)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["active"], 0)
+        self.assertEqual(metrics["calls_by_priority"]["INTERACTIVE"], 8)
+        self.assertGreater(metrics["max_wait_seconds"], 0)
+
+    def test_interactive_goes_before_batch(self):
+        scheduler = LLMCallScheduler(default_max_concurrency=1)
+        order = []
+
+        def call(name, priority):
+            with scheduler.slot("model", priority=priority):
+                order.append(name)
+
+        # Hold the only slot while the others queue
+        scheduler.acquire("model")
+        batch = threading.Thread(target=call, args=("batch", LLMCallPriority.BATCH))
+        batch.start()
+        self.wait_for_queue_depth(scheduler, "model", 1)
+        interactive = threading.Thread(
+            target=call, args=("interactive", LLMCallPriority.INTERACTIVE))
+        interactive.start()
+        self.wait_for_queue_depth(scheduler, "model", 2)
+        scheduler.release("model")
+        batch.join()
+        interactive.join()
+
+        self.assertEqual(order, ["interactive", "batch"])
+
+    def test_token_bucket_limits_rate(self):
+        scheduler = LLMCallScheduler()
+        scheduler.configure_model("model", tokens_per_minute=6000)
+        with scheduler.slot("model", estimated_tokens=6000) as waited:
+            self.assertLess(waited, 0.05)
+
+        # Bucket is empty, 10 tokens needs 0.1s at 100 tokens a second
+        with scheduler.slot("model", estimated_tokens=10) as waited:
+            self.assertGreaterEqual(waited, 0.05)
+
+    def test_token_bucket_oversized_request(self):
+        bucket = TokenBucket(60)
+        self.assertEqual(bucket.wait_time(1000), 0)
+        bucket.consume(1000)
+        self.assertGreater(bucket.wait_time(1000), 0)
+
+    def test_prompt_helpers_are_scheduled(self):
+        chat_model = LangChainUtils.get_chat_model("Mock Model - Echo")
+        model_id = LangChainUtils.get_model_id(chat_model)
+        before = LangChainUtils.get_scheduler_metrics().get(model_id, {}).get("calls", 0)
+        LangChainUtils.simple_prompt_response(
+            chat_model, "system", "hi", LLMCallPriority.BACKGROUND)
+        LangChainUtils.chat_prompt_response(chat_model, "system", "hi", [])
+        metrics = LangChainUtils.get_scheduler_metrics()[model_id]
+        self.assertEqual(metrics["calls"], before + 2)
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            LLMCallScheduler().configure_model("model", max_concurrency=0)
+
+class FailingStubModel(InternalStubModel):
+    """ Stub model that always raises """
+
+    def invoke(self, input_data):
+        raise RuntimeError("model failed")
+
+class TestHedgedRequests(unittest.TestCase):
+
+    def chat(self, chat_model, hedge):
+        return LangChainUtils.chat_prompt_response(
+            chat_model=chat_model,
+            initial_system_prompt="system",
+            human_prompt="hello",
+            hedge=hedge)
+
+    def test_latency_tracker_percentile(self):
+        tracker = LatencyTracker()
+        self.assertIsNone(tracker.percentile("model", 95))
+        for i in range(1, 101):
+            tracker.record("model", i / 100)
+        self.assertAlmostEqual(tracker.percentile("model", 95), 0.95, places=2)
+        self.assertIsNone(tracker.percentile("model", 95, min_samples=200))
+
+    def test_hedge_delay_uses_default_then_percentile(self):
+        tracker = LatencyTracker()
+        policy = HedgePolicy(None, percentile=50, default_delay=3.0, min_delay=0.1, min_samples=3)
+        self.assertEqual(policy.get_delay(tracker, "model"), 3.0)
+        for latency in [1.0, 2.0, 4.0]:
+            tracker.record("model", latency)
+        self.assertEqual(policy.get_delay(tracker, "model"), 2.0)
+
+    def test_fast_primary_does_not_hedge(self):
+        primary = InternalStubModel("echo", model_id="test.hedge.fast")
+        hedge_model = InternalStubModel("fixed", model_id="test.hedge.fast.fallback")
+        policy = HedgePolicy(hedge_model, default_delay=1.0, min_delay=1.0)
+        self.assertEqual(self.chat(primary, policy), "hello")
+        self.assertEqual(policy.hedges_sent, 0)
+
+    def test_slow_primary_is_hedged(self):
+        primary = InternalStubModel("echo", model_id="test.hedge.slow", delay=1.0)
+        hedge_model = InternalStubModel("fixed", model_id="test.hedge.slow.fallback")
+        policy = HedgePolicy(hedge_model, default_delay=0.05, min_delay=0.05)
+
+        start = time.monotonic()
+        response = self.chat(primary, policy)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(response, "Stubbed response")
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(policy.hedges_sent, 1)
+        self.assertEqual(policy.hedges_won, 1)
+
+    def test_failed_primary_falls_back_to_hedge(self):
+        primary = FailingStubModel("echo", model_id="test.hedge.failing")
+        hedge_model = InternalStubModel("fixed", model_id="test.hedge.failing.fallback")
+        policy = HedgePolicy(hedge_model, default_delay=1.0, min_delay=1.0)
+        self.assertEqual(self.chat(primary, policy), "Stubbed response")
+
+    def test_both_fail_raises(self):
+        primary = FailingStubModel("echo", model_id="test.hedge.both")
+        hedge_model = FailingStubModel("echo", model_id="test.hedge.both.fallback")
+        policy = HedgePolicy(hedge_model, default_delay=0.01, min_delay=0.01)
+        with self.assertRaises(RuntimeError):
+            self.chat(primary, policy)
+
+    def test_get_hedge_policy(self):
+        policy = LangChainUtils.get_hedge_policy("Mock Model - Echo", percentile=99)
+        self.assertIsInstance(policy.hedge_model, InternalStubModel)
+        self.assertEqual(policy.percentile, 99)
+        self.assertIs(LangChainUtils.get_hedge_policy("Mock Model - Echo", percentile=99), policy)
+
+    def test_hedge_is_timed_on_first_token(self):
+        # Quick first token but a long stream
+        primary = SimulatedStubModel(
+            model_id="test.hedge.ttft", time_to_first_token=0.01,
+            time_to_first_token_jitter=0.0, tokens_per_second=50, output_tokens=15)
+        hedge_model = InternalStubModel("fixed", model_id="test.hedge.ttft.fallback")
+        policy = HedgePolicy(hedge_model, default_delay=0.1, min_delay=0.1)
+
+        response = self.chat(primary, policy)
+        self.assertEqual(len(response.split()), 15)
+        self.assertEqual(policy.hedges_sent, 0)
+        self.assertLess(LangChainUtils.latency_tracker.percentile("test.hedge.ttft", 50), 0.1)
+
+    def test_losing_call_is_cancelled(self):
+        primary = SimulatedStubModel(
+            model_id="test.hedge.loser", time_to_first_token=0.3,
+            time_to_first_token_jitter=0.0, tokens_per_second=20, output_tokens=20)
+        hedge_model = InternalStubModel("fixed", model_id="test.hedge.loser.fallback")
+        policy = HedgePolicy(hedge_model, default_delay=0.05, min_delay=0.05)
+
+        self.assertEqual(self.chat(primary, policy), "Stubbed response")
+
+        # The loser's slot is freed straight away and it stops at its first chunk
+        metrics = LangChainUtils.get_scheduler_metrics()
+        self.assertEqual(metrics["test.hedge.loser"]["active"], 0)
+        stream_reads = []
+        original_stream = primary.stream
+        def stream(input_data):
+            for chunk in original_stream(input_data):
+                stream_reads.append(chunk)
+                yield chunk
+        primary.stream = stream
+        self.assertEqual(self.chat(primary, policy), "Stubbed response")
+        time.sleep(0.5)
+        self.assertEqual(len(stream_reads), 1)
+
+class TestSimulatedStubModel(unittest.TestCase):
+
+    def test_latency_and_output_length(self):
+        model = SimulatedStubModel(
+            time_to_first_token=0.05,
+            time_to_first_token_jitter=0.0,
+            tokens_per_second=1000,
+            output_tokens=50)
+        self.assertAlmostEqual(model.get_generation_time(), 0.1)
+
+        start = time.monotonic()
+        response = LangChainUtils.simple_prompt_response(model, "system", "start of the prompt")
+        elapsed = time.monotonic() - start
+
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertEqual(len(response.split()), 50)
+        self.assertTrue(response.startswith("start of the prompt"))
+
+    def test_stall(self):
+        model = SimulatedStubModel(
+            time_to_first_token=0.0,
+            tokens_per_second=0,
+            stall_probability=1.0,
+            stall_seconds=0.05)
+        start = time.monotonic()
+        model.invoke({"input": "hi"})
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_throttling(self):
+        model = SimulatedStubModel(throttle_probability=1.0)
+        with self.assertRaises(ClientError) as context:
+            model.invoke({"input": "hi"})
+        self.assertEqual(context.exception.response["Error"]["Code"], "ThrottlingException")
+
+    def test_seeded_runs_repeat(self):
+        first = SimulatedStubModel(throttle_probability=0.5, stall_probability=0.5, seed=7)
+        second = SimulatedStubModel(throttle_probability=0.5, stall_probability=0.5, seed=7)
+        self.assertEqual([first._draw() for _ in range(10)], [second._draw() for _ in range(10)])
+
+    def test_choices(self):
+        self.addCleanup(LangChainUtils._simulated_choices.pop, "unit_test", None)
+        LangChainUtils.register_simulated_model_choice(
+            "unit_test", time_to_first_token=0.0, tokens_per_second=0, output_tokens=3)
+        choices = LangChainUtils.get_chat_model_choices()
+        self.assertIn("Mock Model - Simulated Latency", choices)
+        self.assertIn("unit_test", choices)
+
+        model = LangChainUtils.get_chat_model("unit_test")
+        self.assertIsInstance(model, SimulatedStubModel)
+        self.assertEqual(model.output_tokens, 3)
+        self.assertEqual(model.model_id, "internal.simulated.unit_test")
+
+        model = LangChainUtils.get_chat_model("Mock Model - Simulated Slow and Flaky")
+        self.assertEqual(model.throttle_probability, 0.1)
+
 if __name__ == "__main__":
     unittest.main()
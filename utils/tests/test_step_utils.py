@@ -1,8 +1,9 @@
 # pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import streamlit as st
-from utils.step_utils import BaseFlowStep, StepConfigException
+from utils.step_utils import BaseFlowStep, CondenseDataStep
+from utils.step_status import StepConfigException, StepStatus, StatusCriteria
 
 class FlowStepTest(BaseFlowStep):
     """ Stub flow step for testing """
@@ -46,6 +47,33 @@ class TestBaseFlowStepKeyMgmt(unittest.TestCase):
         keys = self.step.get_internal_keys(include_vdata=False)
         self.assertEqual(set(keys), {"pdata_test_step_key1"})
 
+    def test_internal_key_index(self):
+        st.session_state["pdata_test_step_loaded"] = "loaded"
+        self.assertEqual(self.step.get_internal_keys(), ["pdata_test_step_loaded"])
+
+        # New keys are indexed as they are made
+        st.session_state[self.step.format_internal_key(True, "new")] = "new"
+        self.assertEqual(set(self.step.get_internal_keys()),
+                         {"pdata_test_step_loaded", "pdata_test_step_new"})
+
+        # Removed keys are dropped
+        st.session_state.pop("pdata_test_step_new")
+        self.assertEqual(set(self.step.get_internal_keys()), {"pdata_test_step_loaded"})
+
+        # Clearing volatile data, as loading a saved state does, rebuilds the index
+        st.session_state["vdata__step_key_index"] = None
+        st.session_state["pdata_test_step_other"] = "other"
+        self.assertEqual(set(self.step.get_internal_keys(include_vdata=False)),
+                         {"pdata_test_step_loaded", "pdata_test_step_other"})
+
+    def test_internal_key_index_stale(self):
+        self.assertEqual(self.step.get_internal_keys(), [])
+
+        # Keys written straight to state, like widget keys, are found once state changes size
+        st.session_state["vdata_test_step_upload_123"] = "files"
+        self.assertEqual(self.step.get_internal_keys(), ["vdata_test_step_upload_123"])
+        self.assertEqual(self.step.get_internal_keys(include_vdata=False), [])
+
     def test_get_output_subkeys(self):
         self.assertEqual(self.step.get_output_subkeys(), [])
 
@@ -79,5 +107,63 @@ class TestBaseFlowStep(unittest.TestCase):
     def test_get_output_key(self):
         self.assertEqual(self.step.get_output_key(), "pdata_test_step_output_key")
 
+    def test_get_option(self):
+        self.mock_app.get_config.return_value = {
+            "step_options": {"visibility": "afterActive", "btn_reset": "Reset", "nested": {"a": 1}}}
+        self.step.step_config["step_options"] = {"btn_reset": None, "expandability": "never"}
+
+        self.assertEqual(self.step.get_option("visibility"), "afterActive")
+        self.assertIsNone(self.step.get_option("btn_reset", "default"))
+        self.assertEqual(self.step.get_option("missing", "default"), "default")
+        self.assertEqual(self.step.get_option("nested.a"), 1)
+
+        # Status options are matched against sets worked out once
+        self.assertEqual(self.step.get_status_set("visibility"),
+                         StatusCriteria.get_statuses(StatusCriteria.afterActive))
+        self.assertEqual(self.step.get_status_set("expandability"), frozenset())
+        self.assertIn(StepStatus.WAITING, self.step.get_status_set("status_description_visibility"))
+
+    def test_status_criteria(self):
+        self.assertTrue(StatusCriteria.status_matches_criteria("doneOnly", StepStatus.DONE))
+        self.assertFalse(StatusCriteria.status_matches_criteria("anyActive", StepStatus.DONE))
+        self.assertEqual(StatusCriteria.get_statuses(StatusCriteria.always), frozenset(StepStatus))
+        with self.assertRaises(StepConfigException):
+            StatusCriteria.get_statuses("sometimes")
+
+class TestCondenseDataStep(unittest.TestCase):
+
+    def test_get_input_budget(self):
+        step_config = {"max_input_tokens": None, "prompt_reserve_tokens": 4000,
+                       "chunk_tokens": 4000}
+        self.assertEqual(CondenseDataStep.get_input_budget(step_config, "Mock Model - Echo"),
+                         200000 - 4000)
+
+        step_config["prompt_reserve_tokens"] = 300000
+        self.assertEqual(CondenseDataStep.get_input_budget(step_config, "Mock Model - Echo"), 4000)
+
+        step_config["max_input_tokens"] = 500
+        self.assertEqual(CondenseDataStep.get_input_budget(step_config, "Mock Model - Echo"), 500)
+
+    def test_failure_is_not_retried_on_rerun(self):
+        mock_app = MagicMock()
+        mock_app.get_step_config.return_value = {}
+        step = CondenseDataStep("condense", mock_app)
+        step_config = step.get_step_config()
+        state_dict = {}
+        with patch.object(step, 'get_dependency_key', side_effect=lambda name: name), \
+                patch.object(step, 'condense', return_value=None) as mock_condense:
+            state_dict.update({"data": {"doc": "text"}, "chat_model_choice": "Mock Model - Echo"})
+            step.do(step_config, state_dict, StepStatus.ACTIVE)
+            step.do(step_config, state_dict, StepStatus.ACTIVE)
+            self.assertEqual(mock_condense.call_count, 1)
+            self.assertTrue(state_dict[step.internal_failed_key])
+            self.assertNotIn(step.get_output_key(), state_dict)
+
+            # Retrying runs it again
+            state_dict.pop(step.internal_failed_key)
+            mock_condense.return_value = {"doc": "short"}
+            step.do(step_config, state_dict, StepStatus.ACTIVE)
+            self.assertEqual(state_dict[step.get_output_key()], {"doc": "short"})
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,16 @@
 import unittest
 import tempfile
 import os
+import json
+from unittest.mock import patch
 from moto import mock_aws
 import boto3
-from utils.storage_utils import LocalStorageBackend, S3StorageBackend
+from utils.storage_utils import StorageBackend, LocalStorageBackend, S3StorageBackend
+from utils.storage_utils import StorageWriteBuffer
+from utils.cached_s3_storage import CachedS3StorageBackend
+from utils.mem_storage import MemoryStorageBackend
+from utils.sqlite_storage import SqliteStorageBackend
+from utils.aws_utils import AWSUtils
 
 
 class TestLocalStorageBackend(unittest.TestCase):
@@ -120,6 +127,260 @@ class TestLocalStorageBackend(unittest.TestCase):
         self.assertTrue(self.storage.file_exists(new_folder_path))
         self.assertEqual(self.storage.read_text(new_folder_path), content)
 
+
+class TestStorageBulkOperations(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+
+    def check_bulk(self, storage):
+        for index in range(30):
+            storage.write_text(f"states/session_{index}.json", str(index))
+        storage.write_text("states/archive/old.json", "old")
+        storage.write_text("keep.json", "keep")
+
+        # Copy
+        storage.copy_many([(f"states/session_{index}.json", f"copies/session_{index}.json")
+                           for index in range(5)])
+        self.assertEqual(sorted(storage.list_files("copies")),
+                         sorted(f"session_{index}.json" for index in range(5)))
+        self.assertEqual(storage.read_text("copies/session_3.json"), "3")
+        with self.assertRaises(IOError):
+            storage.copy_many([("states/missing.json", "copies/missing.json")])
+
+        # Delete, missing files are ignored
+        storage.delete_many([f"states/session_{index}.json" for index in range(10)] +
+                            ["states/missing.json"])
+        self.assertEqual(len(storage.list_files("states")), 20)
+        storage.delete_many([])
+
+        # Move a folder including sub folders
+        self.assertEqual(storage.move_prefix("states", "moved/states"), 21)
+        self.assertFalse(storage.file_exists("states/session_10.json"))
+        self.assertEqual(len(storage.list_files("moved/states")), 20)
+        self.assertEqual(storage.read_text("moved/states/archive/old.json"), "old")
+        self.assertEqual(storage.read_text("keep.json"), "keep")
+
+        # Move into an existing folder
+        self.assertEqual(storage.move_prefix("copies", "moved/states"), 5)
+        self.assertEqual(len(storage.list_files("moved/states")), 25)
+
+        with self.assertRaises(ValueError):
+            storage.move_prefix("", "moved")
+
+    def test_local_bulk(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.check_bulk(LocalStorageBackend(root_folder=temp_dir))
+
+    def test_memory_bulk(self):
+        self.check_bulk(MemoryStorageBackend())
+
+    def test_sqlite_bulk(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            storage = SqliteStorageBackend(os.path.join(temp_dir, "store.db"))
+            self.check_bulk(storage)
+            self.assertEqual(storage.list_folders("moved/states"), ["archive"])
+
+    @mock_aws
+    def test_s3_bulk(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        storage = S3StorageBackend("test-bucket/root")
+        storage.BULK_DELETE_BATCH = 8
+        with patch.object(storage.s3_client, 'delete_objects',
+                          wraps=storage.s3_client.delete_objects) as mock_delete:
+            self.check_bulk(storage)
+            # 11 keys then 21 moved keys, then 5 more
+            self.assertEqual(mock_delete.call_count, 2 + 3 + 1)
+
+    @mock_aws
+    def test_s3_move_large_object_in_parts(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        storage = S3StorageBackend("test-bucket")
+        data = os.urandom(9 * 1024 * 1024)
+        storage.write_binary("big/data.bin", data)
+
+        with patch.object(storage.s3_client, 'upload_part_copy',
+                          wraps=storage.s3_client.upload_part_copy) as mock_part_copy:
+            self.assertEqual(storage.move_prefix("big", "moved"), 1)
+            self.assertGreater(mock_part_copy.call_count, 1)
+        self.assertEqual(storage.read_binary("moved/data.bin"), data)
+        self.assertFalse(storage.file_exists("big/data.bin"))
+
+    @mock_aws
+    def test_cached_s3_bulk(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            storage = CachedS3StorageBackend("test-bucket", cache_dir=temp_dir)
+            self.check_bulk(storage)
+            self.assertEqual(storage.cache._entries.keys() & {"states/session_12.json"}, set())
+
+
+class TestStorageScan(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+
+    def check_scan(self, storage):
+        storage.write_text("folder/file1.txt", "12345")
+        storage.write_text("folder/file2.txt", "1")
+        storage.write_text("folder/sub/file3.txt", "123")
+
+        entries = {entry["path"]: entry for entry in storage.scan("folder")}
+        self.assertEqual(set(entries.keys()), {"file1.txt", "file2.txt", "sub"})
+        self.assertEqual(entries["sub"]["type"], "folder")
+        self.assertEqual(entries["file1.txt"]["type"], "file")
+        self.assertEqual(entries["file1.txt"]["size"], 5)
+        self.assertIsInstance(entries["file1.txt"]["mtime"], float)
+        self.assertTrue(entries["file1.txt"]["etag"])
+        self.assertEqual(storage.get_version("folder/file1.txt"), entries["file1.txt"]["etag"])
+        self.assertIsNone(storage.get_version("folder/missing.txt"))
+
+        entries = {entry["path"]: entry for entry in storage.scan("folder", recursive=True)}
+        self.assertEqual(set(entries.keys()),
+                         {"file1.txt", "file2.txt", "sub", "sub/file3.txt"})
+        self.assertEqual(entries["sub/file3.txt"]["size"], 3)
+
+        # Etag changes with the content
+        etag = entries["file2.txt"]["etag"]
+        storage.write_text("folder/file2.txt", "changed")
+        entries = {entry["path"]: entry for entry in storage.scan("folder")}
+        self.assertNotEqual(entries["file2.txt"]["etag"], etag)
+
+    def test_local_scan(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.check_scan(LocalStorageBackend(root_folder=temp_dir))
+
+    def test_memory_scan(self):
+        self.check_scan(MemoryStorageBackend())
+
+    def test_sqlite_scan(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.check_scan(SqliteStorageBackend(os.path.join(temp_dir, "store.db")))
+
+    @mock_aws
+    def test_s3_scan(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        storage = S3StorageBackend("test-bucket/root")
+        with patch.object(storage.s3_client, 'list_objects_v2',
+                          wraps=storage.s3_client.list_objects_v2) as mock_list:
+            self.check_scan(storage)
+            self.assertEqual(mock_list.call_count, 3)
+
+
+class TestStorageStreams(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+
+    def check_streams(self, storage):
+        with storage.open_write("folder/data.bin") as file:
+            file.write(b"abc")
+            file.write(b"def")
+        with storage.open_read("folder/data.bin") as file:
+            self.assertEqual(file.read(2), b"ab")
+            file.seek(4)
+            self.assertEqual(file.read(), b"ef")
+
+        with storage.open_write("folder/data.txt", encoding="utf-8") as file:
+            file.write("line 1\n")
+            file.write("line 2\n")
+        with storage.open_read("folder/data.txt", encoding="utf-8") as file:
+            self.assertEqual(list(file), ["line 1\n", "line 2\n"])
+
+        with self.assertRaises(FileNotFoundError):
+            storage.open_read("folder/missing.txt")
+
+    def test_local_streams(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.check_streams(LocalStorageBackend(root_folder=temp_dir))
+
+    def test_local_failed_write_keeps_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            storage = LocalStorageBackend(root_folder=temp_dir)
+            storage.write_text("state.json", json.dumps({"good": 1}))
+
+            with self.assertRaises(TypeError):
+                with storage.open_write("state.json", encoding="utf-8") as file:
+                    json.dump({"k": "v", "bad": object()}, file)
+
+            self.assertEqual(json.loads(storage.read_text("state.json")), {"good": 1})
+            self.assertEqual(os.listdir(temp_dir), ["state.json"])
+
+    def test_memory_streams(self):
+        self.check_streams(MemoryStorageBackend())
+
+    def test_sqlite_streams(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.check_streams(SqliteStorageBackend(os.path.join(temp_dir, "store.db")))
+
+    @mock_aws
+    def test_s3_streams(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        self.check_streams(S3StorageBackend("test-bucket/root"))
+
+    @mock_aws
+    def test_s3_ranged_reads(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+        storage = S3StorageBackend("test-bucket")
+        storage.READ_CHUNK_SIZE = 1000
+        data = bytes(range(256)) * 20
+        storage.write_binary("data.bin", data)
+
+        with patch.object(storage.s3_client, 'get_object',
+                          wraps=storage.s3_client.get_object) as mock_get:
+            with storage.open_read("data.bin") as file:
+                parts = []
+                while part := file.read(500):
+                    parts.append(part)
+            self.assertEqual(b"".join(parts), data)
+            self.assertEqual(mock_get.call_count, 6)
+            self.assertEqual(mock_get.call_args_list[0].kwargs['Range'], "bytes=0-999")
+
+            # Reading everything is one request
+            mock_get.reset_mock()
+            with storage.open_read("data.bin") as file:
+                file.seek(100)
+                self.assertEqual(file.read(), data[100:])
+            self.assertEqual(mock_get.call_count, 1)
+
+    @mock_aws
+    def test_s3_multipart_upload(self):
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket="test-bucket")
+        storage = S3StorageBackend("test-bucket")
+        storage.MULTIPART_THRESHOLD = storage.MULTIPART_PART_SIZE = 5 * 1024 * 1024
+        chunk = b"x" * (1024 * 1024)
+
+        with patch.object(storage.s3_client, 'upload_part',
+                          wraps=storage.s3_client.upload_part) as mock_upload_part:
+            with storage.open_write("big.bin") as file:
+                for _ in range(12):
+                    file.write(chunk)
+            self.assertEqual(mock_upload_part.call_count, 3)
+        self.assertEqual(len(storage.read_binary("big.bin")), 12 * len(chunk))
+
+        # An exception aborts the upload
+        with self.assertRaises(RuntimeError):
+            with storage.open_write("aborted.bin") as file:
+                for _ in range(6):
+                    file.write(chunk)
+                raise RuntimeError("stop")
+        self.assertFalse(storage.file_exists("aborted.bin"))
+        self.assertNotIn("Uploads", s3_client.list_multipart_uploads(Bucket="test-bucket"))
+
+    def test_write_buffer(self):
+        written = []
+        with StorageWriteBuffer(written.append) as file:
+            file.write(b"data")
+        self.assertEqual(written, [b"data"])
+
+        with self.assertRaises(RuntimeError):
+            with StorageWriteBuffer(written.append) as file:
+                file.write(b"lost")
+                raise RuntimeError("stop")
+        self.assertEqual(written, [b"data"])
+
+
 class TestS3StorageBackend(unittest.TestCase):
 
     def __init__(self, methodName="runTest"):
@@ -131,6 +392,7 @@ class TestS3StorageBackend(unittest.TestCase):
 
     def set_up(self):
         """ Common setup logic """
+        AWSUtils.clear_clients()
         self.s3_client = boto3.client("s3", region_name="us-east-1")
         self.s3_client.create_bucket(Bucket=self.bucket_name)
         self.storage = S3StorageBackend(f"{self.bucket_name}/{self.folder}")
@@ -308,6 +570,7 @@ class TestS3StorageBackendWithAndWithOutfolders(unittest.TestCase):
 
     def set_up(self, folder=None):
         """ Common setup logic """
+        AWSUtils.clear_clients()
         self.s3_client = boto3.client("s3", region_name="us-east-1")
         self.s3_client.create_bucket(Bucket=self.bucket_name)
         if folder:
@@ -385,6 +648,90 @@ class TestS3StorageBackendWithAndWithOutfolders(unittest.TestCase):
         self.assertTrue(folder_storage.file_exists("file_in_folder.txt"))
         self.assertFalse(folder_storage.file_exists("root_file.txt"))
 
+class TestS3Listing(unittest.TestCase):
+
+    def setUp(self):
+        AWSUtils.clear_clients()
+
+    @mock_aws
+    def test_list_paginates_and_uses_delimiter(self):
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket="test-bucket")
+        for index in range(1050):
+            s3_client.put_object(
+                Bucket="test-bucket", Key=f"states/session_{index:04}.json", Body=b"{}")
+        for index in range(3):
+            s3_client.put_object(
+                Bucket="test-bucket", Key=f"states/sub{index}/file.json", Body=b"{}")
+        s3_client.put_object(Bucket="test-bucket", Key="states2/other.json", Body=b"{}")
+
+        storage = S3StorageBackend("test-bucket")
+        with patch.object(storage.s3_client, 'list_objects_v2',
+                          wraps=storage.s3_client.list_objects_v2) as mock_list:
+            files = storage.list_files("states")
+            self.assertEqual(len(files), 1050)
+            self.assertEqual(files[0], "session_0000.json")
+            self.assertEqual(mock_list.call_count, 2)
+            self.assertEqual(mock_list.call_args.kwargs['Delimiter'], '/')
+
+        self.assertEqual(sorted(storage.list_folders("states")), ["sub0", "sub1", "sub2"])
+        self.assertEqual(sorted(storage.list_folders("")), ["states", "states2"])
+
+    @mock_aws
+    def test_list_root_of_folder_backend(self):
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket="test-bucket")
+        s3_client.put_object(Bucket="test-bucket", Key="folder/file.txt", Body=b"a")
+        s3_client.put_object(Bucket="test-bucket", Key="folder2/other.txt", Body=b"b")
+
+        storage = S3StorageBackend("test-bucket/folder")
+        self.assertEqual(storage.list_files(""), ["file.txt"])
+        self.assertEqual(storage.list_folders(""), [])
+
+
+class TestStorageFactory(unittest.TestCase):
+
+    def setUp(self):
+        StorageBackend.clear_storage_cache()
+        AWSUtils.clear_clients()
+
+    def tearDown(self):
+        StorageBackend.clear_storage_cache()
+
+    def test_local_storage_shared(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            storage = StorageBackend.get_storage(f"local::{temp_dir}")
+            self.assertIsInstance(storage, LocalStorageBackend)
+            self.assertIs(StorageBackend.get_storage(f"local::{temp_dir}"), storage)
+            self.assertIsNot(StorageBackend.get_storage(temp_dir), storage)
+
+    @mock_aws
+    def test_s3_storage_shared_and_checked_once(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+
+        storage = StorageBackend.get_storage("s3::test-bucket/folder|us-east-1")
+        self.assertIs(StorageBackend.get_storage("s3::test-bucket/folder|us-east-1"), storage)
+
+        with patch.object(storage.s3_client, 'head_bucket',
+                          wraps=storage.s3_client.head_bucket) as mock_head:
+            storage.write_text("file.txt", "content")
+            self.assertEqual(storage.read_text("file.txt"), "content")
+            self.assertEqual(storage.list_files(""), ["file.txt"])
+            mock_head.assert_called_once_with(Bucket="test-bucket")
+
+            # Errors cause the bucket to be checked again on next use
+            with self.assertRaises(FileNotFoundError):
+                storage.read_text("missing.txt")
+            storage.read_text("file.txt")
+            self.assertEqual(mock_head.call_count, 2)
+
+    @mock_aws
+    def test_s3_missing_bucket_checked_on_use(self):
+        storage = StorageBackend.get_storage("s3::missing-bucket|us-east-1")
+        with self.assertRaises(ValueError):
+            storage.read_text("file.txt")
+
+
 class TestPathUtilities(unittest.TestCase):
 
     def test_dirname(self):
@@ -0,0 +1,113 @@
+# pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
+import unittest
+import threading
+import time
+from utils.langchain_utils import InternalStubModel
+from utils.summary_utils import MapReduceSummariser
+from utils.flow_utils import FlowUtils
+
+
+class CountingStubModel(InternalStubModel):
+    """ Stub model that records the calls and the peak concurrency """
+
+    def __init__(self):
+        super().__init__("fixed")
+        self.prompts = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, input_data):
+        with self.lock:
+            self.prompts.append(input_data["input"])
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        return type("MockResponse", (object,), {"content": "short summary"})
+
+
+class TestMapReduceSummariser(unittest.TestCase):
+
+    def test_split_text_respects_chunk_size(self):
+        text = '\n'.join([f"line {i} has a few words in it" for i in range(500)])
+        chunks = MapReduceSummariser.split_text(text, 100)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(FlowUtils.estimate_tokens(chunk), 100)
+        self.assertEqual('\n'.join(chunks), text)
+
+    def test_split_text_long_line(self):
+        text = ' '.join(["word"] * 1000)
+        chunks = MapReduceSummariser.split_text(text, 100)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(FlowUtils.estimate_tokens(chunk), 100)
+
+    def test_summarise_map_and_reduce(self):
+        model = CountingStubModel()
+        summariser = MapReduceSummariser(model, chunk_tokens=100, max_concurrency=3)
+        text = '\n'.join([f"ticket {i} was raised and fixed" for i in range(300)])
+
+        summary = summariser.summarise(text)
+
+        self.assertEqual(summary, "short summary")
+        num_chunks = len(MapReduceSummariser.split_text(text, 100))
+        self.assertGreater(len(model.prompts), num_chunks)
+        self.assertLessEqual(model.peak, 3)
+
+    def test_summarise_small_and_empty(self):
+        model = CountingStubModel()
+        summariser = MapReduceSummariser(model, chunk_tokens=100)
+        self.assertEqual(summariser.summarise("A small text"), "short summary")
+        self.assertEqual(len(model.prompts), 1)
+        self.assertEqual(summariser.summarise("  "), "")
+
+    def test_reduce_is_bounded_when_summaries_do_not_shrink(self):
+        model = InternalStubModel("echo")
+        summariser = MapReduceSummariser(model, chunk_tokens=10, max_levels=2)
+        text = '\n'.join(["one two three four five six"] * 10)
+        summary = summariser.summarise(text)
+        self.assertIn("one two three", summary)
+
+    def test_reduce_stops_when_a_level_merges_nothing(self):
+        model = InternalStubModel("echo")
+        calls = []
+        original_invoke = model.invoke
+        def invoke(input_data):
+            calls.append(input_data["input"])
+            return original_invoke(input_data)
+        model.invoke = invoke
+
+        # Each echoed chunk summary fills a chunk, so grouping can't merge any
+        summariser = MapReduceSummariser(model, chunk_tokens=10, max_levels=5)
+        text = '\n'.join(["one two three four five six"] * 4)
+        summariser.summarise(text)
+        num_chunks = len(MapReduceSummariser.split_text(text, 10))
+        self.assertEqual(len(calls), num_chunks + 1)
+
+    def test_final_reduce_fits_max_input_tokens(self):
+        model = InternalStubModel("echo")
+        calls = []
+        original_invoke = model.invoke
+        def invoke(input_data):
+            calls.append(input_data["input"])
+            return original_invoke(input_data)
+        model.invoke = invoke
+
+        # Nothing merges, so the final reduce is cut to the input limit
+        summariser = MapReduceSummariser(model, chunk_tokens=10, max_input_tokens=20)
+        text = '\n'.join(["one two three four five six"] * 8)
+        summariser.summarise(text)
+        self.assertLessEqual(FlowUtils.estimate_tokens(calls[-1]), 20)
+
+    def test_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            MapReduceSummariser(InternalStubModel("echo"), chunk_tokens=0)
+        with self.assertRaises(ValueError):
+            MapReduceSummariser(InternalStubModel("echo"), max_concurrency=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,19 @@
 # pylint: disable=missing-function-docstring, missing-module-docstring, missing-class-docstring, protected-access
+import os
+import datetime
 import unittest
 import tempfile
 from unittest.mock import patch
 from utils.template_mgr import TemplateManager
 from utils.storage_utils import LocalStorageBackend
+from utils.mem_storage import MemoryStorageBackend
 
 
 class TestTemplateManager(unittest.TestCase):
 
     def setUp(self):
 
+        TemplateManager.clear_caches()
         self.temp_dir_1 = tempfile.TemporaryDirectory()
         self.use_case_templates_store = LocalStorageBackend(root_folder=self.temp_dir_1.name)
         self.temp_dir_2 = tempfile.TemporaryDirectory()
@@ -26,7 +30,7 @@ class TestTemplateManager(unittest.TestCase):
 
         # Static mocks
         "file2.txt"
-        mock_yaml_utils.load_yaml.return_value = {
+        mock_yaml_utils.return_value.load_yaml.return_value = {
                     "icon": 'test_icon',
                     "title": 'test_title',
                     "description": 'test_description'
@@ -55,7 +59,7 @@ class TestTemplateManager(unittest.TestCase):
         # Static mocks
         mock_storage_backend.basename.return_value = 'template.yaml'
         mock_config_store.nested_get.return_value = 'test'
-        mock_yaml_utils.load_yaml.return_value = {
+        mock_yaml_utils.return_value.load_yaml.return_value = {
                     "title": 'test_title',
                     "description": 'test_description',
                     "enabled" : 'test_enabled'
@@ -76,6 +80,187 @@ class TestTemplateManager(unittest.TestCase):
         templates = manager.get_group_templates("folder1")
         self.assertSetEqual({'template'}, set(templates.keys()))
 
+    @patch('utils.template_mgr.ConfigStore')
+    @patch('utils.template_mgr.StorageBackend')
+    def test_compiled_template_cache(self, mock_storage_backend, mock_config_store):
+
+        mock_config_store.nested_get.side_effect = ['templates', 'lib'] * 3
+        mock_storage_backend.get_storage.side_effect = [
+            self.use_case_templates_store,
+            self.templates_include_lib_store
+            ] * 3
+        self.addCleanup(setattr, TemplateManager.compiled_templates, 'check_interval_seconds',
+                        TemplateManager.compiled_templates.check_interval_seconds)
+        TemplateManager.compiled_templates.check_interval_seconds = 0
+
+        self.use_case_templates_store.write_text(
+            "group/flow.yaml", "#!local_include _include.yaml\ntitle: Flow\n")
+        self.use_case_templates_store.write_text("group/_include.yaml", "description: one")
+
+        # Loaded once then served from the cache
+        manager = TemplateManager()
+        with patch.object(manager.yaml_utils, 'load_yaml',
+                          wraps=manager.yaml_utils.load_yaml) as mock_load:
+            config = manager.load_template("group/flow")
+            self.assertEqual(config, {"title": "Flow", "description": "one"})
+
+            # Each caller gets its own copy
+            config["title"] = "Changed"
+            self.assertEqual(manager.load_template("group/flow")["title"], "Flow")
+            self.assertEqual(TemplateManager().load_template("group/flow")["title"], "Flow")
+            self.assertEqual(mock_load.call_count, 1)
+
+        # Changing an include rebuilds it
+        with open(f"{self.temp_dir_1.name}/group/_include.yaml", "w", encoding="utf-8") as file:
+            file.write("description: two and longer")
+        self.assertEqual(TemplateManager().load_template("group/flow")["description"],
+                         "two and longer")
+        self.assertEqual(TemplateManager.compiled_templates.misses, 2)
+
+        # A change made while loading is seen by the next call
+        include_path = f"{self.temp_dir_1.name}/group/_include.yaml"
+        load_yaml = manager.yaml_utils.load_yaml
+
+        def load_then_change(file_path, sources):
+            data = load_yaml(file_path, sources)
+            with open(include_path, "w", encoding="utf-8") as file:
+                file.write("description: three and longer")
+            return data
+
+        TemplateManager.compiled_templates.clear()
+        with patch.object(manager.yaml_utils, 'load_yaml', side_effect=load_then_change):
+            self.assertEqual(manager.load_template("group/flow")["description"],
+                             "two and longer")
+        self.assertEqual(manager.load_template("group/flow")["description"],
+                         "three and longer")
+
+    @patch('utils.template_mgr.ConfigStore')
+    @patch('utils.template_mgr.StorageBackend')
+    def test_template_catalog(self, mock_storage_backend, mock_config_store):
+
+        catalog_store = MemoryStorageBackend("catalog")
+        stores = {
+            "templates": self.use_case_templates_store,
+            "lib": self.templates_include_lib_store,
+            "mem::catalog": catalog_store}
+        mock_config_store.nested_get.side_effect = ['templates', 'lib'] * 3
+        mock_storage_backend.get_storage.side_effect = stores.get
+
+        self.use_case_templates_store.write_text(
+            "group/_meta.yaml", "icon: i\ntitle: Group\ndescription: d\n")
+        self.use_case_templates_store.write_text(
+            "group/one.yaml", "#!lib_include shared.yaml\ntitle: One\nenabled: true\n")
+        self.use_case_templates_store.write_text("group/two.yaml", "title: Two\n")
+        self.templates_include_lib_store.write_text("shared.yaml", "description: shared\n")
+
+        self.addCleanup(os.environ.pop, 'TEMPLATE_CATALOG_STORE', None)
+        os.environ['TEMPLATE_CATALOG_STORE'] = 'mem::catalog'
+
+        # First listing loads every template and saves the catalog in the cache store
+        manager = TemplateManager()
+        with patch.object(manager.yaml_utils, 'load_yaml',
+                          wraps=manager.yaml_utils.load_yaml) as mock_load:
+            self.assertEqual(manager.generate_groups(),
+                             {"group": {"icon": "i", "title": "Group", "description": "d"}})
+            self.assertEqual(manager.get_group_templates("group"), {
+                "one": {"title": "One", "description": "shared", "enabled": True},
+                "two": {"title": "Two", "description": "", "enabled": False}})
+            self.assertEqual(mock_load.call_count, 3)
+        self.assertEqual(len(catalog_store.list_files("")), 1)
+        self.assertEqual(sorted(os.listdir(self.temp_dir_1.name)), ["group"])
+
+        # A new process reuses the saved catalog and only reloads changed templates,
+        # the include store is checked file by file rather than listed
+        TemplateManager.clear_caches()
+        with open(f"{self.temp_dir_2.name}/shared.yaml", "w", encoding="utf-8") as file:
+            file.write("description: changed and longer\n")
+        manager = TemplateManager()
+        with patch.object(manager.yaml_utils, 'load_yaml',
+                          wraps=manager.yaml_utils.load_yaml) as mock_load, \
+                patch.object(self.templates_include_lib_store, 'scan') as mock_scan:
+            templates = manager.get_group_templates("group")
+            self.assertEqual(templates["one"]["description"], "changed and longer")
+            mock_load.assert_called_once()
+            self.assertEqual(mock_load.call_args[0][0], "group/one.yaml")
+            mock_scan.assert_not_called()
+        self.assertEqual(manager.get_group_templates("missing"), {})
+
+    @patch('utils.template_mgr.ConfigStore')
+    @patch('utils.template_mgr.StorageBackend')
+    def test_template_bundle(self, mock_storage_backend, mock_config_store):
+
+        mock_config_store.nested_get.side_effect = ['templates', 'lib'] * 4
+        mock_storage_backend.get_storage.side_effect = [
+            self.use_case_templates_store,
+            self.templates_include_lib_store
+            ] * 4
+        self.addCleanup(os.environ.pop, 'TEMPLATE_BUNDLE_CHECK_SECONDS', None)
+        os.environ['TEMPLATE_BUNDLE_CHECK_SECONDS'] = '0'
+
+        self.use_case_templates_store.write_text("group/_meta.yaml", "title: Group\n")
+        self.use_case_templates_store.write_text(
+            "group/flow.yaml", "#!lib_include shared.yaml\ntitle: Flow\n")
+        self.templates_include_lib_store.write_text("shared.yaml", "description: shared\n")
+
+        bundle = TemplateManager().build_bundle()
+        self.assertEqual(set(bundle["compiled"]), {"group/_meta.yaml", "group/flow.yaml"})
+        self.assertEqual(bundle["compiled"]["group/flow.yaml"],
+                         {"title": "Flow", "description": "shared"})
+
+        # Served from the bundle without loading any YAML
+        TemplateManager.clear_caches()
+        manager = TemplateManager()
+        with patch.object(manager.yaml_utils, 'load_yaml') as mock_load:
+            self.assertEqual(manager.generate_groups()["group"]["title"], "Group")
+            self.assertEqual(manager.get_group_templates("group")["flow"]["description"], "shared")
+            config = manager.load_template("group/flow")
+            config["title"] = "Changed"
+            self.assertEqual(manager.load_template("group/flow")["title"], "Flow")
+            mock_load.assert_not_called()
+
+        # A new timestamp with the same content keeps the bundle
+        os.utime(f"{self.temp_dir_2.name}/shared.yaml", ns=(1, 1))
+        self.assertIsNotNone(manager.get_bundle().get())
+
+        # Changed content falls back to the live files
+        with open(f"{self.temp_dir_2.name}/shared.yaml", "w", encoding="utf-8") as file:
+            file.write("description: changed\n")
+        self.assertIsNone(manager.get_bundle().get())
+        self.assertEqual(manager.load_template("group/flow")["description"], "changed")
+
+    @patch('utils.template_mgr.ConfigStore')
+    @patch('utils.template_mgr.StorageBackend')
+    def test_template_bundle_keeps_yaml_types(self, mock_storage_backend, mock_config_store):
+
+        mock_config_store.nested_get.side_effect = ['templates', 'lib'] * 3
+        mock_storage_backend.get_storage.side_effect = [
+            self.use_case_templates_store,
+            self.templates_include_lib_store
+            ] * 3
+        self.addCleanup(os.environ.pop, 'TEMPLATE_BUNDLE_CHECK_SECONDS', None)
+        os.environ['TEMPLATE_BUNDLE_CHECK_SECONDS'] = '0'
+
+        self.use_case_templates_store.write_text("group/plain.yaml", "title: Plain\n")
+        self.use_case_templates_store.write_text(
+            "group/typed.yaml", "title: Typed\nreleased: 2024-05-01\n")
+        self.use_case_templates_store.write_text(
+            "group/tagged.yaml", "title: Tagged\ntags: !!set {draft, shared}\n")
+
+        # Data JSON would change or can't hold, like dates and sets, isn't compiled in
+        bundle = TemplateManager().build_bundle()
+        self.assertEqual(set(bundle["compiled"]), {"group/plain.yaml"})
+        self.assertEqual(sorted(bundle["live"]), ["group/tagged.yaml", "group/typed.yaml"])
+        self.assertEqual(bundle["templates"]["group"]["typed"]["title"], "Typed")
+
+        # The bundle is still used and the template comes from the live file
+        TemplateManager.clear_caches()
+        manager = TemplateManager()
+        self.assertIsNotNone(manager.get_bundle().get())
+        self.assertEqual(manager.load_template("group/typed")["released"],
+                         datetime.date(2024, 5, 1))
+        self.assertEqual(manager.load_template("group/plain")["title"], "Plain")
+        self.assertEqual(manager.load_template("group/tagged")["tags"], {"draft", "shared"})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,18 +1,35 @@
 "YAML helpers for loading configuration"
 from typing import Dict, Any
+import os
 import copy
+import time
+import pickle
+import threading
+import weakref
 from functools import reduce
 import yaml
 from utils.storage_utils import StorageBackend
 
+# Use the libyaml loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 class YAMLKeyResolver:
-    """ Handles special keys in loaded YAML that allow efficient use of templates """
+    """ Handles special keys in loaded YAML that allow efficient use of templates
+
+    Each node of the source data is resolved once and the result is shared by every
+    reference to it. Shared results are never changed, merges copy the dicts they change
+    and the final result is unshared so callers get independent data.
+    """
 
     def __init__(self):
         self.key_prefix = '$'
         self.ref_key = f'{self.key_prefix}ref'
         self.allof_key = f'{self.key_prefix}allOf'
         self.resolution_path = []
+        self.resolved_nodes = {}
 
     @staticmethod
     def _merge_nested(target, source):
@@ -44,6 +61,23 @@ class YAMLKeyResolver:
         # Done
         return target
 
+    @staticmethod
+    def _merge_shared(target, source):
+        """ Same result as _merge_nested for a dict source but target is the only object
+        changed, nested dicts in target are copied before they are merged into and
+        values from source are shared rather than copied
+        """
+        if not isinstance(target, dict):
+            return YAMLKeyResolver._merge_nested(copy.deepcopy(target), source)
+
+        for key, value in source.items():
+            if key in target and isinstance(value, dict) and isinstance(target[key], dict):
+                target[key] = YAMLKeyResolver._merge_shared(dict(target[key]), value)
+            else:
+                target[key] = value
+        # Done
+        return target
+
     def _get_by_path(self, obj, path):
         """Retrieve a value from a nested dictionary using a path string."""
         try:
@@ -56,7 +90,7 @@ class YAMLKeyResolver:
     def _handle_allof_key(self, ref_value, resolved_value, container_dict, data):
         """ Handle the ref key """
         if isinstance(resolved_value, dict):
-            container_dict = YAMLKeyResolver._merge_nested(
+            container_dict = YAMLKeyResolver._merge_shared(
                 container_dict,
                 self._resolve_recursive(resolved_value, data))
         else:
@@ -113,7 +147,8 @@ class YAMLKeyResolver:
                 if key == self.ref_key:
                     self._handle_ref_key(ref_value, resolved_value, container_dict, data)
                 elif key == self.allof_key:
-                    self._handle_allof_key(ref_value, resolved_value, container_dict, data)
+                    container_dict = self._handle_allof_key(
+                        ref_value, resolved_value, container_dict, data)
                 else:
                     raise ValueError(f"unkown special key '{key}'")
 
@@ -126,7 +161,17 @@ class YAMLKeyResolver:
         return container_dict
 
     def _resolve_recursive(self, obj, data):
-        """Recursively resolve references in the given object."""
+        """Recursively resolve references in the given object, each node is resolved once."""
+
+        # Primitive types are returned as is
+        if not isinstance(obj, (dict, list)):
+            return obj
+
+        # Already resolved, the result is shared
+        resolved_node = self.resolved_nodes.get(id(obj))
+        if resolved_node is not None:
+            return resolved_node
+
         if isinstance(obj, dict):
             new_dict = {}
             for key, value in obj.items():
@@ -141,25 +186,47 @@ class YAMLKeyResolver:
                         new_dict[key] = resolved
                     elif not isinstance(resolved, dict):
                         new_dict[key] = resolved
+                    elif isinstance(new_dict[key], dict):
+                        new_dict[key] = self._merge_shared(dict(new_dict[key]), resolved)
                     else:
-                        new_dict[key] = self._merge_nested(new_dict[key] , resolved)
+                        new_dict[key] = self._merge_shared(new_dict[key], resolved)
+            resolved_node = new_dict
+        else:
+            # Recursively resolve each item in the list
+            resolved_node = [self._resolve_recursive(item, data) for item in obj]
 
-            # Done
-            return new_dict
+        # Done
+        self.resolved_nodes[id(obj)] = resolved_node
+        return resolved_node
 
-        if isinstance(obj, list):
-            # Recursively resolve each item in the list
-            return [self._resolve_recursive(item, data) for item in obj]
+    @staticmethod
+    def _unshare(obj, seen):
+        """ Copy any dict or list that appears more than once so every part is independent """
 
-        # For primitive types, return as is
-        return obj
+        if isinstance(obj, dict):
+            if id(obj) in seen:
+                obj = dict(obj)
+            seen.add(id(obj))
+            for key, value in obj.items():
+                obj[key] = YAMLKeyResolver._unshare(value, seen)
+        elif isinstance(obj, list):
+            if id(obj) in seen:
+                obj = list(obj)
+            seen.add(id(obj))
+            for index, value in enumerate(obj):
+                obj[index] = YAMLKeyResolver._unshare(value, seen)
 
+        # Done
+        return obj
 
     def resolve(self, data):
         """ Resolve all the custom keys in the object and return a new object """
 
-        # Start resolution with a deep copy of the data to avoid modifying the original
-        return self._resolve_recursive(copy.deepcopy(data), data)
+        try:
+            resolved = self._resolve_recursive(data, data)
+        finally:
+            self.resolved_nodes = {}
+        return YAMLKeyResolver._unshare(resolved, set())
 
 
     @staticmethod
@@ -171,6 +238,18 @@ class YAMLKeyResolver:
 class YAMLUtils:
     """ Loading and manipultaing YAML files, also custom features like includes """
 
+    # Include file lines per store and path with the version they were read at
+    _include_cache = weakref.WeakKeyDictionary()
+    _include_cache_lock = threading.Lock()
+
+    # Loaded and resolved templates per templates store and path, with the version of
+    # every file read to build them
+    _template_cache = weakref.WeakKeyDictionary()
+    _template_cache_lock = threading.Lock()
+
+    # Seconds a cached template is reused before its files are checked again
+    check_interval_seconds = float(os.getenv('YAML_CACHE_CHECK_SECONDS', '0'))
+
     def __init__(
             self,
             use_case_templates_store : StorageBackend,
@@ -180,11 +259,18 @@ class YAMLUtils:
         self.use_case_templates_store = use_case_templates_store
         self.templates_include_lib_store = templates_include_lib_store
 
-    def load_yaml_with_includes(self, file_path: str) -> Dict[Any, Any]:
-        """ Load the file and process include statements to include local or lib include files"""
+    def load_yaml_with_includes(self, file_path: str, sources: list = None) -> Dict[Any, Any]:
+        """ Load the file and process include statements to include local or lib include files
+        If sources is given each (store, path, version) read is appended to it, the version
+        is taken before the read so a change made while loading is seen by the next check
+        """
 
         # Open the file
+        if sources is not None:
+            version = self.use_case_templates_store.get_version(file_path)
         content = self.use_case_templates_store.read_text(file_path)
+        if sources is not None:
+            sources.append((self.use_case_templates_store, file_path, version))
 
         # Split into lins
         lines = content.split('\n')
@@ -197,27 +283,70 @@ class YAMLUtils:
                 include_lines = self._process_include(
                     line,
                     self.use_case_templates_store,
-                    template_path
+                    template_path,
+                    sources
                 )
                 processed_lines.extend(include_lines)
             elif line.strip().startswith('#!lib_include'):
-                include_lines = self._process_include(line, self.templates_include_lib_store)
+                include_lines = self._process_include(
+                    line, self.templates_include_lib_store, sources=sources)
                 processed_lines.extend(include_lines)
             else:
                 processed_lines.append(line)
 
         # Join back together and then YAML parse
         processed_content = '\n'.join(processed_lines)
-        return yaml.safe_load(processed_content)
+        return yaml.load(processed_content, Loader=SafeLoader)
 
-    def load_yaml(self, file_path: str) -> Dict[Any, Any]:
-        """ Load the yaml with includes and reference resolution """
+    def load_yaml(self, file_path: str, sources: list = None) -> Dict[Any, Any]:
+        """ Load the yaml with includes and reference resolution
+        The result is reused while the file and its includes keep the same versions, each
+        of them is checked once per load, or at most every check_interval_seconds
+        """
 
-        data = self.load_yaml_with_includes(file_path)
+        # Reuse the cached template if none of its files changed
+        store = self.use_case_templates_store
+        with YAMLUtils._template_cache_lock:
+            entry = YAMLUtils._template_cache.get(store, {}).get(file_path)
+        if entry is not None and entry["lib"] is self.templates_include_lib_store:
+            now = time.monotonic()
+            if now - entry["checked"] < YAMLUtils.check_interval_seconds or \
+                    YAMLUtils._sources_current(entry["sources"]):
+                entry["checked"] = now
+                if sources is not None:
+                    sources.extend(entry["sources"])
+                return pickle.loads(entry["data"])
+
+        # Load and resolve, noting the version of every file read
+        read = []
+        data = self.load_yaml_with_includes(file_path, read)
         data =  YAMLKeyResolver.resolve_refs(data)
+        if sources is not None:
+            sources.extend(read)
+
+        # Only cached if every file has a version to check
+        if all(version is not None for _, _, version in read):
+            entry = {
+                "lib": self.templates_include_lib_store,
+                "sources": read,
+                "data": pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+                "checked": time.monotonic(),
+            }
+            with YAMLUtils._template_cache_lock:
+                YAMLUtils._template_cache.setdefault(store, {})[file_path] = entry
+
+        # Done
         return data
 
-    def _process_include(self, line: str, store : StorageBackend, template_path='') -> list:
+    @staticmethod
+    def _sources_current(sources: list) -> bool:
+        """ Check none of the (store, path, version) sources changed, each file checked once """
+        versions = {(store, path): version for store, path, version in sources}
+        return all(store.get_version(path) == version
+                   for (store, path), version in versions.items())
+
+    def _process_include(self, line: str, store : StorageBackend, template_path='',
+                         sources: list = None) -> list:
         parts = line.split()
         if len(parts) != 2:
             raise ValueError(f"Invalid local include directive: {line}")
@@ -228,6 +357,37 @@ class YAMLUtils:
             include_path = f"{template_path}/{include_path}"
 
         # Load the lines
-        content = store.read_text(include_path)
-        lines = content.split('\n')
+        version, lines = YAMLUtils._read_include_lines(store, include_path)
+        if sources is not None:
+            sources.append((store, include_path, version))
         return lines
+
+    @staticmethod
+    def _read_include_lines(store: StorageBackend, include_path: str) -> tuple:
+        """ Read the lines of an include file, reusing the last read if the version is the same
+        Returns the version taken before the read and the lines
+        """
+
+        version = store.get_version(include_path)
+        with YAMLUtils._include_cache_lock:
+            cached = YAMLUtils._include_cache.get(store, {}).get(include_path)
+        if version is not None and cached is not None and cached[0] == version:
+            return version, list(cached[1])
+
+        # Read it, the version is taken first so a change while reading is seen next time
+        lines = store.read_text(include_path).split('\n')
+        if version is not None:
+            with YAMLUtils._include_cache_lock:
+                YAMLUtils._include_cache.setdefault(store, {})[include_path] = \
+                    (version, tuple(lines))
+
+        # Done
+        return version, lines
+
+    @staticmethod
+    def clear_caches():
+        """ Drop all the cached include files and templates """
+        with YAMLUtils._include_cache_lock:
+            YAMLUtils._include_cache.clear()
+        with YAMLUtils._template_cache_lock:
+            YAMLUtils._template_cache.clear()